@@ -3,29 +3,42 @@ NACHO LINGUA FOTOGRAFÍA — Backend Flask 2026
 Persistencia: PostgreSQL (Render) + Cloudinary (imágenes)
 """
 
-import os, json, smtplib, io, threading, math, re, hmac
+import os, json, smtplib, io, threading, math, re, hmac, socket, csv, bisect, codecs
+from array import array
 import time as _time
 import hashlib
 from functools import lru_cache
-import urllib.request, urllib.parse, urllib.error
+import urllib.parse
+from collections import deque, OrderedDict
+import urllib3
+from urllib3.util.retry import Retry
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from datetime import timedelta
+from datetime import datetime, timedelta
 from flask import (Flask, request, send_from_directory,
-                   jsonify, session, send_file)
+                   jsonify, session, send_file, make_response)
 from flask_cors import CORS
 from flask_compress import Compress
 from PIL import Image, ImageDraw, ImageFont
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.utils import secure_filename
+from werkzeug.datastructures import MultiDict
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import text as _sqltext
-import cloudinary, cloudinary.uploader
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+import cloudinary, cloudinary.uploader, cloudinary.api
 import boto3
 from botocore.client import Config
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
 try:
     import phonenumbers          # normalización de números AR (pip install phonenumbers)
 except ImportError:
     phonenumbers = None
+try:
+    import openpyxl              # importar roster desde .xlsx (pip install openpyxl)
+except ImportError:
+    openpyxl = None
 
 # ── CLOUDINARY (solo para previews con marca de agua) ────────────────────────
 cloudinary.config(
@@ -43,7 +56,15 @@ WASABI_REGION     = os.environ.get('WASABI_REGION', 'us-east-1')
 WASABI_ENDPOINT   = os.environ.get('WASABI_ENDPOINT', 'https://s3.wasabisys.com')
 WASABI_ENABLED    = bool(WASABI_ACCESS_KEY and WASABI_SECRET_KEY)
 
+# Multipart de a 8 MB: un original de 20 MB nunca se tiene entero en RAM.
+WASABI_TRANSFER = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                 multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=2)
+
+@lru_cache(maxsize=1)
 def get_wasabi_client():
+    """Cliente S3 compartido (boto3 es thread-safe): reusa el pool de conexiones
+    en vez de abrir TLS nuevo en cada subida/firma."""
     return boto3.client(
         's3',
         endpoint_url          = WASABI_ENDPOINT,
@@ -55,10 +76,43 @@ def get_wasabi_client():
             s3                  = {'addressing_style': 'path'},   # Wasabi + bucket con guion bajo -> path style
             connect_timeout     = 10,
             read_timeout        = 60,
-            retries             = {'max_attempts': 2, 'mode': 'standard'}
+            retries             = {'max_attempts': 2, 'mode': 'standard'},
+            max_pool_connections = 20
         )
     )
 
+WASABI_URL_BASE = f"https://s3.wasabisys.com/{WASABI_BUCKET}/"
+
+def url_publica_wasabi(key):
+    return WASABI_URL_BASE + key
+
+def es_url_wasabi(url):
+    return bool(url) and ('wasabisys.com' in url or bool(WASABI_BUCKET and WASABI_BUCKET in url))
+
+class _LectorContado:
+    """Envuelve un stream (respuesta HTTP) y cuenta los bytes leídos."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes  = 0
+    def read(self, n=-1):
+        data = self.stream.read(n)
+        self.bytes += len(data)
+        return data
+
+def subir_stream_a_wasabi(stream, key):
+    """Sube un stream a Wasabi por multipart sin cargarlo entero en memoria.
+    Devuelve (url, bytes) o (None, bytes) si falla."""
+    lector = _LectorContado(stream)
+    try:
+        get_wasabi_client().upload_fileobj(
+            lector, WASABI_BUCKET, key,
+            ExtraArgs={'ContentType': 'image/jpeg'}, Config=WASABI_TRANSFER
+        )
+        return url_publica_wasabi(key), lector.bytes
+    except Exception as e:
+        print(f"✗ Error Wasabi (stream) {key}: {e}")
+        return None, lector.bytes
+
 def subir_a_wasabi(ruta_local, key):
     """Sube un archivo a Wasabi y devuelve la URL pública."""
     try:
@@ -69,7 +123,7 @@ def subir_a_wasabi(ruta_local, key):
                 ExtraArgs={'ContentType': 'image/jpeg'}
             )
         # URL pública directa de Wasabi
-        url = f"https://s3.wasabisys.com/{WASABI_BUCKET}/{key}"
+        url = url_publica_wasabi(key)
         print(f"✓ Wasabi: subido {key}")
         return url
     except Exception as e:
@@ -81,7 +135,7 @@ def subir_bytes_a_wasabi(data_bytes, key):
     try:
         client = get_wasabi_client()
         client.put_object(Bucket=WASABI_BUCKET, Key=key, Body=data_bytes, ContentType='image/jpeg')
-        url = f"https://s3.wasabisys.com/{WASABI_BUCKET}/{key}"
+        url = url_publica_wasabi(key)
         print(f"✓ Wasabi (bytes): subido {key}")
         return url
     except Exception as e:
@@ -108,6 +162,54 @@ def _cloudinary_public_id_de_url(url):
     except Exception:
         return None
 
+# ── REFERENCIAS DE STORAGE ────────────────────────────────────────────────────
+# La tabla foto no guarda URLs: host, cloud name y bucket se repetían en cada
+# fila. Guarda una referencia compacta y la URL se arma al serializar:
+#   c:<ruta>  Cloudinary; lo que sigue a /image/upload/ (transformación, vNNN,
+#             public_id y formato)
+#   w:<key>   Wasabi
+#   p:<key>   original todavía subiendo a Wasabi ("wasabi_pending:<key>")
+# Cualquier otra URL (otra cuenta, carga manual) se guarda tal cual.
+CLOUDINARY_URL_BASE = (f"https://res.cloudinary.com/{os.environ['CLOUD_NAME']}/image/upload/"
+                       if os.environ.get('CLOUD_NAME') else None)
+_REF_PREFIJOS = [(t, base) for t, base in (('c:', CLOUDINARY_URL_BASE), ('w:', WASABI_URL_BASE),
+                                           ('p:', 'wasabi_pending:')) if base]
+_REF_BASES = dict(_REF_PREFIJOS)
+
+def ref_de_url(url):
+    """URL (o placeholder 'wasabi_pending:') -> referencia compacta para la DB."""
+    for tipo, base in _REF_PREFIJOS:
+        if url and url.startswith(base):
+            return tipo + url[len(base):]
+    return url
+
+_REF_TIPOS = ('c:', 'w:', 'p:')
+
+def url_de_ref(ref):
+    """Referencia de la DB -> URL. Las URLs guardadas tal cual vuelven igual.
+    Una referencia cuya base no está configurada (c: sin CLOUD_NAME) es un error
+    de configuración: se lanza en vez de devolver 'c:...' como si fuera una URL."""
+    base = _REF_BASES.get(ref[:2]) if ref else None
+    if base:
+        return base + ref[2:]
+    if ref and ref[:2] in _REF_TIPOS:
+        raise RuntimeError(f'Referencia {ref[:2]}... sin base configurada (¿falta CLOUD_NAME?)')
+    return ref
+
+def sql_ref_de_url(col):
+    """ref_de_url en SQL, para compactar filas existentes sin traerlas a Python."""
+    casos = ' '.join(f"WHEN left({col}, {len(base)}) = '{base.replace(chr(39), chr(39) * 2)}' "
+                     f"THEN '{tipo}' || substr({col}, {len(base) + 1})"
+                     for tipo, base in _REF_PREFIJOS)
+    return f'CASE {casos} ELSE {col} END'
+
+def sql_url_de_ref(col):
+    """url_de_ref en SQL (la inversa de sql_ref_de_url)."""
+    casos = ' '.join(f"WHEN left({col}, 2) = '{tipo}' "
+                     f"THEN '{base.replace(chr(39), chr(39) * 2)}' || substr({col}, 3)"
+                     for tipo, base in _REF_PREFIJOS)
+    return f'CASE {casos} ELSE {col} END'
+
 def get_wasabi_presigned_url(key, expiry=3600*24*6):
     """Genera URL firmada para acceso privado (6 días; Wasabi no permite mas de 7)."""
     try:
@@ -205,6 +307,7 @@ SMTP_PASS = os.environ.get('SMTP_PASS', '')
 
 # ── Resend (email por API HTTPS — Railway bloquea SMTP saliente en Free/Hobby) ─
 RESEND_API_KEY = os.environ.get('RESEND_API_KEY', '')
+RESEND_API_URL = os.environ.get('RESEND_API_URL', 'https://api.resend.com').rstrip('/')   # otro valor = stand-in de carga_checkout.py
 MAIL_FROM      = os.environ.get('MAIL_FROM', 'Nacho Lingua Fotografía <fotos@nacholingua.com>')
 
 # ── AUTH ADMIN ────────────────────────────────────────────────────────────────
@@ -219,10 +322,95 @@ META_WA_PHONE_ID = os.environ.get('META_WA_PHONE_ID', '')
 META_WA_TEMPLATE = os.environ.get('META_WA_TEMPLATE', 'entrega_fotos')
 META_GRAPH_VER   = os.environ.get('META_GRAPH_VERSION', 'v21.0')  # versión de la Graph API, configurable
 META_WA_ENABLED  = bool(META_WA_TOKEN and META_WA_PHONE_ID)
+META_GRAPH_URL   = os.environ.get('META_GRAPH_URL', 'https://graph.facebook.com').rstrip('/')
 CMB_PHONE        = os.environ.get('CMB_PHONE', '')   # tu numero (CallMeBot) para el aviso de venta
 CMB_APIKEY       = os.environ.get('CMB_APIKEY', '')
+CMB_API_URL      = os.environ.get('CMB_API_URL', 'https://api.callmebot.com').rstrip('/')
 PUBLIC_BASE_URL  = os.environ.get('PUBLIC_BASE_URL', 'https://nacholingua.com').rstrip('/')
 
+# ── HTTP SALIENTE: un solo pool keep-alive para todas las integraciones ──────
+# Resend, Meta, CallMeBot, el microservicio IA y las descargas de imágenes
+# reusan conexiones por host (una ráfaga de entregas no paga un handshake TLS
+# por mensaje), con timeouts y reintentos consistentes y latencia por integración.
+HTTP_POOL = urllib3.PoolManager(num_pools=16, maxsize=8, block=False,
+                                headers={'User-Agent': 'nacholingua/1.0'})
+HTTP_CONNECT_TIMEOUT = 5
+
+class ErrorHTTP(Exception):
+    """Respuesta >= 400 de una integración (mismo uso que urllib.error.HTTPError)."""
+    def __init__(self, code, cuerpo):
+        super().__init__(f'HTTP {code}')
+        self.code   = code
+        self.cuerpo = cuerpo
+
+_HTTP_STATS      = {}
+_HTTP_STATS_LOCK = threading.Lock()
+
+def _registrar_latencia(integracion, ms, ok):
+    with _HTTP_STATS_LOCK:
+        s = _HTTP_STATS.setdefault(integracion, {'n': 0, 'errores': 0, 'total_ms': 0.0,
+                                                 'max_ms': 0.0, 'ultimas': deque(maxlen=200)})
+        s['n']        += 1
+        s['errores']  += 0 if ok else 1
+        s['total_ms'] += ms
+        s['max_ms']    = max(s['max_ms'], ms)
+        s['ultimas'].append(ms)
+
+def http_stats():
+    """Latencia por integración (este worker): promedio, p50/p95 de las últimas 200."""
+    out = {}
+    with _HTTP_STATS_LOCK:
+        for k, s in _HTTP_STATS.items():
+            ult = sorted(s['ultimas'])
+            out[k] = {'pedidos': s['n'], 'errores': s['errores'],
+                      'prom_ms': round(s['total_ms'] / s['n'], 1) if s['n'] else 0,
+                      'p50_ms':  round(ult[len(ult) // 2], 1) if ult else 0,
+                      'p95_ms':  round(ult[int(len(ult) * 0.95)], 1) if ult else 0,
+                      'max_ms':  round(s['max_ms'], 1)}
+    return out
+
+def http_pedir(integracion, metodo, url, cuerpo_json=None, headers=None, timeout=15,
+               idempotente=None, stream=False):
+    """Pedido HTTP por el pool compartido. Devuelve la respuesta de urllib3
+    (.status, .data). Con stream=True el cuerpo se lee con .read(n) y al terminar
+    hay que llamar a http_soltar(). Lanza ErrorHTTP si el servidor responde >= 400.
+    Reintentos: los errores de conexión se reintentan siempre (el pedido no salió);
+    timeouts de lectura y 429/5xx solo si es idempotente (GET por defecto), para no
+    mandar dos veces el mismo email o WhatsApp."""
+    idem = (metodo in ('GET', 'HEAD')) if idempotente is None else idempotente
+    reintentos = Retry(total=2, connect=2, read=2 if idem else 0, status=2 if idem else 0,
+                       backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                       allowed_methods=None, raise_on_status=False)
+    hdrs = dict(headers or {})
+    body = None
+    if cuerpo_json is not None:
+        body = json.dumps(cuerpo_json).encode('utf-8')
+        hdrs.setdefault('Content-Type', 'application/json')
+    t0, ok = _time.perf_counter(), False
+    try:
+        r = HTTP_POOL.request(metodo, url, body=body, headers=hdrs, retries=reintentos,
+                              timeout=urllib3.Timeout(connect=HTTP_CONNECT_TIMEOUT, read=timeout),
+                              preload_content=not stream)
+        ok = r.status < 400
+    finally:
+        _registrar_latencia(integracion, (_time.perf_counter() - t0) * 1000, ok)
+    if r.status >= 400:
+        detalle = (r.read(4096) if stream else r.data).decode('utf-8', 'ignore')
+        if stream:
+            http_soltar(r)
+        raise ErrorHTTP(r.status, detalle)
+    return r
+
+def http_soltar(r):
+    """Libera una respuesta stream: si se leyó entera ya volvió sola al pool; si
+    quedó a medias se cierra (una conexión con bytes pendientes no se puede reusar)."""
+    if not r.closed:
+        r.close()
+    r.release_conn()
+
+def http_json(r):
+    return json.loads(r.data.decode('utf-8')) if r.data else {}
+
 # ── Helpers de la galeria privada del cliente ─────────────────────────────────
 import secrets as _secrets
 def generar_token():
@@ -236,19 +424,56 @@ def url_galeria(token):
 # (Reconocimiento facial eliminado)
 FACES_ENABLED = False
 
+_MESES = {'enero': 1, 'febrero': 2, 'marzo': 3, 'abril': 4, 'mayo': 5, 'junio': 6, 'julio': 7,
+          'agosto': 8, 'septiembre': 9, 'setiembre': 9, 'octubre': 10, 'noviembre': 11, 'diciembre': 12}
+
+def parsear_fecha(texto):
+    """Fecha de un evento a partir del texto libre: '2025-03-15' (input date),
+    '15/03/2025', '15-3-25', '15 de marzo de 2025' o 'marzo 2025' (día 1).
+    None si no se entiende."""
+    t = ' '.join(plegar(texto or '').replace(',', ' ').split())
+    if not t:
+        return None
+    try:
+        m = re.match(r'^(\d{4})-(\d{1,2})-(\d{1,2})', t)
+        if m:
+            return datetime(int(m[1]), int(m[2]), int(m[3])).date()
+        m = re.match(r'^(\d{1,2})[/.-](\d{1,2})[/.-](\d{2}|\d{4})$', t)
+        if m:
+            anio = int(m[3]) + (2000 if len(m[3]) == 2 else 0)
+            return datetime(anio, int(m[2]), int(m[1])).date()
+        m = re.search(r'(?:(\d{1,2}) )?(?:de )?([a-z]+) (?:de |del )?(\d{4})', t)
+        if m and m[2] in _MESES:
+            return datetime(int(m[3]), _MESES[m[2]], int(m[1] or 1)).date()
+    except ValueError:
+        pass
+    return None
+
 # ── MODELOS ───────────────────────────────────────────────────────────────────
 class Evento(db.Model):
     __tablename__ = 'evento'
     id            = db.Column(db.Integer, primary_key=True)
     titulo        = db.Column(db.String(150), nullable=False)
     deporte       = db.Column(db.String(50),  nullable=False)
-    fecha         = db.Column(db.String(50))
+    fecha         = db.Column(db.String(50))                  # texto tal como lo cargó el admin
+    fecha_dia     = db.Column(db.Date, nullable=True)         # la misma fecha tipada (filtros y orden)
+    deporte_slug  = db.Column(db.String(80), nullable=True)   # Categoria.slug_from(deporte), para facetas
     descripcion   = db.Column(db.String(300))
     cover_foto_id = db.Column(db.Integer, nullable=True)
     usar_portada  = db.Column(db.Boolean, default=True)   # False = carpeta madre solo-titulo (sin portada)
     precios_json  = db.Column(db.Text, nullable=True)   # regla propia (None = hereda del padre o del general)
     parent_id     = db.Column(db.Integer, db.ForeignKey('evento.id'), nullable=True)
     creado_en     = db.Column(db.DateTime, server_default=db.func.now())
+    version       = db.Column(db.BigInteger, nullable=False, server_default='0', index=True)  # versión del catálogo en que cambió
+    __table_args__ = (db.Index('ix_evento_deporte_fecha', 'deporte_slug', 'fecha_dia'),
+                      db.Index('ix_evento_fecha_dia', 'fecha_dia'),
+                      db.Index('ix_evento_parent_id', 'parent_id'))
+
+    def set_fecha(self, texto):
+        self.fecha, self.fecha_dia = texto, parsear_fecha(texto)
+
+    def set_deporte(self, nombre):
+        self.deporte, self.deporte_slug = nombre, Categoria.slug_from(nombre or '') or None
     fotos         = db.relationship('Foto', backref='evento', lazy=True, cascade='all, delete-orphan')
     subcarpetas   = db.relationship('Evento',
                                     backref=db.backref('padre', remote_side='Evento.id'),
@@ -257,12 +482,65 @@ class Evento(db.Model):
 class Foto(db.Model):
     __tablename__ = 'foto'
     id           = db.Column(db.Integer, primary_key=True)
-    url_preview  = db.Column(db.String(500), nullable=False)
-    url_original = db.Column(db.String(500), nullable=False)
-    url_cover    = db.Column(db.String(500), nullable=True)   # portada limpia (sin marca, baja res)
+    ref_preview  = db.Column(db.String(500), nullable=False)   # referencias compactas (ver ref_de_url)
+    ref_original = db.Column(db.String(500), nullable=False)
+    ref_cover    = db.Column(db.String(500), nullable=True)    # portada limpia (sin marca, baja res)
     precio       = db.Column(db.Float, default=3200.0)
-    evento_id    = db.Column(db.Integer, db.ForeignKey('evento.id'), nullable=False)
+    evento_id    = db.Column(db.Integer, db.ForeignKey('evento.id'), nullable=True)   # NULL = retirada
     subida_en    = db.Column(db.DateTime, server_default=db.func.now())
+    retirada_en  = db.Column(db.DateTime, nullable=True)   # borrada del catálogo pero vendida (ver borrar_fotos_donde)
+    ia_version   = db.Column(db.String(40), nullable=True)   # versión del modelo IA que la etiquetó
+    key_ia       = db.Column(db.String(300), nullable=True)  # key en Wasabi de la copia para la IA (sin marca, 1280px)
+    version      = db.Column(db.BigInteger, nullable=False, server_default='0', index=True)  # versión del catálogo en que cambió
+
+    # URLs armadas al leer; al asignar una URL se guarda su referencia
+    @property
+    def url_preview(self):
+        return url_de_ref(self.ref_preview)
+
+    @url_preview.setter
+    def url_preview(self, url):
+        self.ref_preview = ref_de_url(url)
+
+    @property
+    def url_original(self):
+        return url_de_ref(self.ref_original)
+
+    @url_original.setter
+    def url_original(self, url):
+        self.ref_original = ref_de_url(url)
+
+    @property
+    def url_cover(self):
+        return url_de_ref(self.ref_cover)
+
+    @url_cover.setter
+    def url_cover(self, url):
+        self.ref_cover = ref_de_url(url)
+
+class VersionCatalogo(db.Model):
+    """Una sola fila: versión del catálogo (fotos, eventos y sus reglas). Cada
+    escritura la incrementa en su propia transacción (ver sellar_catalogo)."""
+    __tablename__ = 'version_catalogo'
+    id           = db.Column(db.Integer, primary_key=True)
+    version      = db.Column(db.BigInteger, nullable=False, default=0)
+    podada_hasta = db.Column(db.BigInteger, nullable=False, server_default='0')  # bajas <= esta versión ya se borraron
+
+class FotoBaja(db.Model):
+    """Fotos borradas y en qué versión: lo que el índice en memoria tiene que sacar
+    (y lo que /catalogo/cambios informa como borrado)."""
+    __tablename__ = 'foto_baja'
+    foto_id   = db.Column(db.Integer, primary_key=True)
+    version   = db.Column(db.BigInteger, nullable=False, index=True)
+    evento_id = db.Column(db.Integer, nullable=True)   # su evento cambia de portada/cantidad
+    creada_en = db.Column(db.DateTime, server_default=db.func.now())
+
+class EventoBaja(db.Model):
+    """Eventos borrados y en qué versión (para /catalogo/cambios)."""
+    __tablename__ = 'evento_baja'
+    evento_id = db.Column(db.Integer, primary_key=True)
+    version   = db.Column(db.BigInteger, nullable=False, index=True)
+    creada_en = db.Column(db.DateTime, server_default=db.func.now())
 
 class Categoria(db.Model):
     __tablename__ = 'categoria'
@@ -284,6 +562,7 @@ class Categoria(db.Model):
 class JugadorRoster(db.Model):
     """Roster de jugadores por evento: número → nombre."""
     __tablename__ = 'jugador_roster'
+    __table_args__ = (db.Index('ux_jugador_roster_evento_numero', 'evento_id', 'numero', unique=True),)
     id         = db.Column(db.Integer, primary_key=True)
     evento_id  = db.Column(db.Integer, db.ForeignKey('evento.id'), nullable=False)
     numero     = db.Column(db.String(10))   # número de camiseta
@@ -292,6 +571,25 @@ class JugadorRoster(db.Model):
     foto_cara  = db.Column(db.String(500))  # URL de foto de referencia (opcional)
     creado_en  = db.Column(db.DateTime, server_default=db.func.now())
 
+# Plegado de acentos idéntico en SQL (índice) y en Python (consulta): translate() es
+# inmutable, así que sirve para un índice de expresión sin la extensión unaccent.
+_ACENTOS       = 'ÁÀÂÄÃÉÈÊËÍÌÎÏÓÒÔÖÕÚÙÛÜÑÇáàâäãéèêëíìîïóòôöõúùûüñç'
+_SIN_ACENTOS   = 'AAAAAEEEEIIIIOOOOOUUUUNCaaaaaeeeeiiiiooooouuuunc'
+_PLEGAR        = str.maketrans(_ACENTOS, _SIN_ACENTOS)
+SQL_NOMBRE_PLEGADO = f"translate(coalesce(jugador_nombre, ''), '{_ACENTOS}', '{_SIN_ACENTOS}')"
+SQL_NOMBRE_TSV     = f"to_tsvector('simple', {SQL_NOMBRE_PLEGADO})"
+
+def plegar(texto):
+    """'González' -> 'gonzalez' (mismo criterio que el índice)."""
+    return (texto or '').translate(_PLEGAR).lower()
+
+def sql_clave_nombre(expr):
+    """Nombre normalizado para indice_jugador: sin acentos, minúsculas y espacios
+    simples. Se calcula siempre en SQL (al indexar y al consultar) para que el
+    lower() sea el mismo de los dos lados."""
+    return (f"lower(btrim(regexp_replace(translate({expr}, '{_ACENTOS}', '{_SIN_ACENTOS}'), "
+            f"'\\s+', ' ', 'g')))")
+
 class FotoEtiqueta(db.Model):
     """Etiquetas IA asociadas a una foto."""
     __tablename__ = 'foto_etiqueta'
@@ -305,15 +603,37 @@ class FotoEtiqueta(db.Model):
     procesado_en     = db.Column(db.DateTime, server_default=db.func.now())
     foto             = db.relationship('Foto', backref='etiquetas', lazy=True)
 
+class IndiceJugador(db.Model):
+    """Índice invertido (evento, número o nombre normalizado) -> foto. Cada foto
+    aparece en su evento y en todos los de arriba, así que "el #10 en todo el
+    torneo" es un rango del PK. Se mantiene desde las etiquetas (reindexar_jugadores)."""
+    __tablename__ = 'indice_jugador'
+    evento_id = db.Column(db.Integer, primary_key=True)
+    tipo      = db.Column(db.String(6), primary_key=True)     # 'numero' | 'nombre'
+    clave     = db.Column(db.String(150), primary_key=True)
+    foto_id   = db.Column(db.Integer, db.ForeignKey('foto.id', ondelete='CASCADE'), primary_key=True)
+    __table_args__ = (db.Index('ix_indice_jugador_foto', 'foto_id'),)
+
 class Compra(db.Model):
     __tablename__ = 'compra'
+    __table_args__ = (db.Index('ix_compra_estado_id', 'estado', 'id'),
+                      db.Index('ix_compra_creada_en', 'creada_en'),
+                      db.Index('ux_compra_clave_idem', 'clave_idem', unique=True,
+                               postgresql_where=db.text("estado = 'pendiente'")),
+                      db.Index('ix_compra_mp_preference_id', 'mp_preference_id',
+                               postgresql_where=db.text('mp_preference_id IS NOT NULL')),
+                      db.Index('ix_compra_impaga_creada_en', 'creada_en',
+                               postgresql_where=db.text("estado IN ('pendiente', 'pending', 'rejected', 'cancelled')")))
     id               = db.Column(db.Integer, primary_key=True)
     mp_preference_id = db.Column(db.String(250))
     mp_payment_id    = db.Column(db.String(100))
+    mp_init_point    = db.Column(db.String(500))   # link de pago de la preferencia (para reusarla)
+    preferencia_pedida_en = db.Column(db.DateTime) # quién está creando la preferencia en MP (y desde cuándo)
+    clave_idem       = db.Column(db.String(64))    # hash del carrito: mismo carrito = misma compra pendiente
     email_cliente    = db.Column(db.String(150), nullable=False)
     nombre_cliente   = db.Column(db.String(150))
     whatsapp_cliente = db.Column(db.String(30))   # número con código país, sin +
-    foto_ids         = db.Column(db.Text)
+    foto_ids         = db.Column(db.Text)   # LEGADO: JSON de ids; la fuente de verdad es compra_foto
     monto_total      = db.Column(db.Float)
     tipo                = db.Column(db.String(30), default='individual')  # individual | pack_digital | pack_impresion
     fotos_impresion_ids = db.Column(db.Text)                              # JSON, solo para pack_impresion
@@ -323,6 +643,99 @@ class Compra(db.Model):
     wa_enviado       = db.Column(db.Boolean, default=False)
     creada_en        = db.Column(db.DateTime, server_default=db.func.now())
 
+class CompraArchivada(db.Model):
+    """Compras impagas viejas, fuera de la tabla viva (mismas columnas que `compra`
+    más archivada_en; se verifica al arrancar con verificar_compra_archivada()).
+    Si llega tarde el webhook de una, se restaura con el mismo id."""
+    __tablename__ = 'compra_archivada'
+    id               = db.Column(db.Integer, primary_key=True)
+    mp_preference_id = db.Column(db.String(250), index=True)
+    mp_payment_id    = db.Column(db.String(100))
+    mp_init_point    = db.Column(db.String(500))
+    preferencia_pedida_en = db.Column(db.DateTime)
+    clave_idem       = db.Column(db.String(64))
+    email_cliente    = db.Column(db.String(150), nullable=False)
+    nombre_cliente   = db.Column(db.String(150))
+    whatsapp_cliente = db.Column(db.String(30))
+    foto_ids         = db.Column(db.Text)
+    monto_total      = db.Column(db.Float)
+    tipo                = db.Column(db.String(30))
+    fotos_impresion_ids = db.Column(db.Text)
+    estado           = db.Column(db.String(50))
+    token_galeria    = db.Column(db.String(64))
+    email_enviado    = db.Column(db.Boolean)
+    wa_enviado       = db.Column(db.Boolean)
+    creada_en        = db.Column(db.DateTime)
+    archivada_en     = db.Column(db.DateTime, server_default=db.func.now())
+
+class CompraFotoArchivada(db.Model):
+    __tablename__ = 'compra_foto_archivada'
+    compra_id = db.Column(db.Integer, primary_key=True)
+    foto_id   = db.Column(db.Integer, primary_key=True)
+
+class CompraFoto(db.Model):
+    """Qué fotos incluye cada compra. Si se borra una foto, su fila se va sola
+    (igual que antes, cuando el id quedaba colgado en el JSON y se ignoraba)."""
+    __tablename__  = 'compra_foto'
+    __table_args__ = (db.Index('ix_compra_foto_foto', 'foto_id', 'compra_id'),)
+    compra_id = db.Column(db.Integer, db.ForeignKey('compra.id', ondelete='CASCADE'), primary_key=True)
+    foto_id   = db.Column(db.Integer, db.ForeignKey('foto.id', ondelete='CASCADE'), primary_key=True)
+
+class VentaDia(db.Model):
+    """Rollup diario de compras aprobadas por tipo. Se suma al aprobarse la compra
+    (y se resta si MP la revierte); /admin/metricas y /admin/stats leen de acá."""
+    __tablename__ = 'venta_dia'
+    dia      = db.Column(db.Date, primary_key=True)
+    tipo     = db.Column(db.String(30), primary_key=True)
+    compras  = db.Column(db.Integer, default=0, nullable=False)
+    ingresos = db.Column(db.Float, default=0, nullable=False)
+    fotos    = db.Column(db.Integer, default=0, nullable=False)
+
+class VentaEventoDia(db.Model):
+    """Rollup diario por evento. Una compra con fotos de varios eventos cuenta en
+    cada uno, y su monto se reparte en proporción a las fotos de cada evento.
+    Sin FK: las ventas de un evento borrado siguen en la historia."""
+    __tablename__ = 'venta_evento_dia'
+    dia       = db.Column(db.Date, primary_key=True)
+    evento_id = db.Column(db.Integer, primary_key=True)
+    compras   = db.Column(db.Integer, default=0, nullable=False)
+    ingresos  = db.Column(db.Float, default=0, nullable=False)
+    fotos     = db.Column(db.Integer, default=0, nullable=False)
+
+class Entrega(db.Model):
+    """Outbox de entregas (email, WhatsApp, aviso de venta). Se escribe en la MISMA
+    transacción que aprueba la compra: si el worker se recicla, nada se pierde."""
+    __tablename__  = 'entrega'
+    __table_args__ = (db.Index('ix_entrega_cola', 'estado', 'proximo_intento'),)
+    id              = db.Column(db.Integer, primary_key=True)
+    compra_id       = db.Column(db.Integer, db.ForeignKey('compra.id'), nullable=False, index=True)
+    canal           = db.Column(db.String(20), nullable=False)   # email | whatsapp | aviso
+    clave           = db.Column(db.String(80), unique=True, nullable=False)   # clave idempotente
+    estado          = db.Column(db.String(20), default='pendiente')   # pendiente | enviando | enviado | omitido | error
+    intentos        = db.Column(db.Integer, default=0)
+    proximo_intento = db.Column(db.DateTime, server_default=db.func.now())
+    error           = db.Column(db.String(300))
+    creado_en       = db.Column(db.DateTime, server_default=db.func.now())   # = momento de la aprobación
+    tomado_en       = db.Column(db.DateTime)
+    enviado_en      = db.Column(db.DateTime)
+
+class NotificacionMP(db.Model):
+    """Inbox del webhook de Mercado Pago: una fila por pago. Los reintentos de MP
+    (y las notificaciones repetidas del mismo pago) caen sobre la misma fila."""
+    __tablename__  = 'notificacion_mp'
+    __table_args__ = (db.Index('ix_notificacion_mp_cola', 'estado', 'proximo_intento'),)
+    id              = db.Column(db.Integer, primary_key=True)
+    payment_id      = db.Column(db.String(50), unique=True, nullable=False)
+    estado          = db.Column(db.String(20), default='pendiente')   # pendiente | procesando | procesada | error
+    veces           = db.Column(db.Integer, default=1)     # notificaciones recibidas para este pago
+    intentos        = db.Column(db.Integer, default=0)     # consultas fallidas a la API de MP
+    estado_pago     = db.Column(db.String(50))             # último status que devolvió MP
+    error           = db.Column(db.String(300))
+    recibida_en     = db.Column(db.DateTime, server_default=db.func.now())   # última notificación
+    proximo_intento = db.Column(db.DateTime, server_default=db.func.now())
+    tomada_en       = db.Column(db.DateTime)
+    procesada_en    = db.Column(db.DateTime)
+
 class Consulta(db.Model):
     __tablename__ = 'consulta'
     id        = db.Column(db.Integer, primary_key=True)
@@ -344,15 +757,132 @@ class ConfigPrecios(db.Model):
     upsell_trigger_qty    = db.Column(db.Integer, default=6)
     precios_json          = db.Column(db.Text, nullable=True)   # regla de precios general (None = escalera por defecto)
     actualizado_en        = db.Column(db.DateTime, server_default=db.func.now())
+    version               = db.Column(db.BigInteger, nullable=False, server_default='0')  # versión del catálogo en que cambió
+
+class Trabajo(db.Model):
+    """Trabajo largo en background (migraciones, procesos por lote).
+    El progreso vive en la BD: si el worker se recicla, otro lo retoma desde `cursor`."""
+    __tablename__ = 'trabajo'
+    id           = db.Column(db.Integer, primary_key=True)
+    tipo         = db.Column(db.String(40), nullable=False, index=True)
+    estado       = db.Column(db.String(20), default='pendiente')   # pendiente | corriendo | terminado | error | cancelado
+    params_json  = db.Column(db.Text)
+    cursor       = db.Column(db.Integer, default=0)       # último id procesado (recorrido por keyset)
+    total        = db.Column(db.Integer, default=0)
+    hechos       = db.Column(db.Integer, default=0)
+    fallidos     = db.Column(db.Integer, default=0)
+    saltados     = db.Column(db.Integer, default=0)
+    bytes        = db.Column(db.BigInteger, default=0)
+    error        = db.Column(db.String(500))
+    dueno        = db.Column(db.String(80))               # worker que lo está corriendo
+    latido       = db.Column(db.DateTime)                 # último "sigo vivo" del dueño
+    creado_en    = db.Column(db.DateTime, server_default=db.func.now())
+    iniciado_en  = db.Column(db.DateTime)
+    terminado_en = db.Column(db.DateTime)
+
+class ObjetoBorrar(db.Model):
+    """Cola de GC del storage: objetos de fotos/eventos borrados, a eliminar en lote."""
+    __tablename__  = 'objeto_borrar'
+    __table_args__ = (db.UniqueConstraint('backend', 'ref', name='uq_objeto_borrar'),)
+    id         = db.Column(db.Integer, primary_key=True)
+    backend    = db.Column(db.String(20), nullable=False)    # wasabi | cloudinary
+    ref        = db.Column(db.String(500), nullable=False)   # key de Wasabi o public_id de Cloudinary
+    estado     = db.Column(db.String(20), default='pendiente', index=True)   # pendiente | borrado | error | conservado
+    intentos   = db.Column(db.Integer, default=0)
+    bytes      = db.Column(db.BigInteger, default=0)         # espacio recuperado
+    creado_en  = db.Column(db.DateTime, server_default=db.func.now())
+    borrado_en = db.Column(db.DateTime)
+
+class LoteFoto(db.Model):
+    """Una foto dentro de un lote de registro (/registrar-fotos/lote)."""
+    __tablename__ = 'lote_foto'
+    id           = db.Column(db.Integer, primary_key=True)
+    trabajo_id   = db.Column(db.Integer, db.ForeignKey('trabajo.id'), nullable=False, index=True)
+    public_id    = db.Column(db.String(300))
+    url_clean    = db.Column(db.String(500))          # URL en Cloudinary (flujo viejo)
+    key_original = db.Column(db.String(500))          # key en Wasabi (subida directa)
+    estado       = db.Column(db.String(20), default='pendiente')   # pendiente | ok | error
+    foto_id      = db.Column(db.Integer)
+    error        = db.Column(db.String(300))
 
 with app.app_context():
     db.create_all()
-    # migracion idempotente: agregar columna url_cover si falta
+    # fotos: URLs completas -> referencias compactas (ver ref_de_url). Las ref_*
+    # se agregan AL LADO de las url_* (no se renombran): durante el deploy con
+    # solapamiento la instancia vieja sigue leyendo y escribiendo url_*, y volver
+    # a la versión anterior no necesita SQL a mano. Un trigger mantiene las dos
+    # en sincronía en ambos sentidos; las filas existentes se completan por tramos
+    # de ids. El release siguiente borra el trigger, la función y las url_*.
     try:
-        db.session.execute(_sqltext('ALTER TABLE foto ADD COLUMN url_cover VARCHAR(500)'))
-        db.session.commit()
-    except Exception:
+        cols = set(db.session.execute(_sqltext(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = 'foto'")).scalars())
+        if 'url_preview' in cols:
+            db.session.execute(_sqltext('ALTER TABLE foto ADD COLUMN IF NOT EXISTS url_cover VARCHAR(500)'))
+            for c in ('preview', 'original', 'cover'):
+                db.session.execute(_sqltext(f'ALTER TABLE foto ADD COLUMN IF NOT EXISTS ref_{c} VARCHAR(500)'))
+                db.session.execute(_sqltext(f'ALTER TABLE foto ALTER COLUMN url_{c} DROP NOT NULL'))
+            alta   = '\n'.join(f"NEW.ref_{c} := COALESCE(NEW.ref_{c}, {sql_ref_de_url(f'NEW.url_{c}')}); "
+                               f"NEW.url_{c} := COALESCE(NEW.url_{c}, {sql_url_de_ref(f'NEW.ref_{c}')});"
+                               for c in ('preview', 'original', 'cover'))
+            cambio = '\n'.join(f"IF NEW.url_{c} IS DISTINCT FROM OLD.url_{c} THEN "
+                               f"NEW.ref_{c} := {sql_ref_de_url(f'NEW.url_{c}')}; "
+                               f"ELSIF NEW.ref_{c} IS DISTINCT FROM OLD.ref_{c} THEN "
+                               f"NEW.url_{c} := {sql_url_de_ref(f'NEW.ref_{c}')}; END IF;"
+                               for c in ('preview', 'original', 'cover'))
+            db.session.execute(_sqltext(f"""
+                CREATE OR REPLACE FUNCTION foto_refs_sync() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        {alta}
+                    ELSE
+                        {cambio}
+                    END IF;
+                    RETURN NEW;
+                END $$ LANGUAGE plpgsql"""))
+            db.session.execute(_sqltext('DROP TRIGGER IF EXISTS foto_refs_sync ON foto'))
+            db.session.execute(_sqltext('CREATE TRIGGER foto_refs_sync BEFORE INSERT OR UPDATE ON foto '
+                                        'FOR EACH ROW EXECUTE FUNCTION foto_refs_sync()'))
+            db.session.commit()
+            lo, hi = db.session.execute(_sqltext(
+                'SELECT min(id), max(id) FROM foto WHERE ref_preview IS NULL OR ref_original IS NULL')).one()
+            n, poner = 0, ', '.join(f'ref_{c} = {sql_ref_de_url("url_" + c)}' for c in ('preview', 'original', 'cover'))
+            while lo is not None and lo <= hi:
+                n += db.session.execute(_sqltext(
+                    f'UPDATE foto SET {poner} '
+                    'WHERE id >= :a AND id < :b AND (ref_preview IS NULL OR ref_original IS NULL)'),
+                    {'a': lo, 'b': lo + 20000}).rowcount
+                db.session.commit()
+                lo += 20000
+            for c in ('preview', 'original'):
+                db.session.execute(_sqltext(f'ALTER TABLE foto ALTER COLUMN ref_{c} SET NOT NULL'))
+            db.session.commit()
+            if n:
+                print(f'[migracion] {n} fotos con referencias compactas (url_* se conservan)')
+    except Exception as e:
+        db.session.rollback()
+        print(f'[migracion] url_* -> ref_*: {e}')
+    try:
+        refs   = ('ref_preview', 'ref_original', 'ref_cover')
+        cambia = ' OR '.join(f'{c} <> {sql_ref_de_url(c)}' for c in refs)
+        lo, hi = db.session.execute(_sqltext(f'SELECT min(id), max(id) FROM foto WHERE {cambia}')).one()
+        n = 0
+        while lo is not None and lo <= hi:
+            n += db.session.execute(_sqltext(
+                f"UPDATE foto SET {', '.join(f'{c} = {sql_ref_de_url(c)}' for c in refs)} "
+                f'WHERE id >= :a AND id < :b AND ({cambia})'), {'a': lo, 'b': lo + 20000}).rowcount
+            db.session.commit()
+            lo += 20000
+        if n:
+            print(f'[migracion] {n} fotos pasadas a referencias compactas')
+    except Exception as e:
         db.session.rollback()
+        print(f'[migracion] referencias compactas: {e}')
+    # Sin CLOUD_NAME las referencias c: no se pueden volver URL: mejor no arrancar
+    # que servir 'c:...' como link de cada preview.
+    if not CLOUDINARY_URL_BASE and db.session.execute(_sqltext(
+            "SELECT EXISTS (SELECT 1 FROM foto WHERE left(ref_preview, 2) = 'c:' "
+            "OR left(ref_original, 2) = 'c:' OR left(ref_cover, 2) = 'c:')")).scalar():
+        raise RuntimeError('Hay fotos con referencias de Cloudinary (c:) y falta CLOUD_NAME')
     try:
         db.session.execute(_sqltext('ALTER TABLE evento ADD COLUMN usar_portada BOOLEAN DEFAULT TRUE'))
         db.session.commit()
@@ -368,33 +898,157 @@ with app.app_context():
         db.session.commit()
     except Exception:
         db.session.rollback()
+    # eventos: fecha tipada y deporte normalizado (facetas del listado). El backfill
+    # parsea el texto en Python y solo toca las filas que nunca pasaron por él:
+    # las que no tienen deporte_slug (se completan juntos). Una fecha que no se
+    # puede parsear queda en NULL y no se vuelve a intentar en cada arranque.
+    for ddl in ('ALTER TABLE evento ADD COLUMN IF NOT EXISTS fecha_dia DATE',
+                'ALTER TABLE evento ADD COLUMN IF NOT EXISTS deporte_slug VARCHAR(80)',
+                'ALTER TABLE evento ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0',
+                'CREATE INDEX IF NOT EXISTS ix_evento_version ON evento (version)',
+                'CREATE INDEX IF NOT EXISTS ix_evento_deporte_fecha ON evento (deporte_slug, fecha_dia)',
+                'CREATE INDEX IF NOT EXISTS ix_evento_fecha_dia ON evento (fecha_dia)',
+                'CREATE INDEX IF NOT EXISTS ix_evento_parent_id ON evento (parent_id)'):
+        try:
+            db.session.execute(_sqltext(ddl))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+    try:
+        for ev in Evento.query.filter(Evento.deporte_slug.is_(None)).all():
+            ev.set_fecha(ev.fecha)
+            ev.set_deporte(ev.deporte)
+            ev.deporte_slug = ev.deporte_slug or ''   # procesada aunque no tenga deporte
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f'[migracion] fecha/deporte de eventos: {e}')
+    # roster: un número por evento. Antes de crear el índice único se dejan solo
+    # las filas más nuevas de cada (evento, número) repetido.
+    try:
+        db.session.execute(_sqltext("""
+            DELETE FROM jugador_roster r
+             USING jugador_roster n
+             WHERE n.evento_id = r.evento_id AND n.numero = r.numero AND n.id > r.id"""))
+        db.session.execute(_sqltext('CREATE UNIQUE INDEX IF NOT EXISTS ux_jugador_roster_evento_numero '
+                                    'ON jugador_roster (evento_id, numero)'))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f'[migracion] roster único: {e}')
+    # búsqueda de jugadores: nombre sin acentos en un índice GIN de texto completo
+    # (prefijos con to_tsquery 'gonz:*'; no depende de pg_trgm ni unaccent) + número
+    for ddl in (f'CREATE INDEX IF NOT EXISTS ix_foto_etiqueta_nombre_fts ON foto_etiqueta USING gin ({SQL_NOMBRE_TSV})',
+                'CREATE INDEX IF NOT EXISTS ix_foto_etiqueta_numero ON foto_etiqueta (numero_camiseta)',
+                'CREATE INDEX IF NOT EXISTS ix_foto_etiqueta_foto ON foto_etiqueta (foto_id)',
+                'ALTER TABLE foto ADD COLUMN IF NOT EXISTS ia_version VARCHAR(40)',
+                'ALTER TABLE foto ADD COLUMN IF NOT EXISTS key_ia VARCHAR(300)',
+                'ALTER TABLE foto ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0',
+                'ALTER TABLE foto ADD COLUMN IF NOT EXISTS retirada_en TIMESTAMP',
+                'ALTER TABLE foto ALTER COLUMN evento_id DROP NOT NULL',
+                'CREATE INDEX IF NOT EXISTS ix_foto_version ON foto (version)',
+                'ALTER TABLE foto_baja ADD COLUMN IF NOT EXISTS evento_id INTEGER',
+                'ALTER TABLE foto_baja ADD COLUMN IF NOT EXISTS creada_en TIMESTAMP DEFAULT now()',
+                'ALTER TABLE evento_baja ADD COLUMN IF NOT EXISTS creada_en TIMESTAMP DEFAULT now()',
+                'ALTER TABLE version_catalogo ADD COLUMN IF NOT EXISTS podada_hasta BIGINT NOT NULL DEFAULT 0',
+                'ALTER TABLE config_precios ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0',
+                'INSERT INTO version_catalogo (id, version) VALUES (1, 0) ON CONFLICT DO NOTHING'):
+        try:
+            db.session.execute(_sqltext(ddl))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f'[migracion] {ddl[:60]}...: {e}')
+    for ddl in ('ALTER TABLE compra ADD COLUMN mp_init_point VARCHAR(500)',
+                'ALTER TABLE compra ADD COLUMN clave_idem VARCHAR(64)',
+                'ALTER TABLE compra ADD COLUMN IF NOT EXISTS preferencia_pedida_en TIMESTAMP',
+                'ALTER TABLE compra_archivada ADD COLUMN IF NOT EXISTS preferencia_pedida_en TIMESTAMP',
+                # una sola compra pendiente por carrito: antes del índice único, las
+                # repetidas (viejas, fuera de la ventana de reuso) pierden la clave
+                "UPDATE compra c SET clave_idem = NULL FROM compra n "
+                "WHERE n.clave_idem = c.clave_idem AND n.estado = 'pendiente' AND c.estado = 'pendiente' "
+                "AND n.id > c.id",
+                "CREATE UNIQUE INDEX IF NOT EXISTS ux_compra_clave_idem ON compra (clave_idem) "
+                "WHERE estado = 'pendiente'",
+                'DROP INDEX IF EXISTS ix_compra_clave_idem',
+                'CREATE INDEX IF NOT EXISTS ix_compra_mp_preference_id ON compra (mp_preference_id) '
+                'WHERE mp_preference_id IS NOT NULL',
+                "CREATE INDEX IF NOT EXISTS ix_compra_impaga_creada_en ON compra (creada_en) "
+                "WHERE estado IN ('pendiente', 'pending', 'rejected', 'cancelled')"):
+        try:
+            db.session.execute(_sqltext(ddl))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+    # índices para el listado paginado de compras (create_all no los agrega a tablas existentes)
+    for ddl in ('CREATE INDEX IF NOT EXISTS ix_compra_estado_id ON compra (estado, id)',
+                'CREATE INDEX IF NOT EXISTS ix_compra_creada_en ON compra (creada_en)',
+                'CREATE INDEX IF NOT EXISTS ix_foto_evento_id ON foto (evento_id)'):
+        try:
+            db.session.execute(_sqltext(ddl))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+    # backfill idempotente: compra.foto_ids (JSON) -> compra_foto. Sólo toca las
+    # compras que todavía no tienen filas, así que en cada arranque es casi gratis.
+    try:
+        db.session.execute(_sqltext("""
+            INSERT INTO compra_foto (compra_id, foto_id)
+            SELECT c.id, j.fid::int
+              FROM compra c
+              CROSS JOIN LATERAL json_array_elements_text(c.foto_ids::json) AS j(fid)
+              JOIN foto f ON f.id = j.fid::int
+             WHERE c.foto_ids IS NOT NULL AND c.foto_ids NOT IN ('', '[]')
+               AND NOT EXISTS (SELECT 1 FROM compra_foto cf WHERE cf.compra_id = c.id)
+            ON CONFLICT DO NOTHING"""))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f'[migracion] backfill compra_foto: {e}')
 
 # ── PRICING CENTRALIZADO (única fuente de verdad) ─────────────────────────────
 # ── Cache en memoria para los endpoints públicos calientes ──────────────────
 # Con mucha gente entrando a la vez, /obtener-eventos y /config-precios se
-# calculan UNA vez cada 30s en lugar de una vez por visitante.
-_CACHE_PUB = {}
+# calculan UNA vez cada 30s en lugar de una vez por visitante. Las claves que
+# arma el cliente (búsquedas, filtros) no tienen techo: LRU de CACHE_PUB_MAX.
+CACHE_PUB_MAX = 1000
+_CACHE_PUB    = OrderedDict()
+_CACHE_LOCK   = threading.Lock()
 
 def _cache_get(clave, ttl=30):
-    v = _CACHE_PUB.get(clave)
-    if v and (_time.time() - v[0]) < ttl:
-        return v[1]
+    with _CACHE_LOCK:
+        v = _CACHE_PUB.get(clave)
+        if v and (_time.time() - v[0]) < ttl:
+            _CACHE_PUB.move_to_end(clave)
+            return v[1]
     return None
 
 def _cache_set(clave, data):
-    _CACHE_PUB[clave] = (_time.time(), data)
+    with _CACHE_LOCK:
+        _CACHE_PUB[clave] = (_time.time(), data)
+        _CACHE_PUB.move_to_end(clave)
+        while len(_CACHE_PUB) > CACHE_PUB_MAX:
+            _CACHE_PUB.popitem(last=False)
     return data
 
-def invalidar_cache_publica():
-    _CACHE_PUB.clear()
+def invalidar_cache_publica(prefijo=None):
+    """Vacía el cache público, o solo las claves que empiezan con prefijo
+    (p. ej. 'jugador:' cuando cambian etiquetas)."""
+    with _CACHE_LOCK:
+        if prefijo is None:
+            _CACHE_PUB.clear()
+        else:
+            for clave in [k for k in _CACHE_PUB if k.startswith(prefijo)]:
+                del _CACHE_PUB[clave]
 
 def get_config():
     """Devuelve la fila de configuración, creándola con defaults si no existe."""
     cfg = ConfigPrecios.query.get(1)
     if not cfg:
-        cfg = ConfigPrecios(id=1)
-        db.session.add(cfg)
+        # Varias compras a la vez en una base nueva pueden llegar juntas acá
+        db.session.execute(pg_insert(ConfigPrecios.__table__).values(id=1).on_conflict_do_nothing())
         db.session.commit()
+        cfg = ConfigPrecios.query.get(1)
     return cfg
 
 def precio_unitario_volumen(cantidad, cfg=None):
@@ -478,6 +1132,190 @@ def _total_por_regla(regla, n):
         pass
     return precio_escalera(n)
 
+# ── ÍNDICE DE FOTOS EN MEMORIA (por proceso) ────────────────────────────────
+# Lo que los caminos calientes necesitan saber de una foto (evento, precio y un
+# par de flags) en arreglos paralelos ordenados por id: 17 bytes por foto (4+4+8+1) en
+# vez de un objeto ORM. Cada pedido compara la versión del catálogo (una fila) y
+# trae solo lo que cambió desde la última vez: fotos con version mayor y bajas.
+FOTO_ORIGINAL_LISTO = 1   # el original ya está en su storage (ref no 'p:')
+FOTO_CON_PORTADA    = 2   # tiene portada limpia
+
+def sellar_catalogo():
+    """Nueva versión del catálogo, para guardar en lo que cambia. Va en la misma
+    transacción que el cambio: la fila queda bloqueada hasta el commit, así que
+    las versiones se confirman en orden y un lector nunca se saltea una."""
+    return db.session.execute(_sqltext(
+        'INSERT INTO version_catalogo (id, version) VALUES (1, 1) '
+        'ON CONFLICT (id) DO UPDATE SET version = version_catalogo.version + 1 RETURNING version')).scalar()
+
+def version_catalogo_actual():
+    return db.session.query(VersionCatalogo.version).filter_by(id=1).scalar() or 0
+
+def catalogo_podado_hasta():
+    return db.session.query(VersionCatalogo.podada_hasta).filter_by(id=1).scalar() or 0
+
+def _sql_flags_foto():
+    return (db.case((db.and_(Foto.ref_original != '', ~Foto.ref_original.like('p:%')),
+                     FOTO_ORIGINAL_LISTO), else_=0)
+            + db.case((Foto.ref_cover.isnot(None), FOTO_CON_PORTADA), else_=0))
+
+class IndiceFotos:
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.version = None
+        self.ids     = array('i')
+        self.evento  = array('i')
+        self.precio  = array('d')   # NaN = sin precio
+        self.flags   = array('B')
+        self.eventos = {}           # id -> (parent_id, titulo, regla)
+        self.recargas = self.incrementales = 0
+
+    def _poner(self, fid, eid, precio, flags):
+        i = bisect.bisect_left(self.ids, fid)
+        p = float('nan') if precio is None else float(precio)
+        if i < len(self.ids) and self.ids[i] == fid:
+            self.evento[i], self.precio[i], self.flags[i] = eid, p, flags
+        else:                       # casi siempre i == len (ids crecientes): append
+            self.ids.insert(i, fid); self.evento.insert(i, eid)
+            self.precio.insert(i, p); self.flags.insert(i, flags)
+
+    def _sacar(self, fid):
+        i = bisect.bisect_left(self.ids, fid)
+        if i < len(self.ids) and self.ids[i] == fid:
+            for a in (self.ids, self.evento, self.precio, self.flags):
+                del a[i]
+
+    def _cargar_eventos(self, desde=None):
+        """Todos los eventos, o solo los que cambiaron/se borraron después de `desde`."""
+        q = db.session.query(Evento.id, Evento.parent_id, Evento.titulo, Evento.precios_json)
+        if desde is None:
+            self.eventos = {}
+        else:
+            q = q.filter(Evento.version > desde)
+            for (eid,) in db.session.query(EventoBaja.evento_id).filter(EventoBaja.version > desde):
+                self.eventos.pop(eid, None)
+        for eid, pid, titulo, reglas in q:
+            self.eventos[eid] = (pid, titulo, json.loads(reglas) if reglas else None)
+
+    def actualizar(self):
+        """Trae los cambios desde la última versión vista (o todo, la primera vez)."""
+        v = version_catalogo_actual()
+        if v == self.version:
+            return
+        with self.lock:
+            if v == self.version:
+                return
+            cols = (Foto.id, Foto.evento_id, Foto.precio, _sql_flags_foto())
+            if self.version is not None and self.version < catalogo_podado_hasta():
+                self.version = None     # las bajas que faltan ya se podaron: recarga entera
+            if self.version is None:
+                ids, evento, precio, flags = array('i'), array('i'), array('d'), array('B')
+                for fid, eid, p, fl in (db.session.query(*cols).filter(Foto.evento_id.isnot(None))
+                                        .order_by(Foto.id).yield_per(20000)):
+                    ids.append(fid); evento.append(eid)
+                    precio.append(float('nan') if p is None else float(p)); flags.append(fl)
+                self.ids, self.evento, self.precio, self.flags = ids, evento, precio, flags
+                self._cargar_eventos()
+                self.recargas += 1
+            else:
+                for fid, eid, p, fl in db.session.query(*cols).filter(Foto.version > self.version,
+                                                                      Foto.evento_id.isnot(None)):
+                    self._poner(fid, eid, p, fl)
+                for (fid,) in db.session.query(FotoBaja.foto_id).filter(FotoBaja.version > self.version):
+                    self._sacar(fid)
+                self._cargar_eventos(self.version)
+                self.incrementales += 1
+            self.version = v
+
+    def evento_de(self, fid):
+        """evento_id de la foto, o None si no existe. Sin ir a la base."""
+        i = bisect.bisect_left(self.ids, fid)
+        return self.evento[i] if i < len(self.ids) and self.ids[i] == fid else None
+
+    def con_evento(self, foto_ids):
+        """[(foto_id, evento_id)] de las que existen, sin repetidas y en el orden pedido."""
+        vistos, out = set(), []
+        with self.lock:
+            for fid in foto_ids:
+                try:
+                    fid = int(fid)
+                except (TypeError, ValueError):
+                    continue
+                eid = self.evento_de(fid) if fid not in vistos else None
+                if eid is not None:
+                    vistos.add(fid); out.append((fid, eid))
+        return out
+
+    def existentes(self, foto_ids):
+        return [fid for fid, _ in self.con_evento(foto_ids)]
+
+    def completar(self, foto_ids):
+        """Busca en la base las fotos pedidas que el índice no tiene (filas
+        insertadas por fuera de la app, sin sello de versión) y las agrega, con
+        sus eventos. Devuelve cuántas encontró."""
+        with self.lock:
+            faltan = set()
+            for fid in foto_ids:
+                try:
+                    fid = int(fid)
+                except (TypeError, ValueError):
+                    continue
+                if self.evento_de(fid) is None:
+                    faltan.add(fid)
+        if not faltan:
+            return 0
+        filas = (db.session.query(Foto.id, Foto.evento_id, Foto.precio, _sql_flags_foto())
+                 .filter(Foto.id.in_(faltan), Foto.evento_id.isnot(None)).all())
+        with self.lock:
+            for fid, eid, p, fl in filas:
+                self._poner(fid, eid, p, fl)
+            evs = {eid for _, eid, _, _ in filas if eid not in self.eventos}
+            while evs:                  # el evento y, si falta, su madre
+                for eid, pid, titulo, reglas in (db.session.query(Evento.id, Evento.parent_id, Evento.titulo,
+                                                                  Evento.precios_json)
+                                                 .filter(Evento.id.in_(evs))):
+                    self.eventos[eid] = (pid, titulo, json.loads(reglas) if reglas else None)
+                evs = {ev[0] for ev in self.eventos.values()
+                       if ev[0] and ev[0] not in self.eventos} - evs
+        return len(filas)
+
+    def titulo_evento(self, eid):
+        """'Madre / Evento' (o solo el título si es raíz), como en el panel."""
+        ev = self.eventos.get(eid)
+        if ev is None:
+            return None
+        madre = self.eventos.get(ev[0]) if ev[0] else None
+        return f'{madre[1]} / {ev[1]}' if madre else ev[1]
+
+    def regla_de(self, eid, regla_global):
+        """(clave, regla) que rige el evento: la suya, la del evento madre o la general."""
+        ev = self.eventos.get(eid)
+        if ev is not None:
+            pid, _, regla = ev
+            if regla:
+                return f'ev:{eid}', regla
+            madre = self.eventos.get(pid) if pid else None
+            if madre and madre[2]:
+                return f'ev:{pid}', madre[2]
+        return 'global', regla_global
+
+    def stats(self):
+        with self.lock:
+            n = len(self.ids)
+            arreglos = sum(a.itemsize * len(a) for a in (self.ids, self.evento, self.precio, self.flags))
+            return {'fotos': n, 'eventos': len(self.eventos), 'version': self.version,
+                    'bytes_arreglos': arreglos,
+                    'bytes_por_100k_fotos': round(arreglos / n * 100000) if n else 0,
+                    'originales_pendientes': sum(1 for f in self.flags if not f & FOTO_ORIGINAL_LISTO),
+                    'sin_portada': sum(1 for f in self.flags if not f & FOTO_CON_PORTADA),
+                    'recargas': self.recargas, 'incrementales': self.incrementales}
+
+INDICE_FOTOS = IndiceFotos()
+
+def indice_fotos():
+    INDICE_FOTOS.actualizar()
+    return INDICE_FOTOS
+
 def calcular_total(foto_ids, tipo='individual', cfg=None):
     """Calcula (total, items_mp). tipo: individual | pack_digital | pack_impresion."""
     cfg = cfg or get_config()
@@ -492,19 +1330,12 @@ def calcular_total(foto_ids, tipo='individual', cfg=None):
                         'unit_price': total, 'currency_id': 'ARS'}]
     # Cada evento/album puede tener regla propia (fijo o escalera). Si no tiene,
     # hereda la del evento madre; si tampoco, usa el precio general.
-    fotos_db = Foto.query.filter(Foto.id.in_(foto_ids)).all() if foto_ids else []
-    eventos  = {e.id: e for e in Evento.query.all()}
+    # Evento y regla de cada foto salen del índice en memoria (sin objetos ORM)
+    idx = indice_fotos()
     regla_global = json.loads(cfg.precios_json) if getattr(cfg, 'precios_json', None) else None
     grupos = {}
-    for f in fotos_db:
-        clave, regla = 'global', regla_global
-        ev = eventos.get(f.evento_id)
-        if ev is not None:
-            if ev.precios_json:
-                clave, regla = f'ev:{ev.id}', json.loads(ev.precios_json)
-            elif ev.parent_id and ev.parent_id in eventos and eventos[ev.parent_id].precios_json:
-                padre = eventos[ev.parent_id]
-                clave, regla = f'ev:{padre.id}', json.loads(padre.precios_json)
+    for fid, eid in idx.con_evento(foto_ids):
+        clave, regla = idx.regla_de(eid, regla_global)
         g = grupos.setdefault(clave, {'n': 0, 'regla': regla})
         g['n'] += 1
     total = float(sum(_total_por_regla(g['regla'], g['n']) for g in grupos.values())) if grupos else float(precio_escalera(cantidad))
@@ -512,6 +1343,15 @@ def calcular_total(foto_ids, tipo='individual', cfg=None):
                     'unit_price': float(total), 'currency_id': 'ARS'}]
 
 
+def key_wasabi_de_url(url):
+    """Key de Wasabi de una URL path-style. El path es "/{bucket}/{key}".
+    (Antes se hacia split sin limite y si el bucket coincidia con el
+     prefijo de la key, la key quedaba vacia -> link firmado 404.)"""
+    ruta = urllib.parse.urlparse(url or '').path.lstrip('/')   # "{bucket}/{key}"
+    if WASABI_BUCKET and ruta.startswith(WASABI_BUCKET + '/'):
+        return ruta[len(WASABI_BUCKET) + 1:]
+    return ruta.split('/', 1)[1] if '/' in ruta else ruta
+
 def get_download_url(url_original):
     """
     Devuelve URL de descarga:
@@ -520,16 +1360,9 @@ def get_download_url(url_original):
     """
     if not url_original:
         return url_original
-    if 'wasabisys.com' in url_original or (WASABI_BUCKET and WASABI_BUCKET in url_original):
+    if es_url_wasabi(url_original):
         try:
-            # Sacar la KEY de forma robusta: el path es "/{bucket}/{key}".
-            # (Antes se hacia split sin limite y si el bucket coincidia con el
-            #  prefijo de la key, la key quedaba vacia -> link firmado 404.)
-            ruta = urllib.parse.urlparse(url_original).path.lstrip('/')   # "{bucket}/{key}"
-            if WASABI_BUCKET and ruta.startswith(WASABI_BUCKET + '/'):
-                key = ruta[len(WASABI_BUCKET) + 1:]
-            else:
-                key = ruta.split('/', 1)[1] if '/' in ruta else ruta
+            key       = key_wasabi_de_url(url_original)
             presigned = get_wasabi_presigned_url(key, expiry=3600*24*6)
             if presigned:
                 return presigned
@@ -537,6 +1370,164 @@ def get_download_url(url_original):
             print(f'Error presigned URL: {e}')
     return url_original
 
+IA_URL_EXPIRA_SEG = int(os.environ.get('IA_URL_EXPIRA_SEG', 2 * 3600))
+
+def url_imagen_ia(key_ia, url_original):
+    """URL que se le pasa al microservicio IA: la copia reducida con firma corta
+    (la firma es local, sin ida a Wasabi). Si la foto todavía no tiene copia, el
+    original con link firmado como antes."""
+    if key_ia:
+        try:
+            return get_wasabi_client().generate_presigned_url(
+                'get_object', Params={'Bucket': WASABI_BUCKET, 'Key': key_ia},
+                ExpiresIn=IA_URL_EXPIRA_SEG)
+        except Exception as e:
+            print(f'✗ Error presigned URL (ia): {e}')
+    return get_download_url(url_original)
+
+# ── TRABAJOS EN BACKGROUND (reanudables) ──────────────────────────────────────
+# Un trabajo se "toma" con un UPDATE atómico (dueño + latido). Con 2 workers de
+# gunicorn lo corre uno solo; si ese worker se recicla, el latido envejece y el
+# vigía de cualquier worker lo retoma desde el cursor guardado en la BD.
+TRABAJO_ESTANCADO_SEG = 120
+BACKGROUND_WORKERS    = os.environ.get('BACKGROUND_WORKERS', '1') != '0'
+_HANDLERS_TRABAJO     = {}
+_TRABAJOS_LOCALES     = set()   # ids que ya corren en ESTE proceso
+_TRABAJOS_LOCK        = threading.Lock()
+
+def _worker_id():
+    # Se calcula en cada llamada: gunicorn forkea después de importar el módulo
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def trabajo_handler(tipo):
+    """Registra la función que ejecuta los trabajos de `tipo`: fn(trabajo_id, params)."""
+    def deco(fn):
+        _HANDLERS_TRABAJO[tipo] = fn
+        return fn
+    return deco
+
+def _tomar_trabajo(tid):
+    """Reclama el trabajo para este worker. False si otro lo tiene vivo o ya terminó."""
+    n = Trabajo.query.filter(
+        Trabajo.id == tid,
+        Trabajo.estado.in_(('pendiente', 'corriendo')),
+        db.or_(Trabajo.latido.is_(None),
+               Trabajo.latido < db.func.now() - timedelta(seconds=TRABAJO_ESTANCADO_SEG))
+    ).update({'estado': 'corriendo', 'dueno': _worker_id(), 'latido': db.func.now(),
+              'iniciado_en': db.func.coalesce(Trabajo.iniciado_en, db.func.now())},
+             synchronize_session=False)
+    db.session.commit()
+    return n == 1
+
+def avanzar_trabajo(tid, cursor=None, **sumas):
+    """Suma contadores (hechos, fallidos, saltados, bytes), mueve el cursor y renueva
+    el latido, en la MISMA transacción que lo que el handler tenga pendiente.
+    Devuelve False si el trabajo fue cancelado o lo tomó otro worker: hay que cortar."""
+    vals = {'latido': db.func.now()}
+    for campo, v in sumas.items():
+        if v:
+            vals[campo] = getattr(Trabajo, campo) + v
+    if cursor is not None:
+        vals['cursor'] = cursor
+    n = Trabajo.query.filter_by(id=tid, estado='corriendo', dueno=_worker_id()) \
+                     .update(vals, synchronize_session=False)
+    db.session.commit()
+    return n == 1
+
+def _correr_trabajo(tid):
+    with _TRABAJOS_LOCK:
+        if tid in _TRABAJOS_LOCALES:
+            return
+        _TRABAJOS_LOCALES.add(tid)
+    try:
+        with app.app_context():
+            if not _tomar_trabajo(tid):
+                return
+            t  = Trabajo.query.get(tid)
+            fn = _HANDLERS_TRABAJO.get(t.tipo)
+            estado, error = 'terminado', None
+            try:
+                if not fn:
+                    raise RuntimeError(f'tipo de trabajo desconocido: {t.tipo}')
+                fn(tid, json.loads(t.params_json or '{}'))
+            except Exception as e:
+                db.session.rollback()
+                estado, error = 'error', f'{type(e).__name__}: {e}'[:500]
+                print(f'[trabajo {tid}] ERROR: {error}')
+            Trabajo.query.filter_by(id=tid, estado='corriendo', dueno=_worker_id()).update(
+                {'estado': estado, 'error': error, 'terminado_en': db.func.now()},
+                synchronize_session=False)
+            db.session.commit()
+    finally:
+        with _TRABAJOS_LOCK:
+            _TRABAJOS_LOCALES.discard(tid)
+
+def lanzar_trabajo(tipo, params=None, total=0):
+    """Crea el trabajo y lo arranca en un hilo de este worker."""
+    t = Trabajo(tipo=tipo, params_json=json.dumps(params or {}), total=total, estado='pendiente')
+    db.session.add(t); db.session.commit()
+    threading.Thread(target=_correr_trabajo, args=(t.id,), daemon=True).start()
+    return t
+
+def trabajo_activo(tipo):
+    return (Trabajo.query.filter(Trabajo.tipo == tipo,
+                                 Trabajo.estado.in_(('pendiente', 'corriendo')))
+                         .order_by(Trabajo.id.desc()).first())
+
+def _vigia_trabajos():
+    """Retoma trabajos huérfanos (su worker murió o se recicló)."""
+    huerfanos = (db.session.query(Trabajo.id)
+                 .filter(Trabajo.estado.in_(('pendiente', 'corriendo')),
+                         db.or_(Trabajo.latido.is_(None),
+                                Trabajo.latido < db.func.now() - timedelta(seconds=TRABAJO_ESTANCADO_SEG)))
+                 .all())
+    for (tid,) in huerfanos:
+        threading.Thread(target=_correr_trabajo, args=(tid,), daemon=True).start()
+
+def iniciar_periodico(nombre, fn, cada, despertar=None):
+    """Corre fn() cada `cada` segundos en un hilo daemon, dentro del app context.
+    Si se pasa un threading.Event, un .set() lo adelanta sin esperar el plazo."""
+    def loop():
+        while True:
+            if despertar is None:
+                _time.sleep(cada)
+            else:
+                despertar.wait(timeout=cada)
+                despertar.clear()
+            try:
+                with app.app_context():
+                    fn()
+            except Exception as e:
+                print(f'[{nombre}] error: {e}')
+    threading.Thread(target=loop, name=nombre, daemon=True).start()
+
+def _trabajo_dict(t):
+    seg = 0.0
+    if t.iniciado_en:
+        seg = float(db.session.query(db.func.extract(
+            'epoch', db.func.coalesce(Trabajo.terminado_en, db.func.now()) - Trabajo.iniciado_en))
+            .filter(Trabajo.id == t.id).scalar() or 0)
+    procesados = (t.hechos or 0) + (t.fallidos or 0) + (t.saltados or 0)
+    return {
+        'id':          t.id,
+        'tipo':        t.tipo,
+        'estado':      t.estado,
+        'total':       t.total,
+        'hechos':      t.hechos,
+        'fallidos':    t.fallidos,
+        'saltados':    t.saltados,
+        'procesados':  procesados,
+        'progreso':    round(100.0 * procesados / t.total, 1) if t.total else None,
+        'cursor':      t.cursor,
+        'bytes':       t.bytes,
+        'segundos':    round(seg, 1),
+        'items_seg':   round(procesados / seg, 2) if seg else 0,
+        'mb_seg':      round((t.bytes or 0) / 1048576.0 / seg, 2) if seg else 0,
+        'error':       t.error,
+        'creado_en':   t.creado_en.isoformat() if t.creado_en else None,
+        'terminado_en': t.terminado_en.isoformat() if t.terminado_en else None,
+    }
+
 # ════════════════════════════════════════════════════════════════════════════
 # MARCA DE AGUA — Adaptada a versión Frontend (HTML5 Canvas)
 # Núcleo único usado por TODOS los flujos de subida y re-procesamiento.
@@ -579,6 +1570,8 @@ def _marca_core(imagen, texto='@Nacho Lingua', opacidad=1.0, **kwargs):
 MAX_PREVIEW_PX    = 1600   # lado largo máximo de la preview (se ve nítida igual)
 TARGET_PREVIEW_KB = 450    # peso objetivo por preview
 CLEAN_COVER_PX    = 800    # lado largo de la portada limpia (chica, no robable)
+IA_DERIVADA_PX    = int(os.environ.get('IA_DERIVADA_PX', 1280))   # copia para la IA: alcanza para leer dorsales
+PREFIJO_IA        = 'nacho_lingua/ia/'
 
 def _reducir_para_preview(imagen):
     """Baja la resolución SOLO de la preview si supera MAX_PREVIEW_PX (nunca agranda).
@@ -634,6 +1627,31 @@ def _generar_cover_limpia(raw_bytes):
         print(f'[cover] no pude generar portada limpia: {e}')
         return None
 
+def _generar_derivada_ia(raw_bytes, key):
+    """Copia para el microservicio IA: sin marca, lado largo IA_DERIVADA_PX, guardada
+    en Wasabi (privada; se le pasa con URL firmada). Devuelve la key o None."""
+    if not WASABI_ENABLED:
+        return None
+    try:
+        img = Image.open(io.BytesIO(raw_bytes))
+        try:
+            img.draft('RGB', (IA_DERIVADA_PX, IA_DERIVADA_PX))
+        except Exception:
+            pass
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        w, h = img.size
+        lado = max(w, h)
+        if lado > IA_DERIVADA_PX:
+            esc = IA_DERIVADA_PX / float(lado)
+            img = img.resize((max(1, int(w * esc)), max(1, int(h * esc))), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, 'JPEG', quality=82)
+        return key if subir_bytes_a_wasabi(buf.getvalue(), key) else None
+    except Exception as e:
+        print(f'[ia] no pude generar la copia para la IA: {e}')
+        return None
+
 
 def agregar_watermark(ruta_entrada, ruta_salida, texto='@Nacho Lingua'):
     """Uso en la ruta A (/subir-foto): lee de disco y guarda en disco."""
@@ -722,22 +1740,18 @@ def enviar_wa_cliente(compra):
     }
 
     try:
-        req = urllib.request.Request(
-            f"https://graph.facebook.com/{META_GRAPH_VER}/{META_WA_PHONE_ID}/messages",
-            data    = json.dumps(payload).encode('utf-8'),
-            headers = {
-                "Content-Type":  "application/json",
-                "Authorization": f"Bearer {META_WA_TOKEN}"
-            },
-            method = "POST"
+        resp = http_pedir(
+            'meta_wa', 'POST',
+            f"{META_GRAPH_URL}/{META_GRAPH_VER}/{META_WA_PHONE_ID}/messages",
+            cuerpo_json = payload,
+            headers     = {"Authorization": f"Bearer {META_WA_TOKEN}"},
+            timeout     = 15
         )
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            body = json.loads(resp.read().decode('utf-8'))
-            print(f"✓ WhatsApp enviado a {compra.whatsapp_cliente}: {body}")
-            return True
-    except urllib.error.HTTPError as e:
-        detalle = e.read().decode('utf-8', 'ignore')
-        print(f"✗ Error WhatsApp (HTTP {e.code}) [ver={META_GRAPH_VER} phone={META_WA_PHONE_ID}]: {detalle}")
+        body = http_json(resp)
+        print(f"✓ WhatsApp enviado a {compra.whatsapp_cliente}: {body}")
+        return True
+    except ErrorHTTP as e:
+        print(f"✗ Error WhatsApp (HTTP {e.code}) [ver={META_GRAPH_VER} phone={META_WA_PHONE_ID}]: {e.cuerpo}")
         return False
     except Exception as e:
         print(f"✗ Error enviando WhatsApp: {e}")
@@ -748,55 +1762,130 @@ def notificarme_venta(compra):
     if not CMB_PHONE or not CMB_APIKEY:
         return
     try:
-        ids    = json.loads(compra.foto_ids or '[]')
+        n      = CompraFoto.query.filter_by(compra_id=compra.id).count()
         link   = url_galeria(compra.token_galeria) if compra.token_galeria else ''
         msg    = (
             f"Nueva venta! {compra.nombre_cliente or compra.email_cliente} "
-            f"compro {len(ids)} foto{'s' if len(ids)>1 else ''} "
+            f"compro {n} foto{'s' if n>1 else ''} "
             f"por ${compra.monto_total:,.0f} ARS. "
             f"WA: {compra.whatsapp_cliente or 'no dejó'}. "
             f"Galería: {link}"
         )
-        url = (f"https://api.callmebot.com/whatsapp.php"
+        url = (f"{CMB_API_URL}/whatsapp.php"
                f"?phone={CMB_PHONE}&text={urllib.parse.quote(msg)}&apikey={CMB_APIKEY}")
-        urllib.request.urlopen(url, timeout=10)
+        http_pedir('callmebot', 'GET', url, timeout=10, idempotente=False)
+        return True
     except Exception as e:
         print(f"CallMeBot error: {e}")
+        return False
 
-def entregar_compra(compra_id):
-    """Envía email + WhatsApp al cliente en background."""
+# ── OUTBOX DE ENTREGAS (pool acotado, reintentos con backoff) ────────────────
+# La aprobación de la compra escribe una fila por canal; un pool por worker las
+# drena. La clave idempotente evita duplicados si Mercado Pago reintenta el
+# webhook, y viaja a Resend como Idempotency-Key por si un envío se repite.
+ENTREGA_CONCURRENCIA = int(os.environ.get('ENTREGA_CONCURRENCIA', 4))
+ENTREGA_MAX_INTENTOS = 8
+ENTREGA_TRABADA_SEG  = 300    # 'enviando' más que esto = el worker murió a mitad
+_ENTREGAS_DESPERTAR  = threading.Event()
+_ENTREGAS_POOL       = ThreadPoolExecutor(max_workers=ENTREGA_CONCURRENCIA)
+
+def encolar_entregas(compra, generacion='1', canales=None):
+    """Agrega al outbox (SIN commit: va en la transacción del que llama) los envíos
+    que le faltan a una compra aprobada. Reenviar = otra `generacion`."""
+    if not compra.token_galeria:
+        compra.token_galeria = generar_token()
+    if canales is None:
+        canales = ['email', 'whatsapp', 'aviso']
+    canales = [c for c in canales
+               if not (c == 'email' and compra.email_enviado)
+               and not (c == 'whatsapp' and (compra.wa_enviado or not compra.whatsapp_cliente))]
+    if not canales:
+        return 0
+    db.session.execute(
+        pg_insert(Entrega.__table__)
+        .values([{'compra_id': compra.id, 'canal': c, 'estado': 'pendiente', 'intentos': 0,
+                  'clave': f'compra-{compra.id}-{c}-{generacion}'} for c in canales])
+        .on_conflict_do_nothing(index_elements=['clave']))
+    return len(canales)
+
+def despertar_entregas():
+    """Llamar DESPUÉS del commit: el pool arranca ya, sin esperar el próximo sondeo."""
+    _ENTREGAS_DESPERTAR.set()
+
+def _enviar_por_canal(entrega, compra):
+    """Devuelve (estado, error). 'omitido' = el canal no aplica o no está configurado."""
+    if entrega.canal == 'email':
+        if not RESEND_API_KEY:
+            return 'omitido', 'Resend no configurado'
+        if compra.email_enviado:
+            return 'omitido', 'ya enviado'
+        ok = enviar_fotos_email(compra.id, clave=entrega.clave)
+        return ('enviado', None) if ok else ('pendiente', 'fallo el envío del email')
+    if entrega.canal == 'whatsapp':
+        if not META_WA_ENABLED or not compra.whatsapp_cliente:
+            return 'omitido', 'WhatsApp no configurado o sin número'
+        if compra.wa_enviado:
+            return 'omitido', 'ya enviado'
+        if not enviar_wa_cliente(compra):
+            return 'pendiente', 'fallo el envío de WhatsApp'
+        compra.wa_enviado = True
+        return 'enviado', None
+    if entrega.canal == 'aviso':
+        if not CMB_PHONE or not CMB_APIKEY:
+            return 'omitido', 'CallMeBot no configurado'
+        return ('enviado', None) if notificarme_venta(compra) else ('pendiente', 'fallo CallMeBot')
+    return 'error', f'canal desconocido: {entrega.canal}'
+
+def _procesar_entrega(entrega_id):
+    """Corre en el pool: un envío, con su propio app context."""
     with app.app_context():
-        compra = Compra.query.get(compra_id)
+        e = Entrega.query.get(entrega_id)
+        compra = Compra.query.get(e.compra_id) if e else None
         if not compra:
             return
-        # Generar token de galería si no tiene
-        if not compra.token_galeria:
-            compra.token_galeria = generar_token()
-            db.session.commit()
-
-        # 1. Email
-        if not compra.email_enviado:
-            enviar_fotos_email(compra_id)
-
-        # 2. WhatsApp al cliente
-        if not compra.wa_enviado and compra.whatsapp_cliente:
-            ok = enviar_wa_cliente(compra)
-            if ok:
-                compra.wa_enviado = True
-                db.session.commit()
+        try:
+            estado, error = _enviar_por_canal(e, compra)
+        except Exception as ex:
+            db.session.rollback()
+            e = Entrega.query.get(entrega_id)
+            estado, error = 'pendiente', f'{type(ex).__name__}: {ex}'
+        e.error = error[:300] if error else None
+        if estado == 'pendiente':
+            e.intentos = (e.intentos or 0) + 1
+            if e.intentos >= ENTREGA_MAX_INTENTOS:
+                estado = 'error'
+            else:   # backoff exponencial: 30s, 1m, 2m, 4m ... tope 1h
+                e.proximo_intento = db.func.now() + timedelta(seconds=min(30 * 2 ** (e.intentos - 1), 3600))
+        else:
+            e.enviado_en = db.func.now()
+        e.estado = estado
+        db.session.commit()
 
-        # 3. Notificación a Nacho
-        notificarme_venta(compra)
+def drenar_entregas():
+    # Las que quedaron 'enviando' de un worker que murió vuelven a la cola
+    Entrega.query.filter(Entrega.estado == 'enviando',
+                         Entrega.tomado_en < db.func.now() - timedelta(seconds=ENTREGA_TRABADA_SEG)) \
+                 .update({'estado': 'pendiente'}, synchronize_session=False)
+    db.session.commit()
+    while True:
+        filas = (Entrega.query.filter(Entrega.estado == 'pendiente',
+                                      Entrega.proximo_intento <= db.func.now())
+                 .order_by(Entrega.id).limit(ENTREGA_CONCURRENCIA * 2)
+                 .with_for_update(skip_locked=True).all())
+        if not filas:
+            return
+        ids = [f.id for f in filas]
+        for f in filas:
+            f.estado, f.tomado_en = 'enviando', db.func.now()
+        db.session.commit()
+        list(_ENTREGAS_POOL.map(_procesar_entrega, ids))
 
 # ── GALERÍA PRIVADA ────────────────────────────────────────────────────────────
-def enviar_fotos_email(compra_id):
-    compra = Compra.query.get(compra_id)
-    if not compra or compra.email_enviado: return False
-    if not RESEND_API_KEY: return False
-
-    ids   = json.loads(compra.foto_ids or '[]')
-    fotos = Foto.query.filter(Foto.id.in_(ids)).all()
-    if not fotos: return False
+def _mail_compra(compra):
+    """Mensaje de Resend con los links de descarga de la compra (None si no tiene fotos)."""
+    fotos = (Foto.query.join(CompraFoto, CompraFoto.foto_id == Foto.id)
+             .filter(CompraFoto.compra_id == compra.id).order_by(Foto.id).all())
+    if not fotos: return None
 
     nombre = compra.nombre_cliente or compra.email_cliente.split('@')[0].capitalize()
 
@@ -860,32 +1949,38 @@ def enviar_fotos_email(compra_id):
   </div>
 </div></body></html>"""
 
+    return {
+        "from":    MAIL_FROM,
+        "to":      [compra.email_cliente],
+        "subject": f"Tus fotos listas — Nacho Lingua ({len(fotos)} foto{'s' if len(fotos)>1 else ''})",
+        "html":    html
+    }
+
+def enviar_fotos_email(compra_id, clave=None):
+    compra = Compra.query.get(compra_id)
+    if not compra or compra.email_enviado: return False
+    if not RESEND_API_KEY: return False
+
+    payload = _mail_compra(compra)
+    if not payload: return False
     try:
-        payload = {
-            "from":    MAIL_FROM,
-            "to":      [compra.email_cliente],
-            "subject": f"Tus fotos listas — Nacho Lingua ({len(fotos)} foto{'s' if len(fotos)>1 else ''})",
-            "html":    html
-        }
-        req = urllib.request.Request(
-            "https://api.resend.com/emails",
-            data    = json.dumps(payload).encode('utf-8'),
-            headers = {
-                "Content-Type":  "application/json",
+        resp = http_pedir(
+            'resend', 'POST', f"{RESEND_API_URL}/emails",
+            cuerpo_json = payload,
+            headers     = {
                 "Authorization": f"Bearer {RESEND_API_KEY}",
-                "User-Agent":    "nacholingua-mailer/1.0"
+                "User-Agent":    "nacholingua-mailer/1.0",
+                **({"Idempotency-Key": clave} if clave else {})
             },
-            method = "POST"
+            timeout     = 15
         )
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            body = json.loads(resp.read().decode('utf-8'))
+        body = http_json(resp)
         compra.email_enviado = True
         db.session.commit()
         print(f'✓ Email enviado a {compra.email_cliente} (id {body.get("id","?")})')
         return True
-    except urllib.error.HTTPError as e:
-        detalle = e.read().decode('utf-8', 'ignore')
-        print(f'✗ Error email (HTTP {e.code}): {detalle}')
+    except ErrorHTTP as e:
+        print(f'✗ Error email (HTTP {e.code}): {e.cuerpo}')
         return False
     except Exception as e:
         print(f'✗ Error email: {e}'); return False
@@ -897,56 +1992,10 @@ def index(): return send_from_directory('.', 'index.html')
 @app.route('/nacho_lingua.jpg')
 def foto_fondo(): return send_file('nacho_lingua.jpg')
 
-@app.route('/galeria/<token>')
-def galeria_privada(token):
-    compra = Compra.query.filter_by(token_galeria=token, estado='approved').first()
-    if not compra:
-        return """<!DOCTYPE html><html lang="es"><head><meta charset="UTF-8">
-        <title>Link inválido</title>
-        <style>
-            body{background:#06060A;color:#f2f2f2;font-family:sans-serif;
-            display:flex;align-items:center;justify-content:center;
-            min-height:100vh;text-align:center;}
-            h1{color:#D4A843;font-size:28px;margin-bottom:12px;}
-            p{color:#777;font-size:14px;line-height:1.7;}
-            a{color:#D4A843;}
-        </style></head>
-        <body><div>
-            <h1>Link inválido</h1>
-            <p>Este link no existe o el pago no fue confirmado.<br>
-            Si creés que es un error, respondé el email que recibiste.</p>
-            <p><a href="/">← Volver al portfolio</a></p>
-        </div></body></html>""", 404
-
-    ids   = json.loads(compra.foto_ids or '[]')
-    fotos = Foto.query.filter(Foto.id.in_(ids)).all()
-    nombre = compra.nombre_cliente or 'Cliente'
-
-    # get_download_url está definida a nivel de módulo
-
-    fotos_html = ''
-    for f in fotos:
-        titulo    = f.evento.titulo if f.evento else 'Evento deportivo'
-        dl_url    = get_download_url(f.url_original)
-        fotos_html += f'''
-        <div class="foto-card">
-            <div class="foto-img-wrap">
-                <img src="{f.url_preview}" alt="Foto" loading="lazy">
-                <div class="foto-overlay">
-                    <a href="{dl_url}" download target="_blank" class="btn-dl">
-                        ↓ Descargar
-                    </a>
-                </div>
-            </div>
-            <div class="foto-info">
-                <span>{titulo}</span>
-                <a href="{dl_url}" download target="_blank" class="btn-dl-sm">↓ Alta resolución</a>
-            </div>
-        </div>'''
-
-    urls_json = json.dumps([get_download_url(f.url_original) for f in fotos])
-
-    return f'''<!DOCTYPE html>
+# Plantilla compilada UNA vez al importar (Jinja escapa los datos del cliente).
+# La grilla trae la primera página; el resto se pide a /galeria/<token>/fotos
+# a medida que se scrollea, así un pack de cientos de fotos no es una página gigante.
+GALERIA_HTML = '''<!DOCTYPE html>
 <html lang="es">
 <head>
     <meta charset="UTF-8">
@@ -954,43 +2003,45 @@ def galeria_privada(token):
     <title>Tus fotos — Nacho Lingua Fotografía</title>
     <link href="https://fonts.googleapis.com/css2?family=Bebas+Neue&family=Inter:wght@400;600&display=swap" rel="stylesheet">
     <style>
-        *,*::before,*::after{{margin:0;padding:0;box-sizing:border-box;}}
-        :root{{--ink:#06060A;--ink2:#0c0c12;--ink3:#121218;--ink4:#1c1c24;--gold:#D4A843;--text:#f2f2f2;--sub:#888;}}
-        body{{background:var(--ink);color:var(--text);font-family:'Inter',sans-serif;min-height:100vh;}}
-        .header{{background:var(--ink2);border-bottom:1px solid var(--ink4);padding:20px 5%;display:flex;align-items:center;justify-content:space-between;gap:12px;flex-wrap:wrap;}}
-        .brand{{font-family:'Bebas Neue',sans-serif;font-size:20px;letter-spacing:5px;color:var(--gold);}}
-        .back{{font-size:11px;letter-spacing:2px;text-transform:uppercase;color:var(--sub);text-decoration:none;transition:color .2s;}}
-        .back:hover{{color:var(--gold);}}
-        .hero{{padding:40px 5% 28px;border-bottom:1px solid var(--ink3);display:flex;align-items:flex-start;justify-content:space-between;flex-wrap:wrap;gap:20px;}}
-        .hero-eyebrow{{font-size:10px;letter-spacing:4px;text-transform:uppercase;color:var(--gold);margin-bottom:8px;display:flex;align-items:center;gap:10px;}}
-        .hero-eyebrow::before{{content:'';width:20px;height:1px;background:var(--gold);display:block;}}
-        .hero-title{{font-family:'Bebas Neue',sans-serif;font-size:clamp(28px,5vw,46px);letter-spacing:3px;color:var(--text);margin-bottom:8px;}}
-        .hero-sub{{font-size:13px;color:var(--sub);line-height:1.7;max-width:420px;}}
-        .hero-stats{{display:flex;gap:28px;flex-shrink:0;}}
-        .stat{{text-align:center;}}
-        .stat-n{{font-family:'Bebas Neue',sans-serif;font-size:36px;color:var(--gold);line-height:1;display:block;}}
-        .stat-l{{font-size:9px;letter-spacing:2px;text-transform:uppercase;color:#555;display:block;margin-top:3px;}}
-        .toolbar{{padding:14px 5%;background:var(--ink2);border-bottom:1px solid var(--ink4);display:flex;align-items:center;justify-content:space-between;flex-wrap:wrap;gap:10px;}}
-        .toolbar-info{{font-size:12px;color:var(--sub);}}
-        .btn-all{{display:inline-flex;align-items:center;gap:8px;padding:10px 22px;background:var(--gold);color:#000;font-size:11px;font-weight:700;letter-spacing:2px;text-transform:uppercase;text-decoration:none;cursor:pointer;border:none;font-family:'Inter',sans-serif;transition:background .2s;}}
-        .btn-all:hover{{background:#e8bf6a;}}
-        .grid{{display:grid;grid-template-columns:repeat(auto-fill,minmax(280px,1fr));gap:3px;padding:3px 5%;}}
-        .foto-card{{background:var(--ink3);overflow:hidden;}}
-        .foto-img-wrap{{position:relative;aspect-ratio:4/3;overflow:hidden;}}
-        .foto-img-wrap img{{width:100%;height:100%;object-fit:cover;transition:transform .5s,filter .3s;filter:brightness(.88);display:block;}}
-        .foto-card:hover .foto-img-wrap img{{transform:scale(1.04);filter:brightness(.6);}}
-        .foto-overlay{{position:absolute;inset:0;display:flex;align-items:center;justify-content:center;opacity:0;transition:opacity .3s;}}
-        .foto-card:hover .foto-overlay{{opacity:1;}}
-        .btn-dl{{display:inline-flex;align-items:center;gap:6px;padding:12px 22px;background:var(--gold);color:#000;font-size:11px;font-weight:700;letter-spacing:2px;text-transform:uppercase;text-decoration:none;transform:translateY(6px);transition:transform .3s,background .2s;}}
-        .foto-card:hover .btn-dl{{transform:translateY(0);}}
-        .btn-dl:hover{{background:#e8bf6a;}}
-        .foto-info{{padding:10px 14px;display:flex;align-items:center;justify-content:space-between;gap:8px;border-top:1px solid var(--ink4);}}
-        .foto-info span{{font-size:11px;color:var(--sub);overflow:hidden;text-overflow:ellipsis;white-space:nowrap;}}
-        .btn-dl-sm{{font-size:11px;color:var(--gold);text-decoration:none;white-space:nowrap;flex-shrink:0;transition:opacity .2s;}}
-        .btn-dl-sm:hover{{opacity:.8;}}
-        footer{{margin-top:48px;padding:32px 5%;border-top:1px solid var(--ink3);text-align:center;}}
-        footer p{{font-size:11px;color:#333;line-height:1.8;}}
-        @media(max-width:600px){{.hero-stats{{display:none;}}.grid{{grid-template-columns:1fr 1fr;}}.foto-overlay{{display:none;}}}}
+        *,*::before,*::after{margin:0;padding:0;box-sizing:border-box;}
+        :root{--ink:#06060A;--ink2:#0c0c12;--ink3:#121218;--ink4:#1c1c24;--gold:#D4A843;--text:#f2f2f2;--sub:#888;}
+        body{background:var(--ink);color:var(--text);font-family:'Inter',sans-serif;min-height:100vh;}
+        .header{background:var(--ink2);border-bottom:1px solid var(--ink4);padding:20px 5%;display:flex;align-items:center;justify-content:space-between;gap:12px;flex-wrap:wrap;}
+        .brand{font-family:'Bebas Neue',sans-serif;font-size:20px;letter-spacing:5px;color:var(--gold);}
+        .back{font-size:11px;letter-spacing:2px;text-transform:uppercase;color:var(--sub);text-decoration:none;transition:color .2s;}
+        .back:hover{color:var(--gold);}
+        .hero{padding:40px 5% 28px;border-bottom:1px solid var(--ink3);display:flex;align-items:flex-start;justify-content:space-between;flex-wrap:wrap;gap:20px;}
+        .hero-eyebrow{font-size:10px;letter-spacing:4px;text-transform:uppercase;color:var(--gold);margin-bottom:8px;display:flex;align-items:center;gap:10px;}
+        .hero-eyebrow::before{content:'';width:20px;height:1px;background:var(--gold);display:block;}
+        .hero-title{font-family:'Bebas Neue',sans-serif;font-size:clamp(28px,5vw,46px);letter-spacing:3px;color:var(--text);margin-bottom:8px;}
+        .hero-sub{font-size:13px;color:var(--sub);line-height:1.7;max-width:420px;}
+        .hero-stats{display:flex;gap:28px;flex-shrink:0;}
+        .stat{text-align:center;}
+        .stat-n{font-family:'Bebas Neue',sans-serif;font-size:36px;color:var(--gold);line-height:1;display:block;}
+        .stat-l{font-size:9px;letter-spacing:2px;text-transform:uppercase;color:#555;display:block;margin-top:3px;}
+        .toolbar{padding:14px 5%;background:var(--ink2);border-bottom:1px solid var(--ink4);display:flex;align-items:center;justify-content:space-between;flex-wrap:wrap;gap:10px;}
+        .toolbar-info{font-size:12px;color:var(--sub);}
+        .btn-all{display:inline-flex;align-items:center;gap:8px;padding:10px 22px;background:var(--gold);color:#000;font-size:11px;font-weight:700;letter-spacing:2px;text-transform:uppercase;text-decoration:none;cursor:pointer;border:none;font-family:'Inter',sans-serif;transition:background .2s;}
+        .btn-all:hover{background:#e8bf6a;}
+        .grid{display:grid;grid-template-columns:repeat(auto-fill,minmax(280px,1fr));gap:3px;padding:3px 5%;}
+        .foto-card{background:var(--ink3);overflow:hidden;}
+        .foto-img-wrap{position:relative;aspect-ratio:4/3;overflow:hidden;}
+        .foto-img-wrap img{width:100%;height:100%;object-fit:cover;transition:transform .5s,filter .3s;filter:brightness(.88);display:block;}
+        .foto-card:hover .foto-img-wrap img{transform:scale(1.04);filter:brightness(.6);}
+        .foto-overlay{position:absolute;inset:0;display:flex;align-items:center;justify-content:center;opacity:0;transition:opacity .3s;}
+        .foto-card:hover .foto-overlay{opacity:1;}
+        .btn-dl{display:inline-flex;align-items:center;gap:6px;padding:12px 22px;background:var(--gold);color:#000;font-size:11px;font-weight:700;letter-spacing:2px;text-transform:uppercase;text-decoration:none;transform:translateY(6px);transition:transform .3s,background .2s;}
+        .foto-card:hover .btn-dl{transform:translateY(0);}
+        .btn-dl:hover{background:#e8bf6a;}
+        .foto-info{padding:10px 14px;display:flex;align-items:center;justify-content:space-between;gap:8px;border-top:1px solid var(--ink4);}
+        .foto-info span{font-size:11px;color:var(--sub);overflow:hidden;text-overflow:ellipsis;white-space:nowrap;}
+        .btn-dl-sm{font-size:11px;color:var(--gold);text-decoration:none;white-space:nowrap;flex-shrink:0;transition:opacity .2s;}
+        .btn-dl-sm:hover{opacity:.8;}
+        .mas{display:block;margin:24px auto 0;padding:12px 28px;background:transparent;color:var(--gold);border:1px solid var(--gold);font-size:11px;font-weight:700;letter-spacing:2px;text-transform:uppercase;cursor:pointer;font-family:'Inter',sans-serif;transition:background .2s,color .2s;}
+        .mas:hover{background:var(--gold);color:#000;}
+        footer{margin-top:48px;padding:32px 5%;border-top:1px solid var(--ink3);text-align:center;}
+        footer p{font-size:11px;color:#333;line-height:1.8;}
+        @media(max-width:600px){.hero-stats{display:none;}.grid{grid-template-columns:1fr 1fr;}.foto-overlay{display:none;}}
     </style>
 </head>
 <body>
@@ -1001,7 +2052,7 @@ def galeria_privada(token):
 <div class="hero">
     <div>
         <div class="hero-eyebrow">Tu galería privada</div>
-        <h1 class="hero-title">¡Hola, {nombre}!</h1>
+        <h1 class="hero-title">¡Hola, {{ nombre }}!</h1>
         <p class="hero-sub">
             Tus fotos están listas en alta resolución, sin marca de agua.<br>
             El link es permanente — podés volver cuando quieras.
@@ -1009,11 +2060,11 @@ def galeria_privada(token):
     </div>
     <div class="hero-stats">
         <div class="stat">
-            <span class="stat-n">{len(fotos)}</span>
-            <span class="stat-l">Foto{"s" if len(fotos)>1 else ""}</span>
+            <span class="stat-n">{{ total }}</span>
+            <span class="stat-l">Foto{{ "s" if total > 1 }}</span>
         </div>
         <div class="stat">
-            <span class="stat-n" style="font-size:22px">${compra.monto_total:,.0f}</span>
+            <span class="stat-n" style="font-size:22px">${{ monto }}</span>
             <span class="stat-l">ARS abonados</span>
         </div>
     </div>
@@ -1022,29 +2073,167 @@ def galeria_privada(token):
     <span class="toolbar-info">Pasá el mouse sobre la foto para descargarla · En celular usá el botón debajo</span>
     <button class="btn-all" onclick="descargarTodas()">↓ Descargar todas</button>
 </div>
-<div class="grid">{fotos_html}</div>
+<div class="grid">{% for f in fotos %}
+    <div class="foto-card">
+        <div class="foto-img-wrap">
+            <img src="{{ f.preview }}" alt="Foto" loading="lazy">
+            <div class="foto-overlay">
+                <a href="{{ f.dl }}" download target="_blank" class="btn-dl">↓ Descargar</a>
+            </div>
+        </div>
+        <div class="foto-info">
+            <span>{{ f.titulo }}</span>
+            <a href="{{ f.dl }}" download target="_blank" class="btn-dl-sm">↓ Alta resolución</a>
+        </div>
+    </div>{% endfor %}
+</div>
+{% if total > fotos|length %}<button class="mas" id="mas" onclick="cargarMas()">Ver más fotos</button>{% endif %}
 <footer>
     <p>© 2026 Nacho Lingua Fotografía · Córdoba, Argentina<br>
     Imágenes de uso personal · Prohibida su reproducción sin autorización.</p>
 </footer>
 <script>
-    const urls = {urls_json};
-    function descargarTodas() {{
+    const TOKEN = {{ token|tojson }};
+    const TOTAL = {{ total }};
+    const urls  = {{ urls|tojson }};
+    let pedido  = null;
+    function tarjeta(f) {
+        const card = document.createElement('div'); card.className = 'foto-card';
+        const wrap = document.createElement('div'); wrap.className = 'foto-img-wrap';
+        const img  = document.createElement('img'); img.src = f.preview; img.alt = 'Foto'; img.loading = 'lazy';
+        const ov   = document.createElement('div'); ov.className = 'foto-overlay';
+        const dl   = document.createElement('a');   dl.className = 'btn-dl'; dl.href = f.dl; dl.target = '_blank'; dl.download = ''; dl.textContent = '↓ Descargar';
+        ov.appendChild(dl); wrap.append(img, ov);
+        const info = document.createElement('div'); info.className = 'foto-info';
+        const tit  = document.createElement('span'); tit.textContent = f.titulo;
+        const sm   = document.createElement('a');    sm.className = 'btn-dl-sm'; sm.href = f.dl; sm.target = '_blank'; sm.download = ''; sm.textContent = '↓ Alta resolución';
+        info.append(tit, sm); card.append(wrap, info);
+        return card;
+    }
+    function cargarMas() {
+        if (urls.length >= TOTAL) return Promise.resolve();
+        if (pedido) return pedido;
+        pedido = fetch(`/galeria/${TOKEN}/fotos?desde=${urls.length}`)
+            .then(r => r.json())
+            .then(d => {
+                const grid = document.querySelector('.grid');
+                d.fotos.forEach(f => { grid.appendChild(tarjeta(f)); urls.push(f.dl); });
+                if (urls.length >= TOTAL || !d.fotos.length) document.getElementById('mas')?.remove();
+            })
+            .finally(() => { pedido = null; });
+        return pedido;
+    }
+    const mas = document.getElementById('mas');
+    if (mas && 'IntersectionObserver' in window) {
+        new IntersectionObserver(es => { if (es.some(e => e.isIntersecting)) cargarMas(); },
+                                 { rootMargin: '600px' }).observe(mas);
+    }
+    async function descargarTodas() {
         const btn = document.querySelector('.btn-all');
-        btn.disabled = true; btn.textContent = 'Descargando...';
+        btn.disabled = true; btn.textContent = 'Preparando...';
+        while (urls.length < TOTAL) {
+            const antes = urls.length;
+            await cargarMas();
+            if (urls.length === antes) break;
+        }
         let i = 0;
-        function next() {{
-            if (i >= urls.length) {{ btn.textContent = '✓ ¡Listas!'; setTimeout(() => {{ btn.textContent = '↓ Descargar todas'; btn.disabled = false; }}, 3000); return; }}
+        function next() {
+            if (i >= urls.length) { btn.textContent = '✓ ¡Listas!'; setTimeout(() => { btn.textContent = '↓ Descargar todas'; btn.disabled = false; }, 3000); return; }
             const a = document.createElement('a');
             a.href = urls[i]; a.download = 'nacho-lingua-foto-' + (i+1) + '.jpg'; a.target = '_blank';
             document.body.appendChild(a); a.click(); document.body.removeChild(a);
             btn.textContent = 'Descargando ' + (i+1) + ' de ' + urls.length + '...';
             i++; setTimeout(next, 800);
-        }}
+        }
         next();
-    }}
+    }
 </script>
 </body></html>'''
+_TPL_GALERIA = app.jinja_env.from_string(GALERIA_HTML)
+
+GALERIA_INVALIDA_HTML = """<!DOCTYPE html><html lang="es"><head><meta charset="UTF-8">
+        <title>Link inválido</title>
+        <style>
+            body{background:#06060A;color:#f2f2f2;font-family:sans-serif;
+            display:flex;align-items:center;justify-content:center;
+            min-height:100vh;text-align:center;}
+            h1{color:#D4A843;font-size:28px;margin-bottom:12px;}
+            p{color:#777;font-size:14px;line-height:1.7;}
+            a{color:#D4A843;}
+        </style></head>
+        <body><div>
+            <h1>Link inválido</h1>
+            <p>Este link no existe o el pago no fue confirmado.<br>
+            Si creés que es un error, respondé el email que recibiste.</p>
+            <p><a href="/">← Volver al portfolio</a></p>
+        </div></body></html>"""
+
+# ── Cache de galerías: por token, hasta que las URLs firmadas estén por vencer ─
+GALERIA_POR_PAGINA = 60
+GALERIA_CACHE_SEG  = 5 * 24 * 3600   # las firmas de Wasabi duran 6 días: se rehace 1 día antes
+GALERIA_CACHE_MAX  = 200
+_GALERIA_CACHE     = OrderedDict()
+_GALERIA_LOCK      = threading.Lock()
+
+def _datos_galeria(token):
+    """Fotos firmadas + HTML renderizado de una galería, cacheado por token.
+    Cada URL se firma UNA vez y los títulos vienen en la misma consulta (join).
+    La entrada vale mientras no cambie ninguna de sus fotos: se compara la mayor
+    foto.version y la cantidad (un re-watermark o un borrado la rehacen, así no
+    se sirven URLs que el GC ya encoló).
+    Devuelve None si el token no es de una compra aprobada."""
+    contenido = (db.select(db.func.concat(db.func.max(Foto.version), ':', db.func.count(Foto.id)))
+                 .join(CompraFoto, CompraFoto.foto_id == Foto.id)
+                 .where(CompraFoto.compra_id == Compra.id)
+                 .correlate(Compra).scalar_subquery())
+    compra = (db.session.query(Compra.id, Compra.nombre_cliente, Compra.monto_total, contenido)
+              .filter_by(token_galeria=token, estado='approved').first())
+    if not compra:
+        return None
+    ahora, version = _time.time(), compra[3]
+    with _GALERIA_LOCK:
+        datos = _GALERIA_CACHE.get(token)
+        if datos and datos['expira'] > ahora and datos['version'] == version:
+            _GALERIA_CACHE.move_to_end(token)
+            return datos
+
+    filas = (db.session.query(Foto.id, Foto.ref_preview, Foto.ref_original, Evento.titulo)
+             .join(CompraFoto, CompraFoto.foto_id == Foto.id)
+             .outerjoin(Evento, Evento.id == Foto.evento_id)
+             .filter(CompraFoto.compra_id == compra.id).order_by(Foto.id).all())
+    fotos = [{'id': fid, 'preview': url_de_ref(prev), 'dl': get_download_url(url_de_ref(orig)),
+              'titulo': titulo or 'Evento deportivo'} for fid, prev, orig, titulo in filas]
+    pagina = fotos[:GALERIA_POR_PAGINA]
+    html = _TPL_GALERIA.render(token=token, nombre=compra.nombre_cliente or 'Cliente',
+                               monto=f'{compra.monto_total or 0:,.0f}', total=len(fotos),
+                               fotos=pagina, urls=[f['dl'] for f in pagina])
+    datos = {'expira': ahora + GALERIA_CACHE_SEG, 'version': version, 'fotos': fotos, 'html': html,
+             'etag': hashlib.sha1(html.encode('utf-8')).hexdigest()}
+    with _GALERIA_LOCK:
+        _GALERIA_CACHE[token] = datos
+        while len(_GALERIA_CACHE) > GALERIA_CACHE_MAX:
+            _GALERIA_CACHE.popitem(last=False)
+    return datos
+
+@app.route('/galeria/<token>')
+def galeria_privada(token):
+    datos = _datos_galeria(token)
+    if not datos:
+        return GALERIA_INVALIDA_HTML, 404
+    resp = make_response(datos['html'])
+    resp.set_etag(datos['etag'])
+    resp.headers['Cache-Control'] = 'private, no-cache'   # el navegador revalida y recibe 304
+    return resp.make_conditional(request)
+
+@app.route('/galeria/<token>/fotos')
+def galeria_fotos(token):
+    """Siguiente tanda de fotos de la galería (scroll infinito / 'Descargar todas')."""
+    datos = _datos_galeria(token)
+    if not datos:
+        return jsonify({'error': 'Link inválido'}), 404
+    desde  = max(0, request.args.get('desde', 0, type=int))
+    limite = min(max(1, request.args.get('limite', GALERIA_POR_PAGINA, type=int)), 200)
+    return jsonify({'fotos': datos['fotos'][desde:desde + limite], 'total': len(datos['fotos'])})
 
 
 # ── CATEGORÍAS ────────────────────────────────────────────────────────────────
@@ -1132,8 +2321,7 @@ def serializar_evento(e):
         'parent_id':        e.parent_id,
         'total_fotos':      len(e.fotos),
         'total_subcarpetas': len(e.subcarpetas),
-        'fotos': [{'id': f.id, 'url_preview': f.url_preview,
-                   'url_original': f.url_original, 'precio': f.precio}
+        'fotos': [{'id': f.id, 'url_preview': f.url_preview, 'precio': f.precio}
                   for f in e.fotos],
         'subcarpetas': [serializar_evento(s) for s in
                         sorted(e.subcarpetas, key=lambda x: x.id)]
@@ -1149,10 +2337,12 @@ def crear_evento():
         deporte = padre.deporte if padre else d.get('deporte', '')
     else:
         deporte = d.get('deporte', '')
-    ev = Evento(titulo=d.get('titulo',''), deporte=deporte,
-                fecha=d.get('fecha',''), descripcion=d.get('descripcion',''),
+    ev = Evento(titulo=d.get('titulo',''), descripcion=d.get('descripcion',''),
                 usar_portada=bool(d.get('usar_portada', True)),
                 parent_id=parent_id)
+    ev.set_deporte(deporte)
+    ev.set_fecha(d.get('fecha',''))
+    ev.version = sellar_catalogo()
     db.session.add(ev); db.session.commit()
     return jsonify({'id': ev.id, 'mensaje': 'Carpeta creada'})
 
@@ -1161,20 +2351,242 @@ def obtener_eventos():
     # Solo raíces (sin padre) — las subcarpetas van anidadas dentro
     datos = _cache_get('eventos')
     if datos is None:
-        raices = Evento.query.filter_by(parent_id=None).order_by(Evento.id.desc()).all()
-        datos  = _cache_set('eventos', [serializar_evento(e) for e in raices])
+        # La versión se lee antes que el árbol: lo que cambie mientras tanto vuelve
+        # a venir en /catalogo/cambios, nunca se pierde
+        version = version_catalogo_actual()
+        raices  = Evento.query.filter_by(parent_id=None).order_by(Evento.id.desc()).all()
+        datos   = _cache_set('eventos', {'version': version,
+                                         'eventos': [serializar_evento(e) for e in raices]})
+    resp = jsonify(datos['eventos'])
+    resp.headers['X-Catalogo-Version'] = str(datos['version'])
+    return resp
+
+EVENTOS_POR_PAGINA = 24
+_ORDEN_EVENTOS = {
+    'fecha':     (Evento.fecha_dia.desc().nulls_last(), Evento.id.desc()),
+    'fecha_asc': (Evento.fecha_dia.asc().nulls_last(), Evento.id.asc()),
+    'titulo':    (Evento.titulo.asc(), Evento.id.asc()),
+    'recientes': (Evento.id.desc(),),
+}
+
+def _filtros_eventos(args, sin=()):
+    """Criterios del listado. `sin` deja afuera una faceta: el conteo de cada
+    faceta se hace con todos los demás filtros aplicados."""
+    crit = []
+    if args.get('padre'):
+        crit.append(Evento.parent_id == args.get('padre', type=int))
+    elif not args.get('todos'):
+        crit.append(Evento.parent_id.is_(None))
+    if args.get('deporte') and 'deporte' not in sin:
+        crit.append(Evento.deporte_slug == Categoria.slug_from(args['deporte']))
+    if 'mes' not in sin:
+        if args.get('mes'):                                   # AAAA-MM
+            ini = datetime.strptime(args['mes'], '%Y-%m').date()
+            fin = (ini + timedelta(days=32)).replace(day=1)
+            crit += [Evento.fecha_dia >= ini, Evento.fecha_dia < fin]
+        if args.get('desde'):
+            crit.append(Evento.fecha_dia >= datetime.strptime(args['desde'], '%Y-%m-%d').date())
+        if args.get('hasta'):
+            crit.append(Evento.fecha_dia <= datetime.strptime(args['hasta'], '%Y-%m-%d').date())
+    q = args.get('q', '').strip()
+    if q:
+        patron = '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        crit.append(Evento.titulo.ilike(patron))
+    return crit
+
+def _subconsultas_evento():
+    """Cantidad de fotos y ref de la portada de cada evento, como subconsultas
+    correlacionadas (índice foto.evento_id) en vez de cargar sus fotos."""
+    n_fotos = (db.select(db.func.count(Foto.id)).where(Foto.evento_id == Evento.id)
+               .correlate(Evento).scalar_subquery())
+    primera = (db.select(db.func.min(Foto.id)).where(Foto.evento_id == Evento.id)
+               .correlate(Evento).scalar_subquery())
+    portada = (db.select(db.func.coalesce(Foto.ref_cover, Foto.ref_preview))
+               .where(Foto.id == db.func.coalesce(Evento.cover_foto_id, primera))
+               .correlate(Evento).scalar_subquery())
+    return n_fotos, portada
+
+@app.route('/eventos', methods=['GET'])
+def listar_eventos():
+    """Listado plano de eventos, filtrado y paginado en la base, con facetas.
+    Filtros: ?deporte=<slug o nombre>, ?mes=AAAA-MM, ?desde=&hasta= (AAAA-MM-DD),
+    ?q= (título). Por defecto solo raíces; ?padre=<id> lista sus subcarpetas y
+    ?todos=1 todos los niveles. ?orden=fecha|fecha_asc|titulo|recientes,
+    ?pagina=&por_pagina=. Las facetas (deporte y mes) cuentan con el resto de
+    los filtros aplicados."""
+    args = request.args
+    try:
+        crit = _filtros_eventos(args)
+    except ValueError:
+        return jsonify({'error': 'Fecha inválida (AAAA-MM-DD o AAAA-MM)'}), 400
+    pagina     = max(args.get('pagina', 1, type=int), 1)
+    por_pagina = min(max(args.get('por_pagina', EVENTOS_POR_PAGINA, type=int), 1), 100)
+    orden      = args.get('orden', 'fecha') if args.get('orden') in _ORDEN_EVENTOS else 'fecha'
+    # La clave sale de los filtros ya interpretados, no del query string: el
+    # orden de los parámetros, los desconocidos o '?deporte=Fútbol' vs
+    # '?deporte=futbol' no abren entradas nuevas.
+    fechas = [datetime.strptime(args[k], fmt).date().isoformat() if args.get(k) else None
+              for k, fmt in (('mes', '%Y-%m'), ('desde', '%Y-%m-%d'), ('hasta', '%Y-%m-%d'))]
+    clave  = 'eventos:' + json.dumps([
+        args.get('padre', type=int), bool(args.get('todos')) and not args.get('padre'),
+        Categoria.slug_from(args.get('deporte', '')), *fechas, args.get('q', '').strip().lower(),
+        pagina, por_pagina, orden])
+    datos = _cache_get(clave)
+    if datos is not None:
+        return jsonify(datos)
+    orden = _ORDEN_EVENTOS[orden]
+
+    n_fotos, portada = _subconsultas_evento()
+    total = db.session.query(db.func.count(Evento.id)).filter(*crit).scalar()
+    filas = (db.session.query(Evento, n_fotos, portada).filter(*crit).order_by(*orden)
+             .offset((pagina - 1) * por_pagina).limit(por_pagina).all())
+
+    por_deporte = (db.session.query(Evento.deporte_slug, db.func.min(Evento.deporte), db.func.count(Evento.id))
+                   .filter(*_filtros_eventos(args, sin=('deporte',)))
+                   .group_by(Evento.deporte_slug).order_by(db.func.count(Evento.id).desc()).all())
+    mes = db.func.to_char(Evento.fecha_dia, 'YYYY-MM')
+    por_mes = (db.session.query(mes, db.func.count(Evento.id))
+               .filter(*_filtros_eventos(args, sin=('mes',)), Evento.fecha_dia.isnot(None))
+               .group_by(mes).order_by(mes.desc()).all())
+
+    datos = _cache_set(clave, {
+        'eventos': [{
+            'id':           e.id,
+            'titulo':       e.titulo,
+            'deporte':      e.deporte,
+            'fecha':        e.fecha,
+            'fecha_dia':    e.fecha_dia.isoformat() if e.fecha_dia else None,
+            'descripcion':  e.descripcion,
+            'parent_id':    e.parent_id,
+            'cover_url':    url_de_ref(cover) if e.usar_portada is not False else None,
+            'total_fotos':  n,
+        } for e, n, cover in filas],
+        'total':      total,
+        'pagina':     pagina,
+        'por_pagina': por_pagina,
+        'facetas': {
+            'deporte': [{'slug': slug, 'nombre': nombre, 'eventos': n} for slug, nombre, n in por_deporte if slug],
+            'mes':     [{'mes': m, 'eventos': n} for m, n in por_mes],
+        },
+    })
     return jsonify(datos)
 
+# ── CAMBIOS DEL CATÁLOGO (sincronización incremental) ─────────────────────────
+# Eventos, fotos y config guardan la versión del catálogo en que cambiaron por
+# última vez, y los borrados quedan en evento_baja / foto_baja. Quien ya tiene el
+# catálogo en la versión N (header X-Catalogo-Version de /obtener-eventos) pide
+# /catalogo/cambios?desde=N y recibe solo lo que cambió después. Si es mucho,
+# contesta completo=true y el cliente vuelve a pedir /obtener-eventos.
+CAMBIOS_MAX_FOTOS      = 5000
+CAMBIOS_RETENCION_DIAS = int(os.environ.get('CAMBIOS_RETENCION_DIAS', 30))
+
+def podar_bajas_catalogo():
+    """Borra las bajas de más de CAMBIOS_RETENCION_DIAS. Se poda por versión (todo
+    lo <= la mayor baja vencida) y se anota en version_catalogo.podada_hasta: un
+    cliente con una versión anterior recibe completo=true. Devuelve cuántas borró."""
+    limite = db.func.now() - timedelta(days=CAMBIOS_RETENCION_DIAS)
+    v = max(db.session.query(db.func.max(FotoBaja.version)).filter(FotoBaja.creada_en < limite).scalar() or 0,
+            db.session.query(db.func.max(EventoBaja.version)).filter(EventoBaja.creada_en < limite).scalar() or 0)
+    if not v:
+        return 0
+    # Primero la marca (bloquea la fila como sellar_catalogo), después el borrado
+    VersionCatalogo.query.filter(VersionCatalogo.id == 1, VersionCatalogo.podada_hasta < v) \
+                         .update({'podada_hasta': v}, synchronize_session=False)
+    n = (FotoBaja.query.filter(FotoBaja.version <= v).delete(synchronize_session=False)
+         + EventoBaja.query.filter(EventoBaja.version <= v).delete(synchronize_session=False))
+    db.session.commit()
+    return n
+
+@app.route('/catalogo/cambios', methods=['GET'])
+def cambios_catalogo():
+    """Altas/cambios y bajas desde ?desde=<versión>. Los eventos vienen sin fotos
+    ni subcarpetas (los mismos campos que /obtener-eventos más su regla de
+    precios); las fotos, con su evento_id. Un evento aparece si cambió él, alguna
+    de sus fotos o alguna subcarpeta (portada y cantidades)."""
+    desde   = request.args.get('desde', type=int)
+    version, podada = (db.session.query(VersionCatalogo.version, VersionCatalogo.podada_hasta)
+                       .filter_by(id=1).first() or (0, 0))
+    if desde is None or desde <= 0 or desde > version or desde < podada:
+        return jsonify({'version': version, 'completo': True})
+    clave = f'cambios:{desde}'
+    datos = _cache_get(clave)
+    if datos is not None and datos['version'] == version:
+        return jsonify(datos)
+    datos = {'version': version, 'desde': desde, 'eventos': [], 'eventos_borrados': [],
+             'fotos': [], 'fotos_borradas': []}
+    if desde == version:
+        return jsonify(_cache_set(clave, datos))
+
+    fotos = (db.session.query(Foto.id, Foto.evento_id, Foto.ref_preview, Foto.precio)
+             .filter(Foto.version > desde, Foto.evento_id.isnot(None)).order_by(Foto.id).limit(CAMBIOS_MAX_FOTOS + 1).all())
+    bajas = (db.session.query(FotoBaja.foto_id, FotoBaja.evento_id)
+             .filter(FotoBaja.version > desde).limit(CAMBIOS_MAX_FOTOS + 1).all())
+    if len(fotos) > CAMBIOS_MAX_FOTOS or len(bajas) > CAMBIOS_MAX_FOTOS:
+        return jsonify(_cache_set(clave, {'version': version, 'completo': True}))
+    ev_bajas = [i for (i,) in db.session.query(EventoBaja.evento_id).filter(EventoBaja.version > desde)]
+
+    tocados = {i for (i,) in db.session.query(Evento.id).filter(Evento.version > desde)}
+    tocados |= {f.evento_id for f in fotos} | {eid for _, eid in bajas if eid}
+    tocados |= {pid for (pid,) in db.session.query(Evento.parent_id)
+                .filter(Evento.id.in_(tocados), Evento.parent_id.isnot(None))}
+    if tocados:
+        n_fotos, portada = _subconsultas_evento()
+        hija   = db.aliased(Evento)
+        n_subs = (db.select(db.func.count(hija.id)).where(hija.parent_id == Evento.id)
+                  .correlate(Evento).scalar_subquery())
+        filas  = (db.session.query(Evento, n_fotos, n_subs, portada)
+                  .filter(Evento.id.in_(tocados)).order_by(Evento.id).all())
+        # Sin fotos propias, la portada es la primera foto de la primera subcarpeta
+        # que tenga (como serializar_evento)
+        sin_portada = [e.id for e, n, ns, cover in filas if not cover and ns]
+        de_hijas = dict(db.session.query(hija.parent_id, db.func.coalesce(Foto.ref_cover, Foto.ref_preview))
+                        .join(Foto, Foto.evento_id == hija.id)
+                        .filter(hija.parent_id.in_(sin_portada))
+                        .distinct(hija.parent_id).order_by(hija.parent_id, hija.id, Foto.id).all()) \
+                   if sin_portada else {}
+        datos['eventos'] = [{
+            'id':                e.id,
+            'titulo':            e.titulo,
+            'deporte':           e.deporte,
+            'fecha':             e.fecha,
+            'descripcion':       e.descripcion,
+            'cover_foto_id':     e.cover_foto_id,
+            'usar_portada':      e.usar_portada is not False,
+            'cover_url':         url_de_ref(cover or de_hijas.get(e.id)) if e.usar_portada is not False else None,
+            'parent_id':         e.parent_id,
+            'total_fotos':       n,
+            'total_subcarpetas': ns,
+            'regla':             json.loads(e.precios_json) if e.precios_json else None,
+        } for e, n, ns, cover in filas]
+    datos['eventos_borrados'] = ev_bajas
+    datos['fotos'] = [{'id': fid, 'evento_id': eid, 'url_preview': url_de_ref(ref), 'precio': precio}
+                      for fid, eid, ref, precio in fotos]
+    datos['fotos_borradas'] = [fid for fid, _ in bajas]
+
+    cfg = get_config()
+    if cfg.version > desde:
+        datos['config'] = {
+            'escala_volumen':        json.loads(cfg.escala_volumen),
+            'pack_digital_precio':   cfg.pack_digital_precio,
+            'pack_digital_activo':   cfg.pack_digital_activo,
+            'pack_impresion_precio': cfg.pack_impresion_precio,
+            'pack_impresion_activo': cfg.pack_impresion_activo,
+            'upsell_trigger_qty':    cfg.upsell_trigger_qty,
+            'precios_global':        json.loads(cfg.precios_json) if cfg.precios_json else None,
+        }
+    return jsonify(_cache_set(clave, datos))
+
 @app.route('/editar-evento/<int:ev_id>', methods=['PATCH'])
 def editar_evento(ev_id):
     if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
     ev = Evento.query.get_or_404(ev_id)
     d  = request.json
     if 'titulo'      in d: ev.titulo      = d['titulo']
-    if 'deporte'     in d: ev.deporte     = d['deporte']
-    if 'fecha'       in d: ev.fecha       = d['fecha']
+    if 'deporte'     in d: ev.set_deporte(d['deporte'])
+    if 'fecha'       in d: ev.set_fecha(d['fecha'])
     if 'descripcion' in d: ev.descripcion = d['descripcion']
     if 'usar_portada' in d: ev.usar_portada = bool(d['usar_portada'])
+    ev.version = sellar_catalogo()
     db.session.commit()
     return jsonify({'ok': True})
 
@@ -1194,10 +2606,13 @@ def set_portada(ev_id):
         ev.cover_foto_id = foto_id
     else:
         ev.cover_foto_id = None   # resetear a automático
+    ev.version = sellar_catalogo()
     db.session.commit()
-    # Devolver la URL original (sin watermark) de la nueva portada
+    # Devolver la portada limpia (sin watermark, baja res) como en serializar_evento;
+    # el original no se expone
     cover_foto = Foto.query.get(ev.cover_foto_id) if ev.cover_foto_id else (ev.fotos[0] if ev.fotos else None)
-    return jsonify({'ok': True, 'cover_url': cover_foto.url_original if cover_foto else None})
+    return jsonify({'ok': True,
+                    'cover_url': (cover_foto.url_cover or cover_foto.url_preview) if cover_foto else None})
 
 
 @app.route('/evento/<int:ev_id>/subcarpeta', methods=['POST'])
@@ -1207,12 +2622,13 @@ def crear_subcarpeta(ev_id):
     d     = request.json
     sub   = Evento(
         titulo    = d.get('titulo', ''),
-        deporte   = padre.deporte,
-        fecha     = d.get('fecha', ''),
         descripcion = d.get('descripcion', ''),
         usar_portada = bool(d.get('usar_portada', True)),
         parent_id = ev_id
     )
+    sub.set_deporte(padre.deporte)
+    sub.set_fecha(d.get('fecha', ''))
+    sub.version = sellar_catalogo()
     db.session.add(sub); db.session.commit()
     return jsonify({'id': sub.id, 'mensaje': 'Subcarpeta creada'})
 
@@ -1225,17 +2641,76 @@ def set_precio_foto(foto_id):
     nuevo_precio = data.get('precio')
     if nuevo_precio is None or float(nuevo_precio) < 0:
         return jsonify({'error': 'Precio inválido'}), 400
-    foto.precio = float(nuevo_precio)
+    foto.precio  = float(nuevo_precio)
+    foto.version = sellar_catalogo()
     db.session.commit()
     return jsonify({'ok': True, 'precio': foto.precio})
 
+def ids_subarbol(ev_id):
+    """Ids del evento y de todas sus subcarpetas (CTE recursiva, una sola consulta)."""
+    arbol = db.session.query(Evento.id).filter(Evento.id == ev_id).cte('arbol', recursive=True)
+    arbol = arbol.union_all(db.session.query(Evento.id).filter(Evento.parent_id == arbol.c.id))
+    return [i for (i,) in db.session.query(arbol.c.id).all()]
+
+def _foto_vendida():
+    """EXISTS correlacionado: la foto está en alguna compra aprobada."""
+    return (db.select(CompraFoto.foto_id).join(Compra, Compra.id == CompraFoto.compra_id)
+            .where(CompraFoto.foto_id == Foto.id, Compra.estado == 'approved')
+            .correlate(Foto).exists())
+
+def borrar_fotos_donde(criterio):
+    """Borra en bloque las fotos que cumplen `criterio` (con sus etiquetas) y encola
+    sus objetos de storage para el GC, todo en la misma transacción. No hace commit.
+    Una foto vendida (compra aprobada) no se borra: se retira del catálogo (sin
+    evento, con retirada_en) y conserva la preview y el original, así la galería y
+    los mails de sus compras la siguen mostrando y descargando.
+    Devuelve (fotos borradas o retiradas, objetos encolados)."""
+    ids_fotos = db.select(Foto.id).where(criterio)
+    filas = (db.session.query(Foto.id, Foto.ref_preview, Foto.ref_original, Foto.ref_cover,
+                              Foto.key_ia, _foto_vendida())
+             .filter(criterio).all())
+    retenidas = [fid for fid, *_, vendida in filas if vendida]
+    urls = [(None if vendida else url_de_ref(p), None if vendida else url_de_ref(o), url_de_ref(c),
+             url_publica_wasabi(k) if k else None)
+            for _, p, o, c, k, vendida in filas]
+    objetos = encolar_borrado_storage(urls)
+    # Bajas para los índices en memoria de cada worker (también sella eventos borrados)
+    v = sellar_catalogo()
+    db.session.execute(pg_insert(FotoBaja.__table__)
+                       .from_select(['foto_id', 'version', 'evento_id'],
+                                    db.select(Foto.id, db.literal(v), Foto.evento_id).where(criterio))
+                       .on_conflict_do_update(index_elements=['foto_id'], set_={'version': v}))
+    FotoEtiqueta.query.filter(FotoEtiqueta.foto_id.in_(ids_fotos)).delete(synchronize_session=False)
+    Evento.query.filter(Evento.cover_foto_id.in_(ids_fotos)) \
+                .update({'cover_foto_id': None}, synchronize_session=False)
+    if retenidas:
+        IndiceJugador.query.filter(IndiceJugador.foto_id.in_(retenidas)).delete(synchronize_session=False)
+        Foto.query.filter(Foto.id.in_(retenidas)).update(
+            {'evento_id': None, 'retirada_en': db.func.now(), 'ref_cover': None, 'key_ia': None},
+            synchronize_session=False)
+    Foto.query.filter(criterio, Foto.id.notin_(retenidas)).delete(synchronize_session=False)
+    return len(filas), objetos
+
 @app.route('/borrar-evento/<int:ev_id>', methods=['DELETE'])
 def borrar_evento(ev_id):
     if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
-    ev = Evento.query.get(ev_id)
-    if not ev: return jsonify({'error': 'No encontrado'}), 404
-    db.session.delete(ev); db.session.commit()
-    return jsonify({'ok': True})
+    ev = db.session.query(Evento.id, Evento.parent_id).filter_by(id=ev_id).first()
+    if not ev:
+        return jsonify({'error': 'No encontrado'}), 404
+    # DELETE por conjunto (sin cargar el árbol en el ORM); el storage lo limpia el GC
+    ids = ids_subarbol(ev_id)
+    n_fotos, n_objetos = borrar_fotos_donde(Foto.evento_id.in_(ids))
+    JugadorRoster.query.filter(JugadorRoster.evento_id.in_(ids)).delete(synchronize_session=False)
+    # Bajas para /catalogo/cambios; el padre cambia de cantidad de subcarpetas
+    v = sellar_catalogo()
+    db.session.execute(pg_insert(EventoBaja.__table__)
+                       .values([{'evento_id': i, 'version': v} for i in ids])
+                       .on_conflict_do_update(index_elements=['evento_id'], set_={'version': v}))
+    if ev.parent_id:
+        Evento.query.filter_by(id=ev.parent_id).update({'version': v}, synchronize_session=False)
+    Evento.query.filter(Evento.id.in_(ids)).delete(synchronize_session=False)
+    db.session.commit()
+    return jsonify({'ok': True, 'eventos': len(ids), 'fotos': n_fotos, 'objetos_a_borrar': n_objetos})
 
 # ── FOTOS ─────────────────────────────────────────────────────────────────────
 @app.route('/subir-foto', methods=['POST'])
@@ -1273,7 +2748,8 @@ def subir_foto():
     key_orig     = f"nacho_lingua/originales/evento_{evento_id}/{filename}"
     url_original = f"wasabi_pending:{key_orig}"  # placeholder hasta que suba
 
-    foto = Foto(url_preview=url_preview, url_original=url_original, precio=precio, evento_id=evento_id)
+    foto = Foto(url_preview=url_preview, url_original=url_original, precio=precio, evento_id=evento_id,
+                version=sellar_catalogo())
     db.session.add(foto); db.session.commit()
     foto_id_guardado = foto.id
 
@@ -1283,9 +2759,15 @@ def subir_foto():
             try:
                 url = subir_a_wasabi(ruta, key)
                 if url:
+                    # La copia para la IA solo si el original quedó arriba: si no,
+                    # sería un objeto huérfano que ninguna foto referencia.
+                    with open(ruta, 'rb') as fh:
+                        key_ia = _generar_derivada_ia(fh.read(), f"{PREFIJO_IA}evento_{evento_id}/{filename}")
                     f = Foto.query.get(foto_id)
                     if f:
                         f.url_original = url
+                        f.key_ia       = key_ia
+                        f.version      = sellar_catalogo()
                         db.session.commit()
                         print(f'✓ Wasabi background OK: foto {foto_id}')
                 else:
@@ -1310,19 +2792,25 @@ def subir_foto():
 def editar_precio(foto_id):
     if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
     foto = Foto.query.get_or_404(foto_id)
-    foto.precio = float(request.json.get('precio', foto.precio))
+    foto.precio  = float(request.json.get('precio', foto.precio))
+    foto.version = sellar_catalogo()
     db.session.commit()
     return jsonify({'ok': True, 'precio': foto.precio})
 
 @app.route('/borrar-foto/<int:foto_id>', methods=['DELETE'])
 def borrar_foto(foto_id):
     if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
-    foto = Foto.query.get(foto_id)
-    if not foto: return jsonify({'error': 'No encontrada'}), 404
-    db.session.delete(foto); db.session.commit()
-    return jsonify({'ok': True})
+    n, n_objetos = borrar_fotos_donde(Foto.id == foto_id)
+    if not n:
+        db.session.rollback()
+        return jsonify({'error': 'No encontrada'}), 404
+    db.session.commit()
+    return jsonify({'ok': True, 'objetos_a_borrar': n_objetos})
 
 # ── COMPRAS Y LÓGICA DE PRECIOS POR VOLUMEN ───────────────────────────────────
+ORDEN_REUSO_SEG = int(os.environ.get('ORDEN_REUSO_SEG', 30 * 60))   # ventana para reusar un carrito idéntico
+PREFERENCIA_RECLAMO_SEG = 60    # una preferencia pedida hace más que esto se da por perdida
+PREFERENCIA_ESPERA_SEG  = 5     # cuánto espera el link el pedido que llegó segundo
 @app.route('/crear-orden', methods=['POST'])
 def crear_orden():
     d        = request.json
@@ -1331,7 +2819,11 @@ def crear_orden():
     nombre   = d.get('nombre', '').strip()
     if not foto_ids or not email: return jsonify({'error': 'Datos incompletos'}), 400
 
-    fotos = Foto.query.filter(Foto.id.in_(foto_ids)).all()
+    pedidas = foto_ids if isinstance(foto_ids, list) else []
+    idx     = indice_fotos()
+    fotos   = idx.existentes(pedidas)
+    if len(fotos) < len(pedidas) and idx.completar(pedidas):
+        fotos = idx.existentes(pedidas)     # alguna no estaba en el índice pero sí en la base
     if not fotos: return jsonify({'error': 'Fotos no encontradas'}), 404
 
     # Cálculo de precio centralizado (escala de volumen / packs) — parametrizable
@@ -1343,38 +2835,101 @@ def crear_orden():
         return jsonify({'error': 'Debés elegir exactamente 2 fotos para imprimir'}), 400
 
     cfg = get_config()
-    total, mp_items = calcular_total([f.id for f in fotos], tipo=tipo, cfg=cfg)
+    total, mp_items = calcular_total(fotos, tipo=tipo, cfg=cfg)
     base_url = request.host_url.rstrip('/')
 
     wa = normalizar_wa_ar(d.get('whatsapp', ''))
-    compra = Compra(
-        email_cliente    = email,
-        nombre_cliente   = nombre,
-        whatsapp_cliente = wa if wa else None,
-        foto_ids         = json.dumps([f.id for f in fotos]),
-        monto_total      = total,
-        tipo             = tipo,
-        fotos_impresion_ids = json.dumps(fotos_impresion) if fotos_impresion else None,
-        estado           = 'pendiente',
-        token_galeria    = generar_token()
-    )
-    db.session.add(compra); db.session.commit()
-
-    if not MP_HABILITADO: return jsonify({'error': 'mp_no_configurado', 'compra_id': compra.id, 'total': total}), 503
-
-    result = MP_SDK.preference().create({
-        'items': mp_items,
-        'payer': {'email': email, 'name': nombre},
-        'back_urls': {'success': f'{base_url}/pago-exitoso?cid={compra.id}', 'failure': f'{base_url}/pago-fallido?cid={compra.id}', 'pending': f'{base_url}/pago-exitoso?cid={compra.id}'},
-        'auto_return': 'approved',
-        'notification_url': f'{base_url}/mp-webhook',
-        'statement_descriptor': 'NACHO LINGUA',
-        'external_reference': str(compra.id)
-    })
+
+    # Idempotencia: doble click, reintento o volver atrás con el MISMO carrito
+    # reusan la compra pendiente y su preferencia en vez de crear otra y volver a
+    # llamar a MP (el paso más lento). Una sola compra pendiente por clave la
+    # garantiza el índice único parcial ux_compra_clave_idem: el pedido que pierde
+    # la carrera toma la fila del otro. La compra se confirma ANTES de llamar a
+    # MP, así durante esa ida y vuelta no se retiene ninguna conexión del pool.
+    clave = hashlib.sha256(json.dumps(
+        [email.lower(), nombre, wa, tipo, sorted(fotos),
+         sorted(fotos_impresion), total, request.headers.get('Idempotency-Key', '')],
+        default=str).encode()).hexdigest()
+    previa = (db.session.query(Compra.id, Compra.mp_init_point,
+                               Compra.creada_en > db.func.now() - timedelta(seconds=ORDEN_REUSO_SEG))
+              .filter(Compra.clave_idem == clave, Compra.estado == 'pendiente').first())
+    if previa and not previa[2]:
+        # fuera de la ventana de reuso: la vieja queda como está, sin la clave
+        Compra.query.filter_by(id=previa[0]).update({'clave_idem': None}, synchronize_session=False)
+        previa = None
+    if not previa:
+        compra_id = db.session.execute(
+            pg_insert(Compra.__table__).values(
+                email_cliente    = email,
+                nombre_cliente   = nombre,
+                whatsapp_cliente = wa if wa else None,
+                monto_total      = total,
+                tipo             = tipo,
+                fotos_impresion_ids = json.dumps(fotos_impresion) if fotos_impresion else None,
+                estado           = 'pendiente',
+                token_galeria    = generar_token(),
+                clave_idem       = clave)
+            .on_conflict_do_nothing(index_elements=['clave_idem'],
+                                    index_where=db.text("estado = 'pendiente'"))
+            .returning(Compra.id)).scalar()
+        if compra_id:
+            db.session.add_all([CompraFoto(compra_id=compra_id, foto_id=fid) for fid in fotos])
+        else:            # otro pedido con el mismo carrito la creó recién
+            previa = (db.session.query(Compra.id, Compra.mp_init_point, db.true())
+                      .filter(Compra.clave_idem == clave, Compra.estado == 'pendiente').first())
+    db.session.commit()
+    if previa:
+        compra_id = previa[0]
+        if previa[1]:
+            return jsonify({'init_point': previa[1], 'compra_id': compra_id, 'reusada': True})
+
+    if not MP_HABILITADO:
+        return jsonify({'error': 'mp_no_configurado', 'compra_id': compra_id, 'total': total}), 503
+
+    # Una sola ida a MP por compra: el pedido que marca preferencia_pedida_en la
+    # crea; el otro (doble click mientras MP contesta) espera el link un momento.
+    # Si MP falló la vez anterior, la marca se libera; si el pedido murió, vence.
+    reclamo = (Compra.query.filter(
+        Compra.id == compra_id, Compra.mp_init_point.is_(None),
+        db.or_(Compra.preferencia_pedida_en.is_(None),
+               Compra.preferencia_pedida_en < db.func.now() - timedelta(seconds=PREFERENCIA_RECLAMO_SEG)))
+        .update({'preferencia_pedida_en': db.func.now()}, synchronize_session=False))
+    db.session.commit()
+    if not reclamo:
+        limite = _time.monotonic() + PREFERENCIA_ESPERA_SEG
+        while _time.monotonic() < limite:
+            _time.sleep(0.2)
+            init_point = db.session.query(Compra.mp_init_point).filter_by(id=compra_id).scalar()
+            db.session.commit()
+            if init_point:
+                return jsonify({'init_point': init_point, 'compra_id': compra_id, 'reusada': True})
+        resp = jsonify({'error': 'orden_en_curso', 'compra_id': compra_id})
+        resp.headers['Retry-After'] = '1'
+        return resp, 409
+
+    try:
+        result = MP_SDK.preference().create({
+            'items': mp_items,
+            'payer': {'email': email, 'name': nombre},
+            'back_urls': {'success': f'{base_url}/pago-exitoso?cid={compra_id}', 'failure': f'{base_url}/pago-fallido?cid={compra_id}', 'pending': f'{base_url}/pago-exitoso?cid={compra_id}'},
+            'auto_return': 'approved',
+            'notification_url': f'{base_url}/mp-webhook',
+            'statement_descriptor': 'NACHO LINGUA',
+            'external_reference': str(compra_id)
+        })
+    except Exception as e:
+        print(f'[mp] preferencia de compra {compra_id}: {e}')
+        result = {'status': None}
 
     if result['status'] == 201:
-        compra.mp_preference_id = result['response']['id']; db.session.commit()
-        return jsonify({'init_point': result['response']['init_point'], 'compra_id': compra.id})
+        init_point = result['response']['init_point']
+        Compra.query.filter_by(id=compra_id).update(
+            {'mp_preference_id': result['response']['id'], 'mp_init_point': init_point},
+            synchronize_session=False)
+        db.session.commit()
+        return jsonify({'init_point': init_point, 'compra_id': compra_id})
+    Compra.query.filter_by(id=compra_id).update({'preferencia_pedida_en': None}, synchronize_session=False)
+    db.session.commit()
     return jsonify({'error': 'Error al crear preferencia MP'}), 500
 
 @app.route('/admin/precios', methods=['GET'])
@@ -1406,6 +2961,7 @@ def admin_precios_global():
         return jsonify({'error': err}), 400
     cfg = get_config()
     cfg.precios_json = json.dumps(regla) if regla else None
+    cfg.version = sellar_catalogo()
     db.session.commit()
     return jsonify({'ok': True})
 
@@ -1417,6 +2973,7 @@ def admin_precios_evento(eid):
     if regla is False:
         return jsonify({'error': err}), 400
     ev.precios_json = json.dumps(regla) if regla else None
+    ev.version = sellar_catalogo()
     db.session.commit()
     return jsonify({'ok': True})
 
@@ -1442,6 +2999,17 @@ def _verificar_firma_mp(req):
         return False
 
 
+# ── INBOX DEL WEBHOOK DE MP ───────────────────────────────────────────────────
+# El webhook sólo valida la firma, anota el payment id y responde: la consulta a
+# la API de MP la hace un procesador en segundo plano, por lotes. Una tormenta de
+# notificaciones después de un partido no retiene hilos de gunicorn.
+MP_INBOX_LOTE         = 20
+MP_INBOX_CONCURRENCIA = int(os.environ.get('MP_INBOX_CONCURRENCIA', 4))
+MP_INBOX_MAX_INTENTOS = 10
+MP_INBOX_TRABADA_SEG  = 300
+_MP_INBOX_DESPERTAR   = threading.Event()
+_MP_INBOX_POOL        = ThreadPoolExecutor(max_workers=MP_INBOX_CONCURRENCIA)
+
 @app.route('/mp-webhook', methods=['POST'])
 def mp_webhook():
     # Validación de firma (solo si configuraste MP_WEBHOOK_SECRET)
@@ -1449,37 +3017,133 @@ def mp_webhook():
         print('[mp-webhook] firma inválida, descarto la notificación')
         return jsonify({'status': 'invalid signature'}), 401
 
-    d = request.json or {}
-    if d.get('type') == 'payment' and MP_HABILITADO:
-        pid = d.get('data', {}).get('id')
-        if pid:
-            try:
-                r = MP_SDK.payment().get(pid)
-            except Exception as e:
-                print(f'[mp-webhook] error consultando pago {pid}: {e}')
-                return jsonify({'status': 'ok'}), 200
-            if r.get('status') == 200:
-                pay = r['response']
-                # Buscar la compra por external_reference (exacto) y, si no,
-                # caer a preference_id como respaldo.
-                ext    = pay.get('external_reference')
-                compra = None
-                if ext and str(ext).isdigit():
-                    compra = Compra.query.get(int(ext))
-                if not compra:
-                    compra = Compra.query.filter_by(
-                        mp_preference_id=pay.get('preference_id')).first()
-                if compra:
-                    compra.mp_payment_id = str(pid)
-                    compra.estado        = pay.get('status', 'desconocido')
-                    db.session.commit()
-                    if compra.estado == 'approved' and (
-                            not compra.email_enviado or not compra.wa_enviado):
-                        threading.Thread(target=entregar_compra,
-                                         args=(compra.id,), daemon=True).start()
+    d    = request.get_json(silent=True) or {}
+    tipo = d.get('type') or request.args.get('type') or request.args.get('topic')
+    pid  = str((d.get('data') or {}).get('id') or request.args.get('data.id') or '').strip()
+    if tipo == 'payment' and pid and MP_HABILITADO:
+        t = NotificacionMP.__table__
+        # Si el pago ya estaba anotado vuelve a 'pendiente': MP avisa de nuevo
+        # cuando cambia el estado (pending -> approved), y hay que re-consultarlo.
+        db.session.execute(
+            pg_insert(t).values(payment_id=pid[:50], estado='pendiente', veces=1, intentos=0)
+            .on_conflict_do_update(index_elements=['payment_id'], set_={
+                'estado':          'pendiente',
+                'veces':           t.c.veces + 1,
+                'intentos':        0,
+                'recibida_en':     db.func.now(),
+                'proximo_intento': db.func.now(),
+            }))
+        db.session.commit()
+        _MP_INBOX_DESPERTAR.set()
     return jsonify({'status': 'ok'}), 200
 
-@app.route('/pago-exitoso')
+def _consultar_pago_mp(pid):
+    """Corre en el pool: sólo la llamada HTTP, sin tocar la base. Devuelve (pago, error)."""
+    try:
+        r = MP_SDK.payment().get(pid)
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+    if r.get('status') != 200:
+        return None, f'MP respondió {r.get("status")}'
+    return r['response'], None
+
+def _aplicar_pago_mp(pid, pay):
+    """Actualiza la compra del pago (sin commit). La aprobación y su outbox de
+    entregas van en la misma transacción que marca la notificación procesada."""
+    # Buscar la compra por external_reference (exacto) y, si no,
+    # caer a preference_id como respaldo.
+    ext    = pay.get('external_reference')
+    compra = None
+    # FOR UPDATE: dos pagos de la misma compra no pueden sumar dos veces al rollup
+    if ext and str(ext).isdigit():
+        compra = Compra.query.filter_by(id=int(ext)).with_for_update().first()
+    if not compra:
+        compra = Compra.query.filter_by(
+            mp_preference_id=pay.get('preference_id')).with_for_update().first()
+    if not compra:   # webhook tardío de una compra ya archivada
+        compra = restaurar_compra_archivada(
+            int(ext) if ext and str(ext).isdigit() else None, pay.get('preference_id'))
+    if compra:
+        antes = compra.estado
+        compra.mp_payment_id = str(pid)
+        compra.estado        = pay.get('status', 'desconocido')
+        if compra.estado == 'approved':
+            encolar_entregas(compra)
+        if (antes == 'approved') != (compra.estado == 'approved'):
+            sumar_venta(compra, 1 if compra.estado == 'approved' else -1)
+    return compra
+
+def procesar_notificaciones_mp():
+    if not MP_HABILITADO:
+        return
+    NotificacionMP.query.filter(
+        NotificacionMP.estado == 'procesando',
+        NotificacionMP.tomada_en < db.func.now() - timedelta(seconds=MP_INBOX_TRABADA_SEG)) \
+        .update({'estado': 'pendiente'}, synchronize_session=False)
+    db.session.commit()
+    aprobadas = False
+    while True:
+        filas = (NotificacionMP.query
+                 .filter(NotificacionMP.estado == 'pendiente',
+                         NotificacionMP.proximo_intento <= db.func.now())
+                 .order_by(NotificacionMP.recibida_en).limit(MP_INBOX_LOTE)
+                 .with_for_update(skip_locked=True).all())
+        if not filas:
+            break
+        # Guardamos recibida_en: si llega otra notificación del mismo pago mientras
+        # lo consultamos, la fila no se marca procesada y se vuelve a consultar.
+        tomadas = {f.id: (f.payment_id, f.recibida_en) for f in filas}
+        for f in filas:
+            f.estado, f.tomada_en = 'procesando', db.func.now()
+        db.session.commit()
+
+        ids        = list(tomadas)
+        resultados = _MP_INBOX_POOL.map(_consultar_pago_mp, [tomadas[i][0] for i in ids])
+        for nid, (pay, error) in zip(ids, resultados):
+            pid, recibida = tomadas[nid]
+            q = NotificacionMP.query.filter(NotificacionMP.id == nid,
+                                            NotificacionMP.estado == 'procesando',
+                                            NotificacionMP.recibida_en == recibida)
+            try:
+                if pay is None:
+                    n = q.first()
+                    if n:
+                        n.intentos = (n.intentos or 0) + 1
+                        n.error    = error[:300]
+                        if n.intentos >= MP_INBOX_MAX_INTENTOS:
+                            n.estado = 'error'
+                        else:
+                            n.estado          = 'pendiente'
+                            n.proximo_intento = db.func.now() + timedelta(
+                                seconds=min(15 * 2 ** (n.intentos - 1), 1800))
+                        print(f'[mp-inbox] error consultando pago {pid}: {error}')
+                else:
+                    compra = _aplicar_pago_mp(pid, pay)
+                    q.update({'estado': 'procesada', 'estado_pago': pay.get('status'),
+                              'error': None if compra else 'sin compra asociada',
+                              'procesada_en': db.func.now()}, synchronize_session=False)
+                    aprobadas = aprobadas or bool(compra and compra.estado == 'approved')
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f'[mp-inbox] error aplicando pago {pid}: {e}')
+    if aprobadas:
+        despertar_entregas()
+
+@app.route('/admin/mp-inbox', methods=['GET'])
+def estado_mp_inbox():
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    conteo = dict(db.session.query(NotificacionMP.estado, db.func.count(NotificacionMP.id))
+                  .group_by(NotificacionMP.estado).all())
+    errores = (NotificacionMP.query.filter(NotificacionMP.estado == 'error')
+               .order_by(NotificacionMP.recibida_en.desc()).limit(20).all())
+    return jsonify({
+        'conteo':  conteo,
+        'errores': [{'payment_id': n.payment_id, 'intentos': n.intentos,
+                     'error': n.error} for n in errores],
+    })
+
+@app.route('/pago-exitoso')
 def pago_exitoso():
     # NO marcamos 'approved' ni entregamos acá: el cliente puede caer en esta
     # página con un pago PENDIENTE o sin haber pagado (probando la URL). La
@@ -1526,6 +3190,7 @@ def actualizar_config_precios():
     if 'pack_impresion_precio' in d: cfg.pack_impresion_precio = float(d['pack_impresion_precio'])
     if 'pack_impresion_activo' in d: cfg.pack_impresion_activo = bool(d['pack_impresion_activo'])
     if 'upsell_trigger_qty'    in d: cfg.upsell_trigger_qty    = int(d['upsell_trigger_qty'])
+    cfg.version = sellar_catalogo()
     db.session.commit()
     return jsonify({'ok': True})
 
@@ -1549,11 +3214,10 @@ def admin_re_watermark():
     if not session.get('admin'):
         return jsonify({'error': 'No autorizado'}), 403
 
-    import urllib.request
     data      = request.json or {}
     evento_id = data.get('evento_id')
 
-    query = Foto.query
+    query = Foto.query.filter(Foto.evento_id.isnot(None))   # las retiradas no están en el catálogo
     if evento_id:
         query = query.filter_by(evento_id=int(evento_id))
     fotos = query.all()
@@ -1582,8 +3246,7 @@ def admin_re_watermark():
         for src in candidatos:
             try:
                 dl_url = get_download_url(src)
-                with urllib.request.urlopen(dl_url, timeout=30) as resp:
-                    img_bytes = io.BytesIO(resp.read())
+                img_bytes = io.BytesIO(http_pedir('descarga', 'GET', dl_url, timeout=30).data)
                 img_marcada = agregar_watermark_5x(img_bytes)
                 import time as _t
                 wm_public_id = f'nacholingua/foto_{foto.id}_wm_{int(_t.time())}'
@@ -1592,6 +3255,10 @@ def admin_re_watermark():
                     overwrite=True, invalidate=True,
                 )
                 foto.url_preview = r_wm['secure_url']
+                foto.version     = sellar_catalogo()
+                # La preview vieja queda huérfana: al GC (salvo que sea el mismo objeto que el original)
+                if prev and _ref_storage(prev) != _ref_storage(orig):
+                    encolar_borrado_storage([(prev,)])
                 db.session.commit()
                 ok_count += 1
                 if src == prev:
@@ -1614,32 +3281,189 @@ def admin_re_watermark():
     })
 
 
+# ── ARCHIVO DE COMPRAS IMPAGAS ────────────────────────────────────────────────
+# Cada checkout abandonado deja una compra 'pendiente' para siempre. Pasados
+# COMPRA_RETENCION_DIAS se mueven por lotes a compra_archivada (con sus fotos),
+# así la tabla viva sólo crece con las ventas reales.
+COMPRA_RETENCION_DIAS = int(os.environ.get('COMPRA_RETENCION_DIAS', 30))
+COMPRA_ARCHIVO_LOTE   = 500
+ESTADOS_IMPAGOS       = ['pendiente', 'pending', 'rejected', 'cancelled']
+
+# Columnas que no viajan entre el vivo y el archivo: la clave del carrito (el
+# índice único la reserva para la compra pendiente ACTUAL de ese carrito) y la
+# marca de la preferencia en curso.
+COMPRA_COLUMNAS_EFIMERAS = ('clave_idem', 'preferencia_pedida_en')
+
+def _columnas_compra(prefijo='', nulas=()):
+    """Lista de columnas para INSERT/SELECT entre compra y compra_archivada, sacada
+    de `compra` (la tabla que manda); las de `nulas` van como NULL (solo para la
+    lista del SELECT). verificar_compra_archivada() garantiza que el archivo las tenga."""
+    return ', '.join('NULL' if c.name in nulas else prefijo + c.name
+                     for c in Compra.__table__.columns)
+
+def verificar_compra_archivada():
+    """Compara en la DB las columnas de compra y compra_archivada (nombre y tipo).
+    El archivo tiene que ser `compra` + archivada_en: una columna nueva en Compra
+    sin su ALTER en compra_archivada rompería el archivo en el primer lote.
+    Devuelve la lista de diferencias (vacía si coinciden)."""
+    filas = db.session.execute(_sqltext("""
+        SELECT table_name, column_name, data_type, character_maximum_length
+          FROM information_schema.columns
+         WHERE table_schema = current_schema() AND table_name IN ('compra', 'compra_archivada')""")).all()
+    vivo    = {c: (t, n) for tabla, c, t, n in filas if tabla == 'compra'}
+    archivo = {c: (t, n) for tabla, c, t, n in filas if tabla == 'compra_archivada' and c != 'archivada_en'}
+    return [f'{c}: compra={vivo.get(c)} compra_archivada={archivo.get(c)}'
+            for c in sorted(set(vivo) | set(archivo)) if vivo.get(c) != archivo.get(c)]
+
+def archivar_compras():
+    """Mueve a archivo las compras impagas viejas. Devuelve cuántas movió."""
+    cols, total = _columnas_compra(), 0
+    while True:
+        # Un lote por transacción; SKIP LOCKED: no pelea con un webhook que justo la toma
+        n = db.session.execute(_sqltext(f"""
+            WITH viejas AS (
+                SELECT c.id FROM compra c
+                 WHERE c.estado = ANY(:estados)
+                   AND c.creada_en < now() - make_interval(days => :dias)
+                   AND NOT EXISTS (SELECT 1 FROM entrega e WHERE e.compra_id = c.id)
+                 ORDER BY c.creada_en LIMIT :lote
+                 FOR UPDATE SKIP LOCKED),
+            fotos AS (
+                INSERT INTO compra_foto_archivada (compra_id, foto_id)
+                SELECT cf.compra_id, cf.foto_id FROM compra_foto cf JOIN viejas v ON v.id = cf.compra_id
+                ON CONFLICT DO NOTHING),
+            movidas AS (
+                DELETE FROM compra c USING viejas v WHERE c.id = v.id RETURNING {_columnas_compra('c.')})
+            INSERT INTO compra_archivada ({cols})
+            SELECT {_columnas_compra(nulas=COMPRA_COLUMNAS_EFIMERAS)} FROM movidas"""),
+            {'estados': ESTADOS_IMPAGOS, 'dias': COMPRA_RETENCION_DIAS,
+             'lote': COMPRA_ARCHIVO_LOTE}).rowcount
+        db.session.commit()
+        total += n
+        if n < COMPRA_ARCHIVO_LOTE:
+            return total
+
+def restaurar_compra_archivada(compra_id=None, preference_id=None):
+    """Devuelve al vivo (mismo id, mismas fotos) una compra archivada. Sin commit:
+    va en la transacción del webhook que la necesita. None si no está archivada."""
+    q = CompraArchivada.query
+    arch = (q.filter_by(id=compra_id).first() if compra_id else None) or \
+           (q.filter_by(mp_preference_id=preference_id).first() if preference_id else None)
+    if not arch:
+        return None
+    cols = _columnas_compra()
+    if not db.session.execute(_sqltext(f"""
+            WITH vuelve AS (DELETE FROM compra_archivada WHERE id = :id RETURNING {cols})
+            INSERT INTO compra ({cols})
+            SELECT {_columnas_compra(nulas=COMPRA_COLUMNAS_EFIMERAS)} FROM vuelve"""), {'id': arch.id}).rowcount:
+        return None   # otro hilo la restauró primero: ya está en el vivo
+    db.session.execute(_sqltext("""
+        WITH vuelve AS (DELETE FROM compra_foto_archivada WHERE compra_id = :id RETURNING compra_id, foto_id)
+        INSERT INTO compra_foto (compra_id, foto_id)
+        SELECT v.compra_id, v.foto_id FROM vuelve v JOIN foto f ON f.id = v.foto_id
+        ON CONFLICT DO NOTHING"""), {'id': arch.id})
+    print(f'[archivo] compra {arch.id} restaurada por webhook tardío')
+    return Compra.query.filter_by(id=arch.id).with_for_update().first()
+
+@app.route('/admin/archivo-compras', methods=['GET', 'POST'])
+def admin_archivo_compras():
+    """GET: cuántas hay archivadas y cuántas por archivar. POST: archiva ya."""
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    movidas = archivar_compras() if request.method == 'POST' else 0
+    por_archivar = Compra.query.filter(
+        Compra.estado.in_(ESTADOS_IMPAGOS),
+        Compra.creada_en < db.func.now() - timedelta(days=COMPRA_RETENCION_DIAS)).count()
+    return jsonify({'archivadas': CompraArchivada.query.count(), 'movidas': movidas,
+                    'por_archivar': por_archivar, 'retencion_dias': COMPRA_RETENCION_DIAS})
+
 # ── MÉTRICAS DE VENTAS (req. 4) ───────────────────────────────────────────────
+# Rollups diarios mantenidos al aprobar cada compra: los tableros leen unas
+# pocas filas por día en lugar de recorrer todas las compras de la historia.
+_ROLLUP_LOCK = 0x76656e74   # advisory lock: reconstrucción (exclusivo) vs. sumas (compartido)
+TIPOS_COMPRA = ('individual', 'pack_digital', 'pack_impresion')
+
+def _upsert_sumando(modelo, claves, valores):
+    t = modelo.__table__
+    ins = pg_insert(t).values(**claves, **valores)
+    db.session.execute(ins.on_conflict_do_update(
+        index_elements=list(claves),
+        set_={k: getattr(t.c, k) + getattr(ins.excluded, k) for k in valores}))
+
+def sumar_venta(compra, signo=1):
+    """Suma (o resta, signo=-1) una compra a los rollups. Sin commit: va en la
+    transacción que cambia el estado de la compra."""
+    db.session.execute(_sqltext('SELECT pg_advisory_xact_lock_shared(:k)'), {'k': _ROLLUP_LOCK})
+    dia   = (compra.creada_en or datetime.now()).date()
+    monto = compra.monto_total or 0
+    por_evento = (db.session.query(Foto.evento_id, db.func.count(CompraFoto.foto_id))
+                  .join(Foto, Foto.id == CompraFoto.foto_id)
+                  .filter(CompraFoto.compra_id == compra.id)
+                  .group_by(Foto.evento_id).all())
+    n_fotos = sum(n for _, n in por_evento)
+    _upsert_sumando(VentaDia, {'dia': dia, 'tipo': compra.tipo if compra.tipo in TIPOS_COMPRA else 'individual'},
+                    {'compras': signo, 'ingresos': signo * monto, 'fotos': signo * n_fotos})
+    for evento_id, n in por_evento:
+        if evento_id is None:       # foto retirada: su evento ya no existe
+            continue
+        _upsert_sumando(VentaEventoDia, {'dia': dia, 'evento_id': evento_id},
+                        {'compras': signo, 'ingresos': signo * monto * n / n_fotos, 'fotos': signo * n})
+
+def reconstruir_rollups():
+    """Recalcula los rollups desde cero a partir de las compras aprobadas."""
+    db.session.execute(_sqltext('SELECT pg_advisory_xact_lock(:k)'), {'k': _ROLLUP_LOCK})
+    db.session.execute(_sqltext('DELETE FROM venta_dia'))
+    db.session.execute(_sqltext('DELETE FROM venta_evento_dia'))
+    db.session.execute(_sqltext("""
+        INSERT INTO venta_dia (dia, tipo, compras, ingresos, fotos)
+        SELECT c.creada_en::date,
+               CASE WHEN c.tipo IN ('pack_digital', 'pack_impresion') THEN c.tipo ELSE 'individual' END,
+               count(*), coalesce(sum(c.monto_total), 0), coalesce(sum(cf.n), 0)
+          FROM compra c
+          LEFT JOIN (SELECT compra_id, count(*) AS n FROM compra_foto GROUP BY compra_id) cf
+                 ON cf.compra_id = c.id
+         WHERE c.estado = 'approved' AND c.creada_en IS NOT NULL
+         GROUP BY 1, 2"""))
+    db.session.execute(_sqltext("""
+        WITH x AS (SELECT cf.compra_id, f.evento_id, count(*) AS n
+                     FROM compra_foto cf JOIN foto f ON f.id = cf.foto_id
+                    GROUP BY 1, 2),
+             t AS (SELECT compra_id, sum(n) AS tot FROM x GROUP BY 1)
+        INSERT INTO venta_evento_dia (dia, evento_id, compras, ingresos, fotos)
+        SELECT c.creada_en::date, x.evento_id, count(*),
+               sum(coalesce(c.monto_total, 0) * x.n / t.tot), sum(x.n)
+          FROM x JOIN t ON t.compra_id = x.compra_id
+          JOIN compra c ON c.id = x.compra_id
+         WHERE c.estado = 'approved' AND c.creada_en IS NOT NULL AND x.evento_id IS NOT NULL
+         GROUP BY 1, 2"""))
+    db.session.commit()
+
+def _rango_dias(args):
+    """?desde=&hasta= (AAAA-MM-DD, inclusive). Por defecto, los últimos 30 días."""
+    hasta = datetime.strptime(args['hasta'], '%Y-%m-%d').date() if args.get('hasta') else datetime.now().date()
+    desde = datetime.strptime(args['desde'], '%Y-%m-%d').date() if args.get('desde') else hasta - timedelta(days=29)
+    return desde, hasta
+
 @app.route('/admin/metricas', methods=['GET'])
 def admin_metricas():
     if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
-    from collections import defaultdict
-    pagadas = Compra.query.filter_by(estado='approved').all()
-    total   = len(pagadas)
-    por_tipo = {'individual': 0, 'pack_digital': 0, 'pack_impresion': 0}
+    por_tipo = {t: 0 for t in TIPOS_COMPRA}
     suma_total = 0.0
-    for c in pagadas:
-        t = c.tipo if c.tipo in por_tipo else 'individual'
-        por_tipo[t] += 1
-        suma_total  += (c.monto_total or 0)
+    for tipo, n, suma in (db.session.query(VentaDia.tipo, db.func.sum(VentaDia.compras),
+                                           db.func.sum(VentaDia.ingresos))
+                          .group_by(VentaDia.tipo).all()):
+        por_tipo[tipo] = int(n or 0)
+        suma_total    += float(suma or 0)
+    total = sum(por_tipo.values())
     packs_vendidos = por_tipo['pack_digital'] + por_tipo['pack_impresion']
     aov = round(suma_total / total, 2) if total else 0
-    por_mes = defaultdict(lambda: {'n': 0, 'suma': 0.0, 'packs': 0})
-    for c in pagadas:
-        if not c.creada_en: continue
-        k = c.creada_en.strftime('%Y-%m')
-        por_mes[k]['n']    += 1
-        por_mes[k]['suma'] += (c.monto_total or 0)
-        if c.tipo in ('pack_digital', 'pack_impresion'):
-            por_mes[k]['packs'] += 1
-    serie = [{'mes': k, 'compras': v['n'], 'packs': v['packs'],
-              'aov': round(v['suma'] / v['n'], 2) if v['n'] else 0}
-             for k, v in sorted(por_mes.items())]
+    mes = db.func.to_char(VentaDia.dia, 'YYYY-MM')
+    filas = (db.session.query(
+                mes, db.func.sum(VentaDia.compras), db.func.sum(VentaDia.ingresos),
+                db.func.sum(db.case((VentaDia.tipo != 'individual', VentaDia.compras), else_=0)))
+             .group_by(mes).order_by(mes).all())
+    serie = [{'mes': k, 'compras': int(n), 'packs': int(packs),
+              'aov': round(float(suma) / n, 2) if n else 0}
+             for k, n, suma, packs in filas if n]
     return jsonify({
         'total_compras':               total,
         'packs_vendidos':              packs_vendidos,
@@ -1649,6 +3473,54 @@ def admin_metricas():
         'serie_mensual':               serie,
     })
 
+@app.route('/admin/metricas/dias', methods=['GET'])
+def admin_metricas_dias():
+    """Ventas por día (?desde=&hasta=), con el detalle por tipo."""
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    try:
+        desde, hasta = _rango_dias(request.args)
+    except ValueError:
+        return jsonify({'error': 'Fechas en formato AAAA-MM-DD'}), 400
+    dias = {}
+    for dia, tipo, n, suma, fotos in (db.session.query(VentaDia.dia, VentaDia.tipo, VentaDia.compras,
+                                                       VentaDia.ingresos, VentaDia.fotos)
+                                      .filter(VentaDia.dia.between(desde, hasta))
+                                      .order_by(VentaDia.dia).all()):
+        d = dias.setdefault(dia.isoformat(), {'dia': dia.isoformat(), 'compras': 0, 'ingresos': 0.0,
+                                              'fotos': 0, 'por_tipo': {}})
+        d['compras'] += n; d['ingresos'] += suma; d['fotos'] += fotos
+        d['por_tipo'][tipo] = n
+    return jsonify(list(dias.values()))
+
+@app.route('/admin/metricas/eventos', methods=['GET'])
+def admin_metricas_eventos():
+    """Ranking de eventos por ingresos en el rango (?desde=&hasta=)."""
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    try:
+        desde, hasta = _rango_dias(request.args)
+    except ValueError:
+        return jsonify({'error': 'Fechas en formato AAAA-MM-DD'}), 400
+    Madre = db.aliased(Evento)
+    filas = (db.session.query(VentaEventoDia.evento_id, Evento.titulo, Madre.titulo,
+                              db.func.sum(VentaEventoDia.compras), db.func.sum(VentaEventoDia.ingresos),
+                              db.func.sum(VentaEventoDia.fotos))
+             .outerjoin(Evento, Evento.id == VentaEventoDia.evento_id)
+             .outerjoin(Madre, Madre.id == Evento.parent_id)
+             .filter(VentaEventoDia.dia.between(desde, hasta))
+             .group_by(VentaEventoDia.evento_id, Evento.titulo, Madre.titulo)
+             .order_by(db.func.sum(VentaEventoDia.ingresos).desc()).all())
+    return jsonify([{
+        'evento_id': eid,
+        'titulo':    (f'{madre} / {titulo}' if madre else titulo) if titulo else 'Evento borrado',
+        'compras':   int(n), 'ingresos': round(float(suma), 2), 'fotos': int(fotos),
+    } for eid, titulo, madre, n, suma, fotos in filas])
+
+@app.route('/admin/metricas/reconstruir', methods=['POST'])
+def admin_metricas_reconstruir():
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    reconstruir_rollups()
+    return jsonify({'ok': True})
+
 # ── CONTACTO ──────────────────────────────────────────────────────────────────
 @app.route('/contacto', methods=['POST'])
 def contacto():
@@ -1662,44 +3534,170 @@ def contacto():
 # MÓDULO IA — ETIQUETAS, ROSTER Y BÚSQUEDA
 # ══════════════════════════════════════════════════════════════════════════════
 
+# ── ÍNDICE INVERTIDO JUGADOR -> FOTOS ───────────────────────────────────────
+# Los eventos y las fotos no cambian de lugar en el árbol, así que el índice solo
+# cambia con las etiquetas: cada escritura recalcula las filas de SUS fotos.
+_INDICE_LOCK = 0x6a756761   # advisory lock: reconstrucción (exclusivo) vs. incrementales (compartido)
+
+_SQL_INDEXAR = """
+    WITH RECURSIVE arriba(foto_id, evento_id) AS (
+        SELECT f.id, f.evento_id FROM foto f {donde}
+        UNION ALL
+        SELECT a.foto_id, e.parent_id FROM arriba a JOIN evento e ON e.id = a.evento_id
+         WHERE e.parent_id IS NOT NULL
+    )
+    INSERT INTO indice_jugador (evento_id, tipo, clave, foto_id)
+    SELECT DISTINCT a.evento_id, k.tipo, left(k.clave, 150), a.foto_id
+      FROM arriba a
+      JOIN foto_etiqueta t ON t.foto_id = a.foto_id
+     CROSS JOIN LATERAL (VALUES ('numero', nullif(btrim(t.numero_camiseta), '')),
+                                ('nombre', nullif({nombre}, ''))) AS k(tipo, clave)
+     WHERE k.clave IS NOT NULL {y_etiqueta}
+    ON CONFLICT DO NOTHING"""
+
+def reindexar_jugadores(foto_ids):
+    """Recalcula las filas del índice de estas fotos (DELETE + INSERT ... SELECT).
+    No hace commit: va en la misma transacción que el cambio de etiquetas."""
+    ids = sorted({int(i) for i in foto_ids})
+    if not ids:
+        return
+    db.session.execute(_sqltext('SELECT pg_advisory_xact_lock_shared(:k)'), {'k': _INDICE_LOCK})
+    IndiceJugador.query.filter(IndiceJugador.foto_id.in_(ids)).delete(synchronize_session=False)
+    # El filtro repetido sobre foto_etiqueta hace que use su índice por foto_id
+    # (la CTE sola no le da al planner una estimación de filas útil).
+    db.session.execute(_sqltext(_SQL_INDEXAR.format(donde='WHERE f.id = ANY(:ids)',
+                                                    y_etiqueta='AND t.foto_id = ANY(:ids)',
+                                                    nombre=sql_clave_nombre('t.jugador_nombre'))),
+                       {'ids': ids})
+
+def reconstruir_indice_jugadores():
+    """Rearma el índice entero desde foto_etiqueta."""
+    db.session.execute(_sqltext('SELECT pg_advisory_xact_lock(:k)'), {'k': _INDICE_LOCK})
+    db.session.execute(_sqltext('DELETE FROM indice_jugador'))
+    db.session.execute(_sqltext(_SQL_INDEXAR.format(donde='', y_etiqueta='', nombre=sql_clave_nombre('t.jugador_nombre'))))
+    db.session.commit()
+
 # ── WEBHOOK: recibe resultados del microservicio IA ───────────────────────────
+IA_MODELO_VERSION = os.environ.get('IA_MODELO_VERSION', '1')   # la IA puede mandar la suya en 'version'
+IA_RESULTADOS_MAX = 1000   # fotos por callback en /ia/resultados/lote
+
+def _ia_autorizado():
+    return request.headers.get('X-IA-Secret', '') == os.environ.get('IA_SECRET', 'ia-secret-nacho-2026')
+
+def _etiquetas_ia(jugadores):
+    """Valida los jugadores que manda la IA para una foto y los devuelve como filas
+    de foto_etiqueta (sin foto_id). Los elementos que no son objetos se ignoran.
+    ValueError con el motivo si la lista o algún campo no sirve."""
+    if jugadores is None:
+        return []
+    if not isinstance(jugadores, list):
+        raise ValueError('jugadores tiene que ser una lista')
+    filas = []
+    for j in jugadores:
+        if not isinstance(j, dict):
+            continue
+        nombre, numero = j.get('nombre'), j.get('numero')
+        if not isinstance(nombre, (str, type(None))) or not isinstance(numero, (str, int, type(None))) \
+                or isinstance(numero, bool):
+            raise ValueError('nombre y numero tienen que ser texto')
+        confianzas = {}
+        for campo in ('confianza_cara', 'confianza_numero'):
+            try:
+                v = float(j.get(campo) or 0)
+            except (TypeError, ValueError):
+                raise ValueError(f'{campo} no es un número')
+            if not math.isfinite(v):
+                raise ValueError(f'{campo} no es un número')
+            confianzas[campo] = v
+        numero = str(numero).strip() if numero is not None else ''
+        filas.append({'jugador_nombre':  (nombre or '').strip()[:150] or None,
+                      'numero_camiseta': numero[:10] or None,
+                      'fuente':          'ia', **confianzas})
+    return filas
+
+def _guardar_resultados_ia(resultados, version):
+    """Reemplaza las etiquetas IA (no las manuales) de varias fotos con un DELETE,
+    un INSERT y un UPDATE para todo el conjunto. No hace commit. Las fotos se
+    bloquean en orden de id, así que dos callbacks que se pisan no mezclan
+    etiquetas ni se trancan. resultados: {foto_id: [fila de _etiquetas_ia, ...]}.
+    Después del commit, quien llama invalida el cache 'jugador:'.
+    Devuelve (ids guardados, etiquetas borradas, etiquetas escritas)."""
+    ids = [fid for (fid,) in db.session.query(Foto.id)
+           .filter(Foto.id.in_(list(resultados))).order_by(Foto.id).with_for_update().all()]
+    if not ids:
+        return [], 0, 0
+    borradas = FotoEtiqueta.query.filter(FotoEtiqueta.foto_id.in_(ids), FotoEtiqueta.fuente == 'ia') \
+                                 .delete(synchronize_session=False)
+    filas = [dict(e, foto_id=fid) for fid in ids for e in resultados[fid]]
+    if filas:
+        db.session.execute(FotoEtiqueta.__table__.insert(), filas)
+    Foto.query.filter(Foto.id.in_(ids)).update({'ia_version': str(version or IA_MODELO_VERSION)},
+                                               synchronize_session=False)
+    reindexar_jugadores(ids)
+    return ids, borradas, len(filas)
+
 @app.route('/ia/resultados', methods=['POST'])
 def ia_resultados():
     """
     El microservicio IA llama a este endpoint con los resultados del análisis.
     Autenticación: header X-IA-Secret debe coincidir con IA_SECRET en env vars.
     """
-    secret = request.headers.get('X-IA-Secret', '')
-    if secret != os.environ.get('IA_SECRET', 'ia-secret-nacho-2026'):
+    if not _ia_autorizado():
         return jsonify({'error': 'No autorizado'}), 403
 
-    data    = request.json
-    foto_id = data.get('foto_id')
-    if not foto_id:
+    data    = request.get_json(silent=True) or {}
+    try:
+        foto_id = int(data['foto_id'])
+    except (TypeError, KeyError, ValueError):
         return jsonify({'error': 'foto_id requerido'}), 400
-
-    foto = Foto.query.get(foto_id)
-    if not foto:
+    try:
+        etiquetas = _etiquetas_ia(data.get('jugadores', []))  # lista de jugadores detectados
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    ids, _, escritas = _guardar_resultados_ia({foto_id: etiquetas}, data.get('version'))
+    if not ids:
+        db.session.rollback()
         return jsonify({'error': 'Foto no encontrada'}), 404
+    db.session.commit()
+    invalidar_cache_publica('jugador:')
+    print(f"✓ IA: {escritas} etiqueta(s) guardadas para foto #{foto_id}")
+    return jsonify({'ok': True, 'etiquetas': escritas})
+
+@app.route('/ia/resultados/lote', methods=['POST'])
+def ia_resultados_lote():
+    """Resultados de muchas fotos en un solo callback y una sola transacción.
+    Body: {version, resultados: [{foto_id, jugadores: [...]}, ...]}. Si una foto
+    aparece dos veces vale la última; las que ya no existen se informan y se ignoran.
+    Un resultado mal formado no frena al resto: va a 'errores' con su posición."""
+    if not _ia_autorizado():
+        return jsonify({'error': 'No autorizado'}), 403
+    t0   = _time.perf_counter()
+    data = request.get_json(silent=True) or {}
+    items = data.get('resultados')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'resultados requerido'}), 400
+    if len(items) > IA_RESULTADOS_MAX:
+        return jsonify({'error': f'Máximo {IA_RESULTADOS_MAX} fotos por callback'}), 400
+    resultados, errores = {}, []
+    for n, it in enumerate(items):
+        try:
+            fid = int(it['foto_id'])
+        except (TypeError, KeyError, ValueError):
+            errores.append({'indice': n, 'motivo': 'falta foto_id'})
+            continue
+        try:
+            resultados[fid] = _etiquetas_ia(it.get('jugadores'))
+        except ValueError as e:
+            errores.append({'indice': n, 'foto_id': fid, 'motivo': str(e)})
 
-    # Borrar etiquetas anteriores de IA (no las manuales)
-    FotoEtiqueta.query.filter_by(foto_id=foto_id, fuente='ia').delete()
-
-    jugadores = data.get('jugadores', [])  # lista de jugadores detectados
-    for j in jugadores:
-        etiqueta = FotoEtiqueta(
-            foto_id          = foto_id,
-            jugador_nombre   = j.get('nombre'),
-            numero_camiseta  = j.get('numero'),
-            confianza_cara   = float(j.get('confianza_cara', 0)),
-            confianza_numero = float(j.get('confianza_numero', 0)),
-            fuente           = 'ia'
-        )
-        db.session.add(etiqueta)
-
+    ids, borradas, escritas = _guardar_resultados_ia(resultados, data.get('version'))
     db.session.commit()
-    print(f"✓ IA: {len(jugadores)} etiqueta(s) guardadas para foto #{foto_id}")
-    return jsonify({'ok': True, 'etiquetas': len(jugadores)})
+    invalidar_cache_publica('jugador:')
+    ms = round((_time.perf_counter() - t0) * 1000, 1)
+    print(f"✓ IA lote: {len(ids)} foto(s), {escritas} etiqueta(s) en {ms} ms")
+    return jsonify({'ok': True, 'fotos': len(ids), 'etiquetas_escritas': escritas,
+                    'etiquetas_borradas': borradas,
+                    'desconocidas': sorted(set(resultados) - set(ids)), 'errores': errores, 'ms': ms})
 
 # ── ETIQUETA MANUAL (admin corrige o agrega) ──────────────────────────────────
 @app.route('/foto/<int:foto_id>/etiqueta', methods=['POST'])
@@ -1715,52 +3713,124 @@ def agregar_etiqueta_manual(foto_id):
         confianza_numero= 1.0,
         fuente          = 'manual'
     )
-    db.session.add(etiqueta); db.session.commit()
+    db.session.add(etiqueta); db.session.flush()
+    reindexar_jugadores([foto_id])
+    db.session.commit()
+    invalidar_cache_publica('jugador:')
     return jsonify({'ok': True, 'id': etiqueta.id})
 
 @app.route('/foto/<int:foto_id>/etiqueta/<int:et_id>', methods=['DELETE'])
 def borrar_etiqueta(foto_id, et_id):
     if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
     et = FotoEtiqueta.query.filter_by(id=et_id, foto_id=foto_id).first_or_404()
-    db.session.delete(et); db.session.commit()
+    db.session.delete(et); db.session.flush()
+    reindexar_jugadores([foto_id])
+    db.session.commit()
+    invalidar_cache_publica('jugador:')
     return jsonify({'ok': True})
 
 # ── BÚSQUEDA POR NOMBRE O NÚMERO ─────────────────────────────────────────────
+BUSQUEDA_POR_PAGINA = 48
+JUGADOR_POR_PAGINA  = 100
+
 @app.route('/buscar-jugador', methods=['GET'])
 def buscar_jugador():
-    q          = request.args.get('q', '').strip()
-    evento_id  = request.args.get('evento_id', type=int)
-    if not q or len(q) < 2:
-        return jsonify({'fotos': []})
-
-    query = FotoEtiqueta.query.join(Foto)
+    """Fotos de un jugador por nombre (sin acentos, por prefijo de cada palabra:
+    'gonz' encuentra 'González') o por número exacto. ?evento_id= incluye las
+    subcarpetas. Primero las coincidencias exactas de número, después las de
+    nombre completo y el resto de la más nueva a la más vieja. Pagina con
+    ?desde=&limite=; 'total' cuenta todas las fotos que coinciden."""
+    q         = request.args.get('q', '').strip()
+    evento_id = request.args.get('evento_id', type=int)
+    desde     = max(0, request.args.get('desde', 0, type=int))
+    limite    = min(max(request.args.get('limite', BUSQUEDA_POR_PAGINA, type=int), 1), 200)
+    terminos  = re.findall(r'[a-z0-9]+', plegar(q))
+    if not terminos or (len(q) < 2 and not q.isdigit()):
+        return jsonify({'fotos': [], 'total': 0, 'siguiente': None})
+
+    tsv   = db.literal_column(SQL_NOMBRE_TSV)
+    tsq   = db.func.to_tsquery(db.literal_column("'simple'"), ' & '.join(t + ':*' for t in terminos))
+    crit  = [tsv.op('@@')(tsq)]
+    if q.isdigit():
+        crit.append(FotoEtiqueta.numero_camiseta == q)
+    rango = db.case((FotoEtiqueta.numero_camiseta == q, 0),
+                    (db.func.lower(db.literal_column(SQL_NOMBRE_PLEGADO)) == ' '.join(terminos), 1),
+                    else_=2).label('rango')
+
+    # Una fila por foto (su mejor etiqueta), todo con índices: GIN del nombre,
+    # btree del número y evento_id de la foto. Sin lazy-loads. Sin ts_rank:
+    # recalcula el tsvector fila por fila y en búsquedas amplias es lo que más pesa.
+    mejor = (db.session.query(FotoEtiqueta.foto_id, FotoEtiqueta.jugador_nombre,
+                              FotoEtiqueta.numero_camiseta, FotoEtiqueta.fuente, rango)
+             .filter(db.or_(*crit)))
     if evento_id:
-        query = query.filter(Foto.evento_id == evento_id)
-
-    # Buscar por nombre o número
-    query = query.filter(
-        db.or_(
-            FotoEtiqueta.jugador_nombre.ilike(f'%{q}%'),
-            FotoEtiqueta.numero_camiseta == q
-        )
-    )
-
-    etiquetas = query.all()
-    fotos_vistas = set()
-    resultado = []
-    for et in etiquetas:
-        if et.foto_id not in fotos_vistas:
-            fotos_vistas.add(et.foto_id)
-            resultado.append({
-                'foto_id':     et.foto_id,
-                'url_preview': et.foto.url_preview,
-                'precio':      et.foto.precio,
-                'evento_id':   et.foto.evento_id,
-                'jugador':     et.jugador_nombre,
-                'numero':      et.numero_camiseta,
-                'fuente':      et.fuente,
-            })
-    return jsonify({'fotos': resultado, 'total': len(resultado)})
+        mejor = mejor.join(Foto, Foto.id == FotoEtiqueta.foto_id) \
+                     .filter(Foto.evento_id.in_(ids_subarbol(evento_id)))
+    mejor = (mejor.distinct(FotoEtiqueta.foto_id)
+             .order_by(FotoEtiqueta.foto_id, rango).subquery())
+    filas = (db.session.query(mejor, Foto.ref_preview, Foto.precio, Foto.evento_id)
+             .join(Foto, Foto.id == mejor.c.foto_id)
+             .order_by(mejor.c.rango, mejor.c.foto_id.desc())
+             .offset(desde).limit(limite + 1).all())
+    resultado = [{
+        'foto_id':     f.foto_id,
+        'url_preview': url_de_ref(f.ref_preview),
+        'precio':      f.precio,
+        'evento_id':   f.evento_id,
+        'jugador':     f.jugador_nombre,
+        'numero':      f.numero_camiseta,
+        'fuente':      f.fuente,
+    } for f in filas[:limite]]
+    # En la última página el total sale solo; si no, un count sobre la misma subconsulta
+    if len(filas) <= limite and (resultado or not desde):
+        total = desde + len(resultado)
+    else:
+        total = db.session.query(db.func.count()).select_from(mejor).scalar()
+    return jsonify({'fotos': resultado, 'total': total,
+                    'siguiente': desde + limite if len(filas) > limite else None})
+
+@app.route('/evento/<int:ev_id>/jugador', methods=['GET'])
+def fotos_de_jugador(ev_id):
+    """Fotos de un jugador en el evento y sus subcarpetas, desde el índice
+    invertido: ?numero=10 o ?nombre=Juan Pérez (sin importar acentos). De la más
+    nueva a la más vieja, paginadas por keyset (?antes=<id de la última>&limite=).
+    Se cachea 30s en el worker y el navegador revalida con ETag."""
+    numero = request.args.get('numero', '').strip()
+    nombre = request.args.get('nombre', '').strip()
+    if not numero and not nombre:
+        return jsonify({'error': 'numero o nombre requerido'}), 400
+    antes  = request.args.get('antes', type=int)
+    limite = min(max(request.args.get('limite', JUGADOR_POR_PAGINA, type=int), 1), 200)
+    tipo, valor = ('numero', numero) if numero else ('nombre', nombre)
+    cache = f'jugador:{ev_id}:{tipo}:{valor.lower()}:{antes or 0}:{limite}'
+    datos = _cache_get(cache)
+    if datos is None:
+        clave = (valor if tipo == 'numero'
+                 else db.session.execute(_sqltext(f"SELECT {sql_clave_nombre(':v')}"), {'v': valor}).scalar())
+        crit  = [IndiceJugador.evento_id == ev_id, IndiceJugador.tipo == tipo, IndiceJugador.clave == clave]
+        total = db.session.query(db.func.count(IndiceJugador.foto_id)).filter(*crit).scalar()
+        if antes:
+            crit.append(IndiceJugador.foto_id < antes)   # rango del PK
+        filas = (db.session.query(Foto.id, Foto.ref_preview, Foto.precio, Foto.evento_id)
+                 .join(IndiceJugador, IndiceJugador.foto_id == Foto.id)
+                 .filter(*crit).order_by(IndiceJugador.foto_id.desc()).limit(limite + 1).all())
+        fotos = [{'foto_id': fid, 'url_preview': url_de_ref(prev), 'precio': precio, 'evento_id': eid}
+                 for fid, prev, precio, eid in filas[:limite]]
+        cuerpo = json.dumps({'evento_id': ev_id, tipo: valor, 'total': total, 'fotos': fotos,
+                             'siguiente': fotos[-1]['foto_id'] if len(filas) > limite else None})
+        datos  = _cache_set(cache, {'cuerpo': cuerpo,
+                                    'etag': hashlib.sha1(cuerpo.encode('utf-8')).hexdigest()})
+    resp = make_response(datos['cuerpo'])
+    resp.mimetype = 'application/json'
+    resp.set_etag(datos['etag'])
+    resp.headers['Cache-Control'] = 'public, max-age=30'
+    return resp.make_conditional(request)
+
+@app.route('/admin/indice-jugadores/reconstruir', methods=['POST'])
+def reconstruir_indice_jugadores_admin():
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    reconstruir_indice_jugadores()
+    return jsonify({'ok': True, 'filas': IndiceJugador.query.count()})
 
 # ── ROSTER DE JUGADORES POR EVENTO ───────────────────────────────────────────
 @app.route('/evento/<int:ev_id>/roster', methods=['GET'])
@@ -1770,23 +3840,45 @@ def get_roster(ev_id):
         'id': r.id, 'numero': r.numero, 'nombre': r.nombre, 'equipo': r.equipo
     } for r in roster])
 
+ROSTER_LOTE_SQL    = 1000     # filas por INSERT ... ON CONFLICT
+ROSTER_IMPORT_MAX  = 20000    # filas por archivo importado
+
+def upsert_roster(filas):
+    """Inserta o actualiza jugadores por (evento_id, numero) con un INSERT ... ON
+    CONFLICT por cada ROSTER_LOTE_SQL filas. No hace commit. Si el mismo número
+    viene dos veces para un evento, vale el último. Devuelve (insertados, actualizados)."""
+    unicas = {}
+    for f in filas:
+        unicas[(f['evento_id'], f['numero'])] = f
+    filas, t = list(unicas.values()), JugadorRoster.__table__
+    insertados = actualizados = 0
+    for i in range(0, len(filas), ROSTER_LOTE_SQL):
+        ins = pg_insert(t).values(filas[i:i + ROSTER_LOTE_SQL])
+        res = db.session.execute(
+            ins.on_conflict_do_update(index_elements=['evento_id', 'numero'],
+                                      set_={'nombre': ins.excluded.nombre, 'equipo': ins.excluded.equipo})
+               .returning(db.literal_column('xmax = 0')))   # xmax 0 = fila nueva
+        for (nueva,) in res:
+            if nueva: insertados += 1
+            else:     actualizados += 1
+    return insertados, actualizados
+
+def _fila_roster(ev_id, j):
+    numero = str(j.get('numero') if j.get('numero') is not None else '').strip()
+    nombre = str(j.get('nombre') or '').strip()
+    if not numero or not nombre:
+        return None
+    return {'evento_id': ev_id, 'numero': numero[:10], 'nombre': nombre[:150],
+            'equipo': str(j.get('equipo') or '').strip()[:100]}
+
 @app.route('/evento/<int:ev_id>/roster', methods=['POST'])
 def agregar_jugador(ev_id):
     if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
-    d = request.json
-    # Si ya existe ese número en ese evento, actualizar
-    existente = JugadorRoster.query.filter_by(evento_id=ev_id, numero=d.get('numero','')).first()
-    if existente:
-        existente.nombre = d.get('nombre', '')
-        existente.equipo = d.get('equipo', '')
-    else:
-        jugador = JugadorRoster(
-            evento_id = ev_id,
-            numero    = d.get('numero', '').strip(),
-            nombre    = d.get('nombre', '').strip(),
-            equipo    = d.get('equipo', '').strip()
-        )
-        db.session.add(jugador)
+    fila = _fila_roster(ev_id, request.json or {})
+    if not fila:
+        return jsonify({'error': 'Faltan número o nombre'}), 400
+    # Si ya existe ese número en ese evento, se actualiza (en la misma sentencia)
+    upsert_roster([fila])
     db.session.commit()
     return jsonify({'ok': True})
 
@@ -1801,20 +3893,104 @@ def borrar_jugador(ev_id, jid):
 def roster_bulk(ev_id):
     """Carga masiva: lista de {numero, nombre, equipo}"""
     if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
-    jugadores = request.json.get('jugadores', [])
-    for j in jugadores:
-        numero = str(j.get('numero', '')).strip()
-        nombre = str(j.get('nombre', '')).strip()
-        if not numero or not nombre: continue
-        existente = JugadorRoster.query.filter_by(evento_id=ev_id, numero=numero).first()
-        if existente:
-            existente.nombre = nombre
-            existente.equipo = j.get('equipo', '')
-        else:
-            db.session.add(JugadorRoster(evento_id=ev_id, numero=numero,
-                                         nombre=nombre, equipo=j.get('equipo','')))
+    jugadores = (request.json or {}).get('jugadores', [])
+    filas = [f for f in (_fila_roster(ev_id, j) for j in jugadores if isinstance(j, dict)) if f]
+    insertados, actualizados = upsert_roster(filas)
+    db.session.commit()
+    return jsonify({'ok': True, 'total': len(jugadores),
+                    'insertados': insertados, 'actualizados': actualizados})
+
+# Encabezados aceptados en el archivo (sin acentos ni mayúsculas)
+_COLUMNAS_ROSTER = {'numero': 'numero', 'nro': 'numero', 'n': 'numero', 'dorsal': 'numero',
+                    'camiseta': 'numero', 'nombre': 'nombre', 'jugador': 'nombre',
+                    'equipo': 'equipo', 'club': 'equipo', 'categoria': 'categoria'}
+
+def _filas_archivo_roster(archivo):
+    """Itera las filas de un CSV o XLSX como listas de strings, leyendo de a poco
+    (el CSV se decodifica en stream; el XLSX con openpyxl en modo read_only)."""
+    nombre = (archivo.filename or '').lower()
+    if nombre.endswith('.xlsx'):
+        if openpyxl is None:
+            raise ValueError('Falta openpyxl en el servidor para leer .xlsx; subí un CSV')
+        libro = openpyxl.load_workbook(archivo.stream, read_only=True, data_only=True)
+        try:
+            for fila in libro.active.iter_rows(values_only=True):
+                yield ['' if v is None else (str(int(v)) if isinstance(v, float) and v.is_integer() else str(v))
+                       for v in fila]
+        finally:
+            libro.close()
+        return
+    muestra = archivo.stream.read(64 * 1024)
+    archivo.stream.seek(0)
+    try:
+        # Incremental: un carácter multibyte cortado al final de la muestra no
+        # es un error, solo queda pendiente.
+        codecs.getincrementaldecoder('utf-8')().decode(muestra, final=False)
+        codif = 'utf-8-sig'
+    except UnicodeDecodeError:
+        codif = 'cp1252'            # CSV exportado por Excel en castellano
+    texto = muestra.decode(codif, 'ignore')
+    delim = ';' if texto.count(';') > texto.count(',') else ','
+    yield from csv.reader(io.TextIOWrapper(archivo.stream, encoding=codif, errors='replace', newline=''),
+                          delimiter=delim)
+
+@app.route('/evento/<int:ev_id>/roster/importar', methods=['POST'])
+def importar_roster(ev_id):
+    """Importa un roster desde CSV o XLSX (campo 'archivo') en un solo pedido.
+    Columnas: numero, nombre, equipo y opcional categoria, que es el título de
+    una subcarpeta del evento (torneos con varias categorías). Sin categoria la
+    fila va al evento. Las filas sin número o nombre, o con una categoría que no
+    existe, se saltean y se informan en 'errores'; las válidas se guardan en una
+    sola transacción."""
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    Evento.query.get_or_404(ev_id)
+    archivo = request.files.get('archivo')
+    if not archivo:
+        return jsonify({'error': 'Falta el archivo'}), 400
+    t0 = _time.perf_counter()
+    categorias = {plegar(t).strip(): i for i, t in
+                  db.session.query(Evento.id, Evento.titulo).filter(Evento.parent_id == ev_id).all()}
+
+    filas, errores, rechazadas, cols, total, insertados, actualizados = [], [], 0, None, 0, 0, 0
+    try:
+        for n, valores in enumerate(_filas_archivo_roster(archivo), start=1):
+            if cols is None:
+                cols = [_COLUMNAS_ROSTER.get(re.sub(r'[^a-z]', '', plegar(v))) for v in valores]
+                if 'numero' not in cols or 'nombre' not in cols:
+                    return jsonify({'error': 'El archivo necesita columnas numero y nombre'}), 400
+                continue
+            if not any(v.strip() for v in valores):
+                continue
+            total += 1
+            if total > ROSTER_IMPORT_MAX:
+                db.session.rollback()
+                return jsonify({'error': f'Máximo {ROSTER_IMPORT_MAX} jugadores por archivo'}), 400
+            j = {c: v for c, v in zip(cols, valores) if c}
+            destino, motivo = ev_id, None
+            if (j.get('categoria') or '').strip():
+                destino = categorias.get(plegar(j['categoria']).strip())
+                if destino is None:
+                    motivo = f"categoría desconocida: {j['categoria'].strip()[:40]}"
+            fila = _fila_roster(destino, j) if not motivo else None
+            if not fila:
+                rechazadas += 1
+                if len(errores) < 20:
+                    errores.append({'fila': n, 'motivo': motivo or 'falta número o nombre'})
+                continue
+            filas.append(fila)
+            if len(filas) >= ROSTER_LOTE_SQL:
+                i, a = upsert_roster(filas)
+                insertados, actualizados, filas = insertados + i, actualizados + a, []
+    except (ValueError, csv.Error) as e:
+        db.session.rollback()
+        return jsonify({'error': f'No pude leer el archivo: {e}'}), 400
+    if cols is None:
+        return jsonify({'error': 'Archivo vacío'}), 400
+    i, a = upsert_roster(filas)
     db.session.commit()
-    return jsonify({'ok': True, 'total': len(jugadores)})
+    return jsonify({'ok': True, 'filas': total, 'insertados': insertados + i,
+                    'actualizados': actualizados + a, 'rechazadas': rechazadas,
+                    'errores': errores, 'ms': round((_time.perf_counter() - t0) * 1000, 1)})
 
 # ── TRIGGER: encolar foto para procesamiento IA ───────────────────────────────
 @app.route('/foto/<int:foto_id>/procesar-ia', methods=['POST'])
@@ -1832,110 +4008,244 @@ def encolar_foto_ia(foto_id):
 
     payload = {
         'foto_id':    foto_id,
-        'url_imagen': foto.url_original,
+        'url_imagen': url_imagen_ia(foto.key_ia, foto.url_original),
         'evento_id':  foto.evento_id,
         'roster':     roster_data,
         'callback':   f"{os.environ.get('BASE_URL','')}/ia/resultados"
     }
 
     try:
-        req = urllib.request.Request(
-            f"{ia_url}/procesar",
-            data    = json.dumps(payload).encode('utf-8'),
-            headers = {
-                'Content-Type':  'application/json',
-                'X-IA-Secret':   os.environ.get('IA_SECRET', 'ia-secret-nacho-2026')
-            },
-            method = 'POST'
-        )
-        with urllib.request.urlopen(req, timeout=10) as r:
-            resp = json.loads(r.read().decode())
-            return jsonify({'ok': True, 'mensaje': 'Foto encolada para procesamiento'})
+        http_pedir('ia', 'POST', f"{ia_url}/procesar", cuerpo_json=payload,
+                   headers={'X-IA-Secret': os.environ.get('IA_SECRET', 'ia-secret-nacho-2026')},
+                   timeout=10)
+        return jsonify({'ok': True, 'mensaje': 'Foto encolada para procesamiento'})
     except Exception as e:
         return jsonify({'error': f'No se pudo conectar con el microservicio: {e}'}), 503
 
+# ── TRABAJO: despacho por lotes de un evento entero ──────────────────────────
+# Las fotos viajan en lotes de IA_LOTE con el roster una sola vez por lote, y hay
+# a lo sumo IA_CONCURRENCIA lotes en vuelo (por el pool HTTP compartido, sin
+# conexión nueva por foto). El cursor avanza por id de foto después de cada
+# ventana, así que si el worker se recicla se retoma sin reenviar lo ya enviado.
+# Se saltean las fotos que ya etiquetó la versión actual del modelo.
+IA_LOTE         = int(os.environ.get('IA_LOTE', 25))
+IA_CONCURRENCIA = int(os.environ.get('IA_CONCURRENCIA', 3))
+
+def _roster_ia(ev_id):
+    return [{'numero': n, 'nombre': nom, 'equipo': eq} for n, nom, eq in
+            db.session.query(JugadorRoster.numero, JugadorRoster.nombre, JugadorRoster.equipo)
+            .filter(JugadorRoster.evento_id == ev_id).order_by(JugadorRoster.numero).all()]
+
+def _fotos_pendientes_ia(ev_id, version, forzar=False):
+    q = Foto.query.filter(Foto.evento_id == ev_id)
+    if not forzar:
+        q = q.filter(db.or_(Foto.ia_version.is_(None), Foto.ia_version != version))
+    return q
+
+# /procesar-lote es un contrato nuevo del microservicio. Mientras la versión
+# desplegada no lo tenga (404/405), se manda foto por foto a /procesar, como
+# /foto/<id>/procesar-ia. Se recuerda por proceso: al actualizar el servicio,
+# el próximo deploy de la app vuelve a probar el lote.
+_IA_SIN_LOTE = threading.Event()
+
+def _enviar_lote_ia(ia_url, ev_id, version, roster, fotos):
+    """Manda varias fotos en un POST (o una por una si el servicio no acepta lotes).
+    Devuelve cuántas aceptó el microservicio."""
+    base    = os.environ.get('BASE_URL', '')
+    headers = {'X-IA-Secret': os.environ.get('IA_SECRET', 'ia-secret-nacho-2026')}
+    if not _IA_SIN_LOTE.is_set():
+        payload = {
+            'evento_id': ev_id,
+            'version':   version,
+            'roster':    roster,
+            'fotos':     [{'foto_id': fid, 'url_imagen': url_imagen_ia(k, url_de_ref(ref))} for fid, k, ref in fotos],
+            'callback':  f"{base}/ia/resultados",
+            # los resultados del lote en UN callback (ver ia_resultados_lote)
+            'callback_lote': f"{base}/ia/resultados/lote"
+        }
+        try:
+            http_pedir('ia', 'POST', f"{ia_url}/procesar-lote", cuerpo_json=payload, headers=headers, timeout=30)
+            return len(fotos)
+        except ErrorHTTP as e:
+            if e.code not in (404, 405):
+                print(f"[ia] lote de {len(fotos)} fotos (desde #{fotos[0][0]}) falló: {e}")
+                return 0
+            _IA_SIN_LOTE.set()
+            print('[ia] el microservicio no tiene /procesar-lote: se envía foto por foto')
+        except Exception as e:
+            print(f"[ia] lote de {len(fotos)} fotos (desde #{fotos[0][0]}) falló: {e}")
+            return 0
+    aceptadas = 0
+    for fid, k, ref in fotos:
+        try:
+            http_pedir('ia', 'POST', f"{ia_url}/procesar", headers=headers, timeout=10,
+                       cuerpo_json={'foto_id': fid, 'url_imagen': url_imagen_ia(k, url_de_ref(ref)),
+                                    'evento_id': ev_id, 'roster': roster,
+                                    'callback': f"{base}/ia/resultados"})
+            aceptadas += 1
+        except Exception as e:
+            print(f"[ia] foto #{fid} falló: {e}")
+    return aceptadas
+
+@trabajo_handler('ia_evento')
+def _trabajo_ia_evento(tid, params):
+    ia_url = os.environ.get('IA_SERVICE_URL', '')
+    if not ia_url:
+        raise RuntimeError('IA_SERVICE_URL no configurado')
+    ev_id, version = params['evento_id'], params['version']
+    lote   = max(1, int(params.get('lote', IA_LOTE)))
+    cursor = Trabajo.query.get(tid).cursor or 0
+    roster = _roster_ia(ev_id)
+    with ThreadPoolExecutor(max_workers=IA_CONCURRENCIA) as pool:
+        while True:
+            filas = (_fotos_pendientes_ia(ev_id, version, params.get('forzar'))
+                     .filter(Foto.id > cursor).order_by(Foto.id)
+                     .with_entities(Foto.id, Foto.key_ia, Foto.ref_original)
+                     .limit(lote * IA_CONCURRENCIA).all())
+            if not filas:
+                return
+            lotes = [filas[i:i + lote] for i in range(0, len(filas), lote)]
+            ok    = sum(pool.map(lambda l: _enviar_lote_ia(ia_url, ev_id, version, roster, l), lotes))
+            cursor = filas[-1][0]
+            if not avanzar_trabajo(tid, cursor=cursor, hechos=ok, fallidos=len(filas) - ok):
+                return
+
 @app.route('/evento/<int:ev_id>/procesar-ia-todo', methods=['POST'])
 def procesar_evento_completo(ev_id):
-    """Encola TODAS las fotos de un evento para procesamiento IA en background."""
+    """Manda a la IA las fotos del evento que la versión actual del modelo todavía
+    no etiquetó, como trabajo en background (por lotes, reanudable). Body opcional:
+    {forzar: true} reprocesa todas; {lote: n} cambia el tamaño del lote. El progreso
+    se consulta en /admin/trabajos/<id>."""
     if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
-    ia_url = os.environ.get('IA_SERVICE_URL', '')
-    if not ia_url:
+    if not os.environ.get('IA_SERVICE_URL', ''):
         return jsonify({'error': 'Microservicio IA no configurado'}), 503
 
-    ev    = Evento.query.get_or_404(ev_id)
-    fotos = ev.fotos
-    roster = JugadorRoster.query.filter_by(evento_id=ev_id).all()
-    roster_data = [{'numero': r.numero, 'nombre': r.nombre, 'equipo': r.equipo}
-                   for r in roster]
-
-    def encolar_todas():
-        with app.app_context():
-            for foto in fotos:
-                try:
-                    payload = {
-                        'foto_id':    foto.id,
-                        'url_imagen': foto.url_original,
-                        'evento_id':  ev_id,
-                        'roster':     roster_data,
-                        'callback':   f"{os.environ.get('BASE_URL','')}/ia/resultados"
-                    }
-                    req = urllib.request.Request(
-                        f"{ia_url}/procesar",
-                        data    = json.dumps(payload).encode(),
-                        headers = {'Content-Type': 'application/json',
-                                   'X-IA-Secret': os.environ.get('IA_SECRET','ia-secret-nacho-2026')},
-                        method  = 'POST'
-                    )
-                    urllib.request.urlopen(req, timeout=10)
-                except Exception as e:
-                    print(f"Error encolando foto {foto.id}: {e}")
-    
-    threading.Thread(target=encolar_todas, daemon=True).start()
-    return jsonify({'ok': True, 'total_fotos': len(fotos),
-                    'mensaje': f'Procesando {len(fotos)} fotos en background'})
+    Evento.query.get_or_404(ev_id)
+    d      = request.get_json(silent=True) or {}
+    params = {'evento_id': ev_id, 'version': IA_MODELO_VERSION,
+              'lote': min(max(int(d.get('lote') or IA_LOTE), 1), 200),
+              'forzar': bool(d.get('forzar'))}
+    # Uno por evento: si ya hay uno en curso se devuelve ese
+    for t in Trabajo.query.filter(Trabajo.tipo == 'ia_evento',
+                                  Trabajo.estado.in_(('pendiente', 'corriendo'))).all():
+        if json.loads(t.params_json or '{}').get('evento_id') == ev_id:
+            return jsonify({'ok': True, 'total_fotos': t.total, 'trabajo': _trabajo_dict(t),
+                            'mensaje': 'Ya se estaba procesando este evento'}), 202
+
+    total = _fotos_pendientes_ia(ev_id, IA_MODELO_VERSION, params['forzar']).count()
+    t = lanzar_trabajo('ia_evento', params, total=total)
+    return jsonify({'ok': True, 'total_fotos': total, 'trabajo': _trabajo_dict(t),
+                    'mensaje': f'Procesando {total} fotos en background'}), 202
 
 # ── ADMIN ─────────────────────────────────────────────────────────────────────
 @app.route('/admin/stats', methods=['GET'])
 def admin_stats():
     if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    # Una sola ida a la base; compras e ingresos salen del rollup diario
+    sub = lambda q: q.scalar_subquery()
+    fila = db.session.query(
+        sub(db.session.query(db.func.count(Foto.id))),
+        sub(db.session.query(db.func.count(Evento.id))),
+        sub(db.session.query(db.func.coalesce(db.func.sum(VentaDia.compras), 0))),
+        sub(db.session.query(db.func.coalesce(db.func.sum(VentaDia.ingresos), 0))),
+        sub(db.session.query(db.func.count(Compra.id)).filter(Compra.estado == 'approved',
+                                                             Compra.email_enviado == False)),
+        sub(db.session.query(db.func.count(Consulta.id)).filter(Consulta.leida == False)),
+    ).one()
     return jsonify({
-        'total_fotos': Foto.query.count(), 'total_eventos': Evento.query.count(),
-        'total_compras': Compra.query.filter_by(estado='approved').count(),
-        'ingresos': float(db.session.query(db.func.sum(Compra.monto_total)).filter_by(estado='approved').scalar() or 0),
-        'emails_pend': Compra.query.filter_by(estado='approved', email_enviado=False).count(),
-        'mensajes_nue': Consulta.query.filter_by(leida=False).count()
+        'total_fotos': fila[0], 'total_eventos': fila[1],
+        'total_compras': int(fila[2]),
+        'ingresos': float(fila[3]),
+        'emails_pend': fila[4],
+        'mensajes_nue': fila[5]
     })
 
+COMPRAS_POR_PAGINA = 50
+
+def _filtro_compras(args):
+    """Criterios SQL a partir de los filtros del panel. Devuelve (criterios, error)."""
+    crit = []
+    estado = args.get('estado', '').strip()
+    if estado:
+        crit.append(Compra.estado == estado)
+    for nombre, op in (('desde', '>='), ('hasta', '<')):
+        valor = args.get(nombre, '').strip()
+        if not valor:
+            continue
+        try:
+            dia = datetime.strptime(valor, '%Y-%m-%d')
+        except ValueError:
+            return None, f'{nombre} debe ser AAAA-MM-DD'
+        crit.append(Compra.creada_en >= dia if op == '>=' else Compra.creada_en < dia + timedelta(days=1))
+    q = args.get('q', '').strip()
+    if q:
+        patron = '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        crit.append(db.or_(Compra.email_cliente.ilike(patron), Compra.nombre_cliente.ilike(patron)))
+    evento = args.get('evento', type=int)
+    if evento:
+        # el evento y sus subcarpetas: elegir la madre trae las compras de todas sus hijas
+        crit.append(db.exists().where(CompraFoto.compra_id == Compra.id,
+                                      CompraFoto.foto_id == Foto.id,
+                                      Foto.evento_id.in_(ids_subarbol(evento))))
+    envio = args.get('envio', '').strip()
+    if envio == 'sin_email':
+        crit.append(Compra.email_enviado.isnot(True))
+    elif envio == 'sin_wa':
+        crit += [Compra.whatsapp_cliente.isnot(None), Compra.wa_enviado.isnot(True)]
+    elif envio == 'completo':
+        crit += [Compra.email_enviado.is_(True),
+                 db.or_(Compra.whatsapp_cliente.is_(None), Compra.wa_enviado.is_(True))]
+    elif envio == 'con_error':
+        crit.append(db.exists().where(Entrega.compra_id == Compra.id, Entrega.estado == 'error'))
+    elif envio:
+        return None, 'envio: sin_email | sin_wa | completo | con_error'
+    return crit, None
+
 @app.route('/admin/compras', methods=['GET'])
 def ver_compras():
+    """Compras más nuevas primero, paginadas por keyset (?antes=<id de la última>).
+    Filtros: estado, desde/hasta (AAAA-MM-DD), evento (incluye subcarpetas), q
+    (nombre o email) y envio. El costo depende del tamaño de la página, no del historial."""
     if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
-    base = os.environ.get('BASE_URL', request.host_url.rstrip('/'))
-    foto2ev = dict(db.session.query(Foto.id, Foto.evento_id).all())
-    eventos = {e.id: e for e in Evento.query.all()}
-    def infos_de(ev):
-        out = []
-        if ev.parent_id and ev.parent_id in eventos:
-            madre = eventos[ev.parent_id]
-            out.append({'id': ev.id, 'titulo': madre.titulo + ' / ' + ev.titulo})
-            out.append({'id': madre.id, 'titulo': madre.titulo})
-        else:
-            out.append({'id': ev.id, 'titulo': ev.titulo})
-        return out
+    base   = os.environ.get('BASE_URL', request.host_url.rstrip('/'))
+    limite = min(max(request.args.get('limite', COMPRAS_POR_PAGINA, type=int), 1), 200)
+    crit, err = _filtro_compras(request.args)
+    if err:
+        return jsonify({'error': err}), 400
+    antes = request.args.get('antes', type=int)
+    if antes:
+        crit.append(Compra.id < antes)
+    compras = Compra.query.filter(*crit).order_by(Compra.id.desc()).limit(limite + 1).all()
+    siguiente = compras[limite - 1].id if len(compras) > limite else None
+    compras   = compras[:limite]
+    ids       = [c.id for c in compras]
+
+    # Fotos y eventos sólo de las compras de esta página
+    fotos_de = {}
+    for cid, fid in (db.session.query(CompraFoto.compra_id, CompraFoto.foto_id)
+                     .filter(CompraFoto.compra_id.in_(ids))
+                     .order_by(CompraFoto.compra_id, CompraFoto.foto_id)) if ids else []:
+        fotos_de.setdefault(cid, []).append(fid)
+    # Evento (y madre) de cada foto desde el índice en memoria
+    idx    = indice_fotos()
+    evs_de = {}
+    for cid, fids in fotos_de.items():
+        evs = evs_de.setdefault(cid, {})
+        for _, eid in idx.con_evento(fids):
+            if eid in evs:
+                continue
+            mid = idx.eventos.get(eid, (None,))[0]
+            evs[eid] = {'id': eid, 'titulo': idx.titulo_evento(eid)}
+            if mid:
+                evs[mid] = {'id': mid, 'titulo': idx.eventos[mid][1]}
     salida = []
-    for c in Compra.query.order_by(Compra.creada_en.desc()).all():
-        ids = json.loads(c.foto_ids or '[]')
-        evs = {}
-        for fid in ids:
-            ev = eventos.get(foto2ev.get(fid))
-            if ev:
-                for info in infos_de(ev):
-                    evs[info['id']] = info
+    for c in compras:
         salida.append({
             'id':            c.id,
             'email':         c.email_cliente,
             'nombre':        c.nombre_cliente,
             'whatsapp':      c.whatsapp_cliente,
-            'foto_ids':      ids,
+            'foto_ids':      fotos_de.get(c.id, []),
             'total':         c.monto_total,
             'estado':        c.estado,
             'email_enviado': c.email_enviado,
@@ -1943,9 +4253,21 @@ def ver_compras():
             'link_galeria':  f"{base}/galeria/{c.token_galeria}" if c.token_galeria else None,
             'fecha':         c.creada_en.strftime('%d/%m/%Y %H:%M') if c.creada_en else '',
             'fecha_iso':     c.creada_en.strftime('%Y-%m-%d') if c.creada_en else '',
-            'eventos':       list(evs.values())
+            'eventos':       list(evs_de.get(c.id, {}).values())
         })
-    return jsonify(salida)
+    return jsonify({'compras': salida, 'siguiente': siguiente})
+
+@app.route('/admin/fotos/<int:fid>/compras', methods=['GET'])
+def compras_de_foto(fid):
+    """Qué compras incluyen una foto (índice compra_foto(foto_id))."""
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    compras = (Compra.query.join(CompraFoto, CompraFoto.compra_id == Compra.id)
+               .filter(CompraFoto.foto_id == fid)
+               .order_by(Compra.creada_en.desc()).all())
+    return jsonify([{'id': c.id, 'email': c.email_cliente, 'nombre': c.nombre_cliente,
+                     'estado': c.estado, 'total': c.monto_total,
+                     'fecha': c.creada_en.strftime('%d/%m/%Y %H:%M') if c.creada_en else ''}
+                    for c in compras])
 
 @app.route('/admin/compras/<int:cid>/reenviar', methods=['POST'])
 def reenviar_todo(cid):
@@ -1953,10 +4275,176 @@ def reenviar_todo(cid):
     compra = Compra.query.get_or_404(cid)
     compra.email_enviado = False
     compra.wa_enviado    = False
+    encolar_entregas(compra, generacion=f'r{int(_time.time())}', canales=['email', 'whatsapp'])
     db.session.commit()
-    threading.Thread(target=entregar_compra, args=(cid,), daemon=True).start()
+    despertar_entregas()
     return jsonify({'ok': True})
 
+# ── REENVÍO MASIVO (p.ej. después de una caída del proveedor de email) ────────
+# Corre como trabajo: emails por la API batch de Resend (hasta 100 por llamada),
+# WhatsApp por un pool acotado; ambos respetando el rate limit del proveedor.
+# Cada resultado queda como fila de `entrega`, así las fallas se ven en
+# /admin/entregas y en el filtro envio=con_error de /admin/compras.
+REENVIO_LOTE          = 100    # máximo de la API batch de Resend
+REENVIO_CONCURRENCIA  = int(os.environ.get('REENVIO_CONCURRENCIA', 4))
+RESEND_RPS            = float(os.environ.get('RESEND_RPS', 2))    # límite por defecto de Resend
+META_WA_RPS           = float(os.environ.get('META_WA_RPS', 10))
+
+class _Limitador:
+    """Como mucho `por_seg` llamadas por segundo, repartidas entre todos los hilos."""
+    def __init__(self, por_seg):
+        self.intervalo = 1.0 / por_seg
+        self._prox     = 0.0
+        self._lock     = threading.Lock()
+
+    def esperar(self):
+        with self._lock:
+            ahora      = _time.monotonic()
+            turno      = max(self._prox, ahora)
+            self._prox = turno + self.intervalo
+        if turno > ahora:
+            _time.sleep(turno - ahora)
+
+_LIMITE_RESEND = _Limitador(RESEND_RPS)
+_LIMITE_WA     = _Limitador(META_WA_RPS)
+
+def _reenviar_emails(compras, clave):
+    """Manda los emails de `compras` por la API batch. Devuelve {compra_id: error|None}."""
+    mensajes, ids, res = [], [], {}
+    for c in compras:
+        m = _mail_compra(c)
+        if m: mensajes.append(m); ids.append(c.id)
+        else: res[c.id] = 'compra sin fotos'
+    if not mensajes:
+        return res
+    # Con Idempotency-Key el lote es idempotente: http_pedir reintenta los 429/5xx
+    # respetando Retry-After sin riesgo de mandar dos veces
+    _LIMITE_RESEND.esperar()
+    try:
+        http_pedir('resend', 'POST', f'{RESEND_API_URL}/emails/batch',
+                   cuerpo_json = mensajes,
+                   headers     = {"Authorization":   f"Bearer {RESEND_API_KEY}",
+                                  "User-Agent":      "nacholingua-mailer/1.0",
+                                  "Idempotency-Key": clave},
+                   timeout     = 30, idempotente=True)
+        error = None
+    except ErrorHTTP as e:
+        error = f'Resend HTTP {e.code}: {e.cuerpo[:200]}'
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    res.update({cid: error for cid in ids})
+    return res
+
+def _reenviar_wa_uno(compra):
+    _LIMITE_WA.esperar()
+    try:
+        return None if enviar_wa_cliente(compra) else 'fallo el envío de WhatsApp'
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+
+@trabajo_handler('reenvio_masivo')
+def _trabajo_reenvio_masivo(tid, params):
+    crit, _ = _filtro_compras(MultiDict(params.get('filtros') or {}))
+    canales = params.get('canales') or ['email', 'whatsapp']
+    forzar  = bool(params.get('forzar'))
+    cursor  = Trabajo.query.get(tid).cursor or 0
+    with ThreadPoolExecutor(max_workers=REENVIO_CONCURRENCIA) as pool:
+        while True:
+            compras = (Compra.query.filter(*crit, Compra.estado == 'approved', Compra.id > cursor)
+                       .order_by(Compra.id).limit(REENVIO_LOTE).all())
+            if not compras:
+                return
+            for c in compras:
+                if not c.token_galeria:
+                    c.token_galeria = generar_token()
+            db.session.commit()
+
+            # Cada canal solo a quien todavía no lo recibió, salvo "forzar"
+            resultados = []    # (compra, canal, error|None)
+            if 'email' in canales and RESEND_API_KEY:
+                sin_email = [c for c in compras if forzar or not c.email_enviado]
+                if sin_email:
+                    errores = _reenviar_emails(sin_email, clave=f'reenvio-{tid}-{sin_email[0].id}')
+                    for c in sin_email:
+                        resultados.append((c, 'email', errores[c.id]))
+            if 'whatsapp' in canales and META_WA_ENABLED:
+                con_wa = [c for c in compras if c.whatsapp_cliente and (forzar or not c.wa_enviado)]
+                for c, error in zip(con_wa, pool.map(_reenviar_wa_uno, con_wa)):
+                    resultados.append((c, 'whatsapp', error))
+
+            fallidas = set()
+            for c, canal, error in resultados:
+                if error:
+                    fallidas.add(c.id)
+                elif canal == 'email':
+                    c.email_enviado = True
+                else:
+                    c.wa_enviado = True
+            if resultados:
+                db.session.execute(
+                    pg_insert(Entrega.__table__)
+                    .values([{'compra_id': c.id, 'canal': canal, 'clave': f'reenvio-{tid}-{c.id}-{canal}',
+                              'estado': 'error' if error else 'enviado', 'intentos': 1,
+                              'error': error[:300] if error else None,
+                              'enviado_en': None if error else db.func.now()}
+                             for c, canal, error in resultados])
+                    .on_conflict_do_nothing(index_elements=['clave']))
+            # Flags + outbox + cursor en la misma transacción
+            cursor   = compras[-1].id
+            enviadas = {c.id for c, _, _ in resultados}
+            if not avanzar_trabajo(tid, cursor=cursor, hechos=len(enviadas) - len(fallidas),
+                                   fallidos=len(fallidas), saltados=len(compras) - len(enviadas)):
+                return
+
+@app.route('/admin/compras/reenviar-lote', methods=['POST'])
+def reenviar_lote():
+    """Reenvía email y/o WhatsApp a las compras aprobadas que cumplen los filtros de
+    /admin/compras (p.ej. {"filtros": {"envio": "sin_email", "desde": "2026-05-01"}}).
+    Cada canal va solo a las compras que todavía no lo recibieron (email_enviado /
+    wa_enviado); "forzar": true reenvía igual. Con "simular": true sólo cuenta. El progreso se consulta en /admin/trabajos/<id>."""
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    d       = request.json or {}
+    filtros = {k: str(v) for k, v in (d.get('filtros') or {}).items() if v not in (None, '')}
+    canales = [c for c in (d.get('canales') or ['email', 'whatsapp']) if c in ('email', 'whatsapp')]
+    if not canales:
+        return jsonify({'error': 'canales: email y/o whatsapp'}), 400
+    crit, err = _filtro_compras(MultiDict(filtros))
+    if err:
+        return jsonify({'error': err}), 400
+    total = Compra.query.filter(*crit, Compra.estado == 'approved').count()
+    if d.get('simular'):
+        return jsonify({'ok': True, 'total': total})
+    activo = trabajo_activo('reenvio_masivo')
+    if activo:
+        return jsonify({'error': 'Ya hay un reenvío masivo en curso', 'trabajo': _trabajo_dict(activo)}), 409
+    t = lanzar_trabajo('reenvio_masivo', {'filtros': filtros, 'canales': canales,
+                                          'forzar': bool(d.get('forzar'))}, total=total)
+    return jsonify({'ok': True, 'trabajo': _trabajo_dict(t)}), 202
+
+@app.route('/admin/entregas', methods=['GET'])
+def metricas_entregas():
+    """Estado del outbox y latencia aprobación -> enviado por canal (últimos ?dias=7)."""
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    dias = request.args.get('dias', 7, type=int)
+    lat  = db.func.extract('epoch', Entrega.enviado_en - Entrega.creado_en)
+    desde = db.func.now() - timedelta(days=dias)
+    out = {}
+    for canal, estado, n in (db.session.query(Entrega.canal, Entrega.estado, db.func.count(Entrega.id))
+                             .filter(Entrega.creado_en >= desde)
+                             .group_by(Entrega.canal, Entrega.estado).all()):
+        out.setdefault(canal, {})[estado] = n
+    for canal, p50, p95, mx in (db.session.query(
+                Entrega.canal,
+                db.func.percentile_cont(0.5).within_group(lat),
+                db.func.percentile_cont(0.95).within_group(lat),
+                db.func.max(lat))
+            .filter(Entrega.estado == 'enviado', Entrega.creado_en >= desde)
+            .group_by(Entrega.canal).all()):
+        out.setdefault(canal, {}).update({'latencia_p50_seg': round(float(p50), 1),
+                                          'latencia_p95_seg': round(float(p95), 1),
+                                          'latencia_max_seg': round(float(mx), 1)})
+    return jsonify(out)
+
 @app.route('/admin/consultas', methods=['GET'])
 def ver_consultas():
     if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
@@ -2006,40 +4494,42 @@ def cloudinary_signature():
         'timestamp':  timestamp,
         'folder':     folder,
         'api_key':    os.environ.get('CLOUD_API_KEY', ''),
-        'cloud_name': os.environ.get('CLOUD_NAME', '')
+        'cloud_name': os.environ.get('CLOUD_NAME', ''),
+        'wasabi_directo': WASABI_ENABLED   # originales directo al bucket (/wasabi/multipart/*)
     })
 
-@app.route('/registrar-foto', methods=['POST'])
-def registrar_foto():
-    """Registra en BD una foto subida a Cloudinary desde el browser,
-    aplicando marca de agua antes de guardar el preview."""
-    if not session.get('admin'):
-        return jsonify({'error': 'No autorizado'}), 403
-
-    data      = request.json or {}
-    url_clean = data.get('url_preview')
-    evento_id = data.get('evento_id')
-    precio    = float(data.get('precio', 3200))
-    public_id = data.get('public_id', '')
-
-    if not url_clean or not evento_id:
-        return jsonify({'error': 'Faltan datos'}), 400
+def registrar_original(evento_id, precio, url_clean=None, public_id='', key_original=None,
+                       commit=True):
+    """Núcleo de /registrar-foto. A partir del original (subido a Cloudinary o, con la
+    subida directa, ya guardado en Wasabi) genera la preview con marca y la portada
+    limpia, y guarda la Foto. Devuelve la Foto; lanza ValueError si no hay preview.
+    Con commit=False la Foto queda en la sesión (flush) para confirmarla junto a otra cosa."""
+    stamp = int(_time.time())
 
-    # ── 1) Bajar el original limpio UNA sola vez (sirve para marca y Wasabi) ─
-    import urllib.request, time as _t2
+    # ── 1) Bajar el original limpio UNA sola vez (sirve para marca, Wasabi y portada) ─
     raw = None
-    try:
-        with urllib.request.urlopen(url_clean) as resp:
-            raw = resp.read()
-    except Exception as e:
-        print(f'[registrar-foto] no pude bajar el original: {e}')
+    if key_original:
+        try:
+            raw = get_wasabi_client().get_object(Bucket=WASABI_BUCKET, Key=key_original)['Body'].read()
+        except Exception as e:
+            print(f'[registrar-foto] no pude leer {key_original} de Wasabi: {e}')
+        base_id = os.path.splitext(os.path.basename(key_original))[0]
+    else:
+        try:
+            raw = http_pedir('descarga', 'GET', url_clean, timeout=60).data
+        except Exception as e:
+            print(f'[registrar-foto] no pude bajar el original: {e}')
+        base_id = public_id.split('/')[-1] if public_id else 'foto'
 
     # ── 2) Marca de agua -> preview LIVIANA en Cloudinary ─────────────────
     url_preview = url_clean
     if raw is not None:
         try:
             img_marcada  = agregar_watermark_5x(io.BytesIO(raw))
-            wm_public_id = (public_id + f'_wm_{int(_t2.time())}') if public_id else None
+            if key_original:
+                wm_public_id = f'{base_id}_wm_{stamp}'
+            else:
+                wm_public_id = (public_id + f'_wm_{stamp}') if public_id else None
             r_wm = cloudinary.uploader.upload(
                 img_marcada, folder='nacholingua', public_id=wm_public_id,
                 resource_type='image', invalidate=True,
@@ -2048,15 +4538,20 @@ def registrar_foto():
             print(f'[registrar-foto] watermark OK -> {url_preview[:70]}...')
         except Exception as e:
             print(f'[registrar-foto] watermark fallo, guardando sin marca: {e}')
+    if not url_preview:
+        # Subida directa: no hay copia en Cloudinary a la que caer; sin preview no se publica
+        raise ValueError('No se pudo generar la preview')
 
     # ── 3) Original -> WASABI y se BORRA de Cloudinary (libera los 25 GB) ─────
     #     Si Wasabi falla o no esta configurado, el original queda en Cloudinary
     #     (igual que antes) para no perder la foto ni romper la compra.
-    url_original = url_clean.replace('/upload/', '/upload/q_100/')
-    if raw is not None and WASABI_ENABLED:
+    if key_original:
+        url_original = url_publica_wasabi(key_original)
+    else:
+        url_original = url_clean.replace('/upload/', '/upload/q_100/')
+    if raw is not None and WASABI_ENABLED and not key_original:
         try:
-            base_id  = (public_id.split('/')[-1] if public_id else 'foto')
-            key_orig = f"nacho_lingua/originales/evento_{evento_id}/{base_id}_{int(_t2.time())}.jpg"
+            key_orig   = f"{PREFIJO_ORIGINALES}evento_{evento_id}/{base_id}_{stamp}.jpg"
             wasabi_url = subir_bytes_a_wasabi(raw, key_orig)
             if wasabi_url:
                 url_original = wasabi_url
@@ -2072,60 +4567,486 @@ def registrar_foto():
     # ── 4) Portada LIMPIA (sin marca, baja resolucion) para el showcase ──────
     url_cover = _generar_cover_limpia(raw) if raw is not None else None
 
+    # ── 5) Copia chica para la IA (la IA no necesita bajar el original de 20 MB) ─
+    key_ia = None
+    if raw is not None:
+        key_ia = _generar_derivada_ia(raw, f"{PREFIJO_IA}evento_{evento_id}/{base_id}_{stamp}.jpg")
+
     foto = Foto(
         url_preview  = url_preview,
         url_original = url_original,
         url_cover    = url_cover,
+        key_ia       = key_ia,
         precio       = precio,
         evento_id    = evento_id,
+        version      = sellar_catalogo(),
     )
     db.session.add(foto)
-    db.session.commit()
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
+    return foto
+
+@app.route('/registrar-foto', methods=['POST'])
+def registrar_foto():
+    """Registra en BD una foto subida desde el browser (a Cloudinary, o directo a
+    Wasabi con `key_original`), aplicando marca de agua antes de guardar el preview."""
+    if not session.get('admin'):
+        return jsonify({'error': 'No autorizado'}), 403
 
-    return jsonify({'ok': True, 'id': foto.id, 'url_preview': url_preview})
+    data         = request.json or {}
+    url_clean    = data.get('url_preview')
+    key_original = data.get('key_original')
+    evento_id    = data.get('evento_id')
+    precio       = float(data.get('precio', 3200))
+    public_id    = data.get('public_id', '')
 
-@app.route('/admin/migrar-wasabi', methods=['POST'])
-def migrar_wasabi():
-    """Mueve a Wasabi los originales que hoy estan en Cloudinary y los borra de
-    Cloudinary (uso unico, para las fotos viejas). Solo admin."""
+    if not (url_clean or key_original) or not evento_id:
+        return jsonify({'error': 'Faltan datos'}), 400
+    if key_original and not _key_original_valida(key_original):
+        return jsonify({'error': 'Key invalida'}), 400
+
+    try:
+        foto = registrar_original(evento_id, precio, url_clean=url_clean,
+                                  public_id=public_id, key_original=key_original)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 502
+    return jsonify({'ok': True, 'id': foto.id, 'url_preview': foto.url_preview})
+
+# ── REGISTRO POR LOTE (cientos de fotos en un solo pedido) ───────────────────
+# El admin sube todas las fotos al storage y manda la lista de una vez; un pool
+# acotado las procesa en background y el panel consulta el estado por foto.
+REGISTRO_CONCURRENCIA = int(os.environ.get('REGISTRO_CONCURRENCIA', 3))
+MAX_FOTOS_LOTE        = 1000
+
+def _registrar_item_lote(item_id, evento_id, precio):
+    """Procesa UNA foto del lote en su propio app context (corre en el pool).
+    La Foto y el estado del item se confirman juntos: al reanudar no se duplica.
+    Devuelve True (registrada), False (falló) o None si ya estaba hecha de una
+    corrida anterior que se cortó antes de mover el cursor."""
+    with app.app_context():
+        item = LoteFoto.query.get(item_id)
+        if not item or item.estado == 'ok':
+            return None
+        try:
+            foto = registrar_original(evento_id, precio, url_clean=item.url_clean,
+                                      public_id=item.public_id or '',
+                                      key_original=item.key_original, commit=False)
+            item.estado, item.foto_id, item.error = 'ok', foto.id, None
+            db.session.commit()
+            return True
+        except Exception as e:
+            db.session.rollback()
+            LoteFoto.query.filter_by(id=item_id).update(
+                {'estado': 'error', 'error': f'{type(e).__name__}: {e}'[:300]},
+                synchronize_session=False)
+            db.session.commit()
+            print(f'[lote] item {item_id} fallo: {e}')
+            return False
+
+@trabajo_handler('registrar_lote')
+def _trabajo_registrar_lote(tid, params):
+    evento_id, precio = params['evento_id'], float(params.get('precio', 3200))
+    cursor = Trabajo.query.get(tid).cursor or 0
+    with ThreadPoolExecutor(max_workers=REGISTRO_CONCURRENCIA) as pool:
+        while True:
+            ids = [i for (i,) in db.session.query(LoteFoto.id)
+                   .filter(LoteFoto.trabajo_id == tid, LoteFoto.id > cursor)
+                   .order_by(LoteFoto.id).limit(REGISTRO_CONCURRENCIA * 2).all()]
+            if not ids:
+                return
+            res = list(pool.map(lambda i: _registrar_item_lote(i, evento_id, precio), ids))
+            cursor = ids[-1]
+            invalidar_cache_publica()
+            if not avanzar_trabajo(tid, cursor=cursor, hechos=res.count(True),
+                                   fallidos=res.count(False), saltados=res.count(None)):
+                return
+
+@app.route('/registrar-fotos/lote', methods=['POST'])
+def registrar_fotos_lote():
+    """Body: {evento_id, precio, fotos: [{public_id, url_preview} | {key_original}, ...]}.
+    Devuelve el id del lote enseguida (202); el estado se consulta por GET."""
+    if not session.get('admin'):
+        return jsonify({'error': 'No autorizado'}), 403
+    d         = request.json or {}
+    evento_id = d.get('evento_id')
+    fotos     = d.get('fotos') or []
+    if not evento_id or not isinstance(fotos, list) or not fotos:
+        return jsonify({'error': 'Faltan datos'}), 400
+    if len(fotos) > MAX_FOTOS_LOTE:
+        return jsonify({'error': f'Máximo {MAX_FOTOS_LOTE} fotos por lote'}), 400
+    if not Evento.query.get(evento_id):
+        return jsonify({'error': 'Evento no encontrado'}), 404
+
+    filas = []
+    for f in fotos:
+        f = f if isinstance(f, dict) else {}
+        key = f.get('key_original')
+        if key and not _key_original_valida(key):
+            return jsonify({'error': 'Key invalida'}), 400
+        if not key and not f.get('url_preview'):
+            return jsonify({'error': 'Cada foto necesita url_preview o key_original'}), 400
+        filas.append({'public_id': f.get('public_id') or None, 'url_clean': f.get('url_preview'),
+                      'key_original': key, 'estado': 'pendiente'})
+
+    t = Trabajo(tipo='registrar_lote', total=len(filas), estado='pendiente',
+                params_json=json.dumps({'evento_id': int(evento_id),
+                                        'precio': float(d.get('precio', 3200))}))
+    db.session.add(t); db.session.flush()
+    for fila in filas:
+        fila['trabajo_id'] = t.id
+    db.session.execute(LoteFoto.__table__.insert(), filas)
+    db.session.commit()
+    threading.Thread(target=_correr_trabajo, args=(t.id,), daemon=True).start()
+    return jsonify({'ok': True, 'lote_id': t.id, 'total': len(filas)}), 202
+
+@app.route('/registrar-fotos/lote/<int:lote_id>', methods=['GET'])
+def estado_lote(lote_id):
+    """Progreso del lote + estado por foto. ?estado=error filtra; ?desde=<item id> pagina."""
+    if not session.get('admin'):
+        return jsonify({'error': 'No autorizado'}), 403
+    t = Trabajo.query.filter_by(id=lote_id, tipo='registrar_lote').first_or_404()
+    q = LoteFoto.query.filter(LoteFoto.trabajo_id == lote_id,
+                              LoteFoto.id > request.args.get('desde', 0, type=int))
+    if request.args.get('estado'):
+        q = q.filter(LoteFoto.estado == request.args['estado'])
+    items = q.order_by(LoteFoto.id).limit(MAX_FOTOS_LOTE).all()
+    return jsonify({'lote': _trabajo_dict(t),
+                    'fotos': [{'item_id': i.id, 'public_id': i.public_id,
+                               'key_original': i.key_original, 'estado': i.estado,
+                               'foto_id': i.foto_id, 'error': i.error} for i in items]})
+
+# ── SUBIDA DIRECTA browser -> Wasabi (multipart firmado) ─────────────────────
+# El original viaja UNA sola vez: del navegador al bucket, en partes que el
+# browser sube en paralelo. El dyno solo firma y después lee el objeto guardado
+# para generar preview y portada. El bucket necesita una regla CORS que permita
+# PUT desde el dominio del sitio y exponga el header ETag.
+PREFIJO_ORIGINALES = 'nacho_lingua/originales/'
+WASABI_PARTE_BYTES = 8 * 1024 * 1024
+MAX_ORIGINAL_BYTES = 200 * 1024 * 1024
+
+def _key_original_valida(key):
+    return isinstance(key, str) and key.startswith(PREFIJO_ORIGINALES) and '..' not in key
+
+@app.route('/wasabi/multipart/iniciar', methods=['POST'])
+def wasabi_multipart_iniciar():
+    """Abre un multipart upload y devuelve una URL firmada por parte."""
     if not session.get('admin'):
         return jsonify({'error': 'No autorizado'}), 403
     if not WASABI_ENABLED:
-        return jsonify({'error': 'Wasabi no esta configurado (faltan WASABI_ACCESS_KEY / WASABI_SECRET_KEY)'}), 400
+        return jsonify({'error': 'wasabi_no_configurado'}), 400
+    d = request.json or {}
+    try:
+        evento_id = int(d.get('evento_id'))
+        tamano    = int(d.get('tamano') or 0)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Faltan datos'}), 400
+    if not 0 < tamano <= MAX_ORIGINAL_BYTES:
+        return jsonify({'error': 'Tamaño invalido'}), 400
+    nombre = secure_filename(d.get('nombre') or '') or 'foto.jpg'
+    key    = f"{PREFIJO_ORIGINALES}evento_{evento_id}/{_secrets.token_hex(6)}_{nombre}"
+    client = get_wasabi_client()
+    try:
+        up = client.create_multipart_upload(Bucket=WASABI_BUCKET, Key=key,
+                                            ContentType=d.get('tipo') or 'image/jpeg')
+        partes = max(1, math.ceil(tamano / WASABI_PARTE_BYTES))
+        urls = [client.generate_presigned_url(
+                    'upload_part',
+                    Params={'Bucket': WASABI_BUCKET, 'Key': key,
+                            'UploadId': up['UploadId'], 'PartNumber': n},
+                    ExpiresIn=3600)
+                for n in range(1, partes + 1)]
+    except Exception as e:
+        print(f'✗ Error iniciando multipart: {e}')
+        return jsonify({'error': 'No se pudo iniciar la subida'}), 502
+    return jsonify({'key': key, 'upload_id': up['UploadId'],
+                    'parte_bytes': WASABI_PARTE_BYTES, 'urls': urls})
 
-    import urllib.request, time as _t3
-    movidas = fallidas = ya_wasabi = sin_original = 0
+@app.route('/wasabi/multipart/completar', methods=['POST'])
+def wasabi_multipart_completar():
+    if not session.get('admin'):
+        return jsonify({'error': 'No autorizado'}), 403
+    d = request.json or {}
+    key, upload_id = d.get('key'), d.get('upload_id')
+    if not _key_original_valida(key) or not upload_id:
+        return jsonify({'error': 'Faltan datos'}), 400
+    try:
+        partes = sorted(({'PartNumber': int(p['PartNumber']), 'ETag': str(p['ETag'])}
+                         for p in d.get('partes') or []), key=lambda p: p['PartNumber'])
+    except (TypeError, ValueError, KeyError):
+        return jsonify({'error': 'Partes invalidas'}), 400
+    if not partes:
+        return jsonify({'error': 'Partes invalidas'}), 400
+    try:
+        get_wasabi_client().complete_multipart_upload(
+            Bucket=WASABI_BUCKET, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': partes})
+    except Exception as e:
+        print(f'✗ Error completando multipart {key}: {e}')
+        return jsonify({'error': 'No se pudo completar la subida'}), 502
+    return jsonify({'ok': True, 'key': key})
 
-    for f in Foto.query.all():
-        orig = f.url_original or ''
-        if not orig or 'wasabi_pending' in orig:
-            sin_original += 1; continue
-        if 'wasabisys.com' in orig or (WASABI_BUCKET and WASABI_BUCKET in orig):
-            ya_wasabi += 1; continue
-        if 'res.cloudinary.com' not in orig and '/upload/' not in orig:
-            continue
+@app.route('/wasabi/multipart/abortar', methods=['POST'])
+def wasabi_multipart_abortar():
+    if not session.get('admin'):
+        return jsonify({'error': 'No autorizado'}), 403
+    d = request.json or {}
+    if not _key_original_valida(d.get('key')) or not d.get('upload_id'):
+        return jsonify({'error': 'Faltan datos'}), 400
+    try:
+        get_wasabi_client().abort_multipart_upload(Bucket=WASABI_BUCKET, Key=d['key'],
+                                                   UploadId=d['upload_id'])
+    except Exception as e:
+        print(f'✗ Error abortando multipart: {e}')
+    return jsonify({'ok': True})
+
+# ── GC DEL STORAGE (previews, portadas y originales de fotos borradas) ───────
+# Borrar un evento solo encola; esto elimina de a 1000 keys por DeleteObjects en
+# Wasabi y de a 100 public_ids por delete_resources en Cloudinary, y registra
+# cuántos bytes se recuperaron.
+GC_LOTE_WASABI     = 1000   # máximo de S3 DeleteObjects
+GC_LOTE_CLOUDINARY = 100    # máximo de la Admin API de Cloudinary
+GC_MAX_INTENTOS    = 5
+_GC_LOCK           = threading.Lock()
+
+def _ref_storage(url):
+    """(backend, ref) del objeto de storage detrás de una URL guardada, o None."""
+    if not url:
+        return None
+    if url.startswith('wasabi_pending:'):
+        return ('wasabi', url.split(':', 1)[1])
+    if es_url_wasabi(url):
+        key = key_wasabi_de_url(url)
+        return ('wasabi', key) if key else None
+    if 'res.cloudinary.com' in url:
+        pid = _cloudinary_public_id_de_url(url)
+        return ('cloudinary', pid) if pid else None
+    return None
+
+def encolar_borrado_storage(filas_urls):
+    """Encola (sin commit) los objetos detrás de cada URL. filas_urls: iterable de
+    tuplas de URLs. Devuelve cuántos objetos distintos se encolaron."""
+    objetos = {r for urls in filas_urls for r in map(_ref_storage, urls) if r}
+    if objetos:
+        db.session.execute(
+            pg_insert(ObjetoBorrar.__table__)
+            .values([{'backend': b, 'ref': ref, 'estado': 'pendiente', 'intentos': 0, 'bytes': 0}
+                     for b, ref in objetos])
+            .on_conflict_do_nothing())
+    return len(objetos)
+
+def _gc_borrar_wasabi(keys):
+    """Borra hasta 1000 keys en UN DeleteObjects. Devuelve {key: bytes} de las borradas."""
+    client, pedidas, tamanos = get_wasabi_client(), set(keys), {}
+    # Tamaños antes de borrar: un listado por carpeta (las de un evento comparten prefijo)
+    por_prefijo = {}
+    for k in keys:
+        por_prefijo.setdefault(k.rsplit('/', 1)[0] + '/' if '/' in k else '', []).append(k)
+    for prefijo, ks in por_prefijo.items():
         try:
-            with urllib.request.urlopen(orig) as resp:
-                raw = resp.read()
-            key  = f"nacho_lingua/originales/evento_{f.evento_id}/migrada_{f.id}_{int(_t3.time())}.jpg"
-            wurl = subir_bytes_a_wasabi(raw, key)
-            if not wurl:
-                fallidas += 1; continue
-            pid = _cloudinary_public_id_de_url(orig)
-            if pid:
+            if len(ks) <= 5:
+                for k in ks:
+                    try:
+                        tamanos[k] = client.head_object(Bucket=WASABI_BUCKET, Key=k)['ContentLength']
+                    except Exception:
+                        pass
+            else:
+                for pag in client.get_paginator('list_objects_v2').paginate(Bucket=WASABI_BUCKET, Prefix=prefijo):
+                    for o in pag.get('Contents', []):
+                        if o['Key'] in pedidas:
+                            tamanos[o['Key']] = o['Size']
+        except Exception as e:
+            print(f'[gc] no pude medir {prefijo}: {e}')
+    r = client.delete_objects(Bucket=WASABI_BUCKET,
+                              Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+    fallidas = {e['Key'] for e in r.get('Errors', [])}
+    return {k: tamanos.get(k, 0) for k in keys if k not in fallidas}
+
+def _gc_borrar_cloudinary(pids):
+    """Borra hasta 100 public_ids en UN delete_resources. Devuelve {public_id: bytes}."""
+    tamanos = {}
+    try:
+        r = cloudinary.api.resources_by_ids(pids, max_results=len(pids))
+        tamanos = {x['public_id']: x.get('bytes', 0) for x in r.get('resources', [])}
+    except Exception as e:
+        print(f'[gc] no pude medir en Cloudinary: {e}')
+    r = cloudinary.api.delete_resources(pids, invalidate=True)
+    return {pid: tamanos.get(pid, 0) for pid, st in (r.get('deleted') or {}).items()
+            if st in ('deleted', 'not_found')}
+
+def gc_storage():
+    """Vacía la cola de borrado. Las filas se toman con SKIP LOCKED: los dos workers
+    de gunicorn pueden correrlo a la vez sin borrar dos veces lo mismo."""
+    if not _GC_LOCK.acquire(blocking=False):
+        return
+    try:
+        backends = [('cloudinary', GC_LOTE_CLOUDINARY, _gc_borrar_cloudinary)]
+        if WASABI_ENABLED:
+            backends.append(('wasabi', GC_LOTE_WASABI, _gc_borrar_wasabi))
+        for backend, lote, borrar in backends:
+            while True:
+                filas = (ObjetoBorrar.query.filter_by(backend=backend, estado='pendiente')
+                         .order_by(ObjetoBorrar.id).limit(lote)
+                         .with_for_update(skip_locked=True).all())
+                if not filas:
+                    break
+                tomadas = len(filas)
+                if backend == 'wasabi':
+                    # Red de seguridad: nunca el original de una foto vendida que sigue viva
+                    vivos = {f'w:{f.ref}' for f in filas} | {f'p:{f.ref}' for f in filas}
+                    protegidos = {r[2:] for r, in db.session.query(Foto.ref_original)
+                                  .filter(Foto.ref_original.in_(vivos), _foto_vendida())}
+                    for f in filas:
+                        if f.ref in protegidos:
+                            f.estado = 'conservado'
+                    filas = [f for f in filas if f.ref not in protegidos]
                 try:
-                    cloudinary.uploader.destroy(pid, invalidate=True)
+                    borrados = borrar([f.ref for f in filas]) if filas else {}
                 except Exception as e:
-                    print(f'[migrar-wasabi] no pude borrar {pid}: {e}')
-            f.url_original = wurl
-            db.session.commit()
-            movidas += 1
-        except Exception as e:
-            print(f'[migrar-wasabi] foto {f.id} fallo: {e}')
-            fallidas += 1
+                    print(f'[gc] {backend}: {e}')
+                    borrados = {}
+                for f in filas:
+                    if f.ref in borrados:
+                        f.estado, f.bytes, f.borrado_en = 'borrado', borrados[f.ref], db.func.now()
+                    else:
+                        f.intentos = (f.intentos or 0) + 1
+                        if f.intentos >= GC_MAX_INTENTOS:
+                            f.estado = 'error'
+                db.session.commit()
+                if borrados:
+                    print(f'[gc] {backend}: {len(borrados)} objeto(s), '
+                          f'{sum(borrados.values()) // 1024} KB recuperados')
+                if tomadas < lote or (filas and not borrados):
+                    break
+    finally:
+        _GC_LOCK.release()
+
+@app.route('/admin/gc', methods=['GET'])
+def ver_gc():
+    """Progreso del GC: objetos por backend/estado y bytes recuperados."""
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    filas = (db.session.query(ObjetoBorrar.backend, ObjetoBorrar.estado, db.func.count(ObjetoBorrar.id),
+                              db.func.coalesce(db.func.sum(ObjetoBorrar.bytes), 0))
+             .group_by(ObjetoBorrar.backend, ObjetoBorrar.estado).all())
+    out = {}
+    for backend, estado, n, b in filas:
+        d = out.setdefault(backend, {'pendiente': 0, 'borrado': 0, 'error': 0, 'conservado': 0,
+                                      'bytes_recuperados': 0})
+        d[estado] = n
+        d['bytes_recuperados'] += int(b)
+    return jsonify(out)
+
+@app.route('/admin/gc/ejecutar', methods=['POST'])
+def ejecutar_gc():
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    def correr():
+        with app.app_context():
+            gc_storage()
+    threading.Thread(target=correr, daemon=True).start()
+    return jsonify({'ok': True}), 202
+
+# ── ADMIN: trabajos en background ────────────────────────────────────────────
+@app.route('/admin/trabajos', methods=['GET'])
+def ver_trabajos():
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    q = Trabajo.query
+    if request.args.get('tipo'):
+        q = q.filter_by(tipo=request.args['tipo'])
+    return jsonify([_trabajo_dict(t) for t in q.order_by(Trabajo.id.desc()).limit(20).all()])
+
+@app.route('/admin/trabajos/<int:tid>', methods=['GET'])
+def ver_trabajo(tid):
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    return jsonify(_trabajo_dict(Trabajo.query.get_or_404(tid)))
 
-    return jsonify({'ok': True, 'movidas': movidas, 'ya_en_wasabi': ya_wasabi,
-                    'fallidas': fallidas, 'sin_original': sin_original})
+@app.route('/admin/trabajos/<int:tid>/cancelar', methods=['POST'])
+def cancelar_trabajo(tid):
+    if not session.get('admin'): return jsonify({'error': 'No autorizado'}), 403
+    n = Trabajo.query.filter(Trabajo.id == tid, Trabajo.estado.in_(('pendiente', 'corriendo'))) \
+                     .update({'estado': 'cancelado', 'terminado_en': db.func.now()}, synchronize_session=False)
+    db.session.commit()
+    return jsonify({'ok': bool(n)})
+
+# ── MIGRACIÓN Cloudinary -> Wasabi (trabajo reanudable) ──────────────────────
+MIGRAR_CONCURRENCIA = int(os.environ.get('MIGRAR_CONCURRENCIA', 4))
+
+def _migrar_una(foto_id, evento_id, orig):
+    """Copia UN original de Cloudinary a Wasabi en streaming (corre en el pool, sin BD).
+    La key es fija por foto: si se reintenta, pisa el mismo objeto en vez de duplicarlo."""
+    key = f"nacho_lingua/originales/evento_{evento_id}/migrada_{foto_id}.jpg"
+    resp = http_pedir('descarga', 'GET', orig, timeout=60, stream=True)
+    try:
+        url, n = subir_stream_a_wasabi(resp, key)
+    finally:
+        http_soltar(resp)
+    return foto_id, orig, url, n
+
+@trabajo_handler('migrar_wasabi')
+def _trabajo_migrar_wasabi(tid, params):
+    cursor = Trabajo.query.get(tid).cursor or 0
+    lote   = MIGRAR_CONCURRENCIA * 4
+    with ThreadPoolExecutor(max_workers=MIGRAR_CONCURRENCIA) as pool:
+        while True:
+            filas = (db.session.query(Foto.id, Foto.evento_id, Foto.ref_original)
+                     .filter(Foto.id > cursor).order_by(Foto.id).limit(lote).all())
+            if not filas:
+                return
+            a_mover, saltados = [], 0
+            for fid, evid, ref in filas:
+                orig = url_de_ref(ref) or ''
+                if (not orig or 'wasabi_pending' in orig or es_url_wasabi(orig)
+                        or ('res.cloudinary.com' not in orig and '/upload/' not in orig)):
+                    saltados += 1
+                else:
+                    a_mover.append((fid, evid, orig))
+
+            movidas = fallidas = nbytes = 0
+            a_borrar = []
+            for fut in [pool.submit(_migrar_una, *x) for x in a_mover]:
+                try:
+                    fid, orig, url, n = fut.result()
+                except Exception as e:
+                    print(f'[migrar-wasabi] fallo: {e}')
+                    fallidas += 1; continue
+                nbytes += n
+                if not url:
+                    fallidas += 1; continue
+                # Solo si la foto sigue apuntando al mismo original (no la borraron ni cambiaron)
+                if Foto.query.filter_by(id=fid, ref_original=ref_de_url(orig)) \
+                             .update({'ref_original': ref_de_url(url)}, synchronize_session=False):
+                    movidas += 1
+                    a_borrar.append(orig)
+                else:
+                    saltados += 1
+
+            # Fotos actualizadas + cursor en la misma transacción: al reanudar no se repite nada
+            cursor = filas[-1][0]
+            seguir = avanzar_trabajo(tid, cursor=cursor, hechos=movidas, fallidos=fallidas,
+                                     saltados=saltados, bytes=nbytes)
+
+            # Recién con la BD confirmada se borra el original de Cloudinary
+            pids = [p for p in (_cloudinary_public_id_de_url(o) for o in a_borrar) if p]
+            if pids:
+                try:
+                    cloudinary.api.delete_resources(pids, invalidate=True)
+                except Exception as e:
+                    print(f'[migrar-wasabi] no pude borrar {len(pids)} de Cloudinary: {e}')
+            if not seguir:
+                return
+
+@app.route('/admin/migrar-wasabi', methods=['POST'])
+def migrar_wasabi():
+    """Mueve a Wasabi los originales que hoy estan en Cloudinary y los borra de
+    Cloudinary. Corre como trabajo en background (concurrente y reanudable); el
+    progreso se consulta en /admin/trabajos/<id>. Solo admin."""
+    if not session.get('admin'):
+        return jsonify({'error': 'No autorizado'}), 403
+    if not WASABI_ENABLED:
+        return jsonify({'error': 'Wasabi no esta configurado (faltan WASABI_ACCESS_KEY / WASABI_SECRET_KEY)'}), 400
+
+    t = trabajo_activo('migrar_wasabi') or lanzar_trabajo('migrar_wasabi', total=Foto.query.count())
+    return jsonify({'ok': True, 'trabajo': _trabajo_dict(t)}), 202
 
 
 @app.route('/admin/generar-covers', methods=['POST'])
@@ -2133,7 +5054,6 @@ def generar_covers():
     """Genera la portada limpia (sin marca) de las fotos que aun no la tienen."""
     if not session.get('admin'):
         return jsonify({'error': 'No autorizado'}), 403
-    import urllib.request
     generadas = fallidas = ya = sin_original = 0
     errores = []
     for f in Foto.query.all():
@@ -2143,22 +5063,17 @@ def generar_covers():
             sin_original += 1; continue
         try:
             srcu = get_download_url(f.url_original)
-            req  = urllib.request.Request(srcu, headers={'User-Agent': 'Mozilla/5.0'})
-            with urllib.request.urlopen(req, timeout=60) as resp:
-                raw = resp.read()
+            raw  = http_pedir('descarga', 'GET', srcu, headers={'User-Agent': 'Mozilla/5.0'}, timeout=60).data
             u = _generar_cover_limpia(raw)
             if u:
-                f.url_cover = u; db.session.commit(); generadas += 1
+                f.url_cover, f.version = u, sellar_catalogo(); db.session.commit(); generadas += 1
             else:
                 fallidas += 1
                 if len(errores) < 5: errores.append(f'foto {f.id}: la generacion devolvio None')
-        except urllib.error.HTTPError as e:
+        except ErrorHTTP as e:
             db.session.rollback(); fallidas += 1
-            cuerpo = ''
-            try: cuerpo = e.read().decode('utf-8', 'ignore')[:350]
-            except Exception: pass
             if len(errores) < 3:
-                errores.append(f'foto {f.id}: HTTP {e.code} -> {cuerpo}')
+                errores.append(f'foto {f.id}: HTTP {e.code} -> {e.cuerpo[:350]}')
         except Exception as e:
             db.session.rollback(); fallidas += 1
             if len(errores) < 3:
@@ -2167,39 +5082,80 @@ def generar_covers():
                     'fallidas': fallidas, 'sin_original': sin_original, 'errores': errores})
 
 
+def _derivada_ia_una(foto_id, evento_id, url_original):
+    raw = http_pedir('descarga', 'GET', get_download_url(url_original),
+                     headers={'User-Agent': 'Mozilla/5.0'}, timeout=60).data
+    return foto_id, len(raw), _generar_derivada_ia(raw, f"{PREFIJO_IA}evento_{evento_id}/foto_{foto_id}.jpg")
+
+@trabajo_handler('derivadas_ia')
+def _trabajo_derivadas_ia(tid, params):
+    cursor = Trabajo.query.get(tid).cursor or 0
+    with ThreadPoolExecutor(max_workers=MIGRAR_CONCURRENCIA) as pool:
+        while True:
+            filas = (db.session.query(Foto.id, Foto.evento_id, Foto.ref_original)
+                     .filter(Foto.id > cursor, Foto.key_ia.is_(None), Foto.evento_id.isnot(None))
+                     .order_by(Foto.id).limit(MIGRAR_CONCURRENCIA * 4).all())
+            if not filas:
+                return
+            hechas = fallidas = saltadas = nbytes = 0
+            futs = []
+            for fid, evid, ref in filas:
+                if not ref or ref.startswith('p:'):
+                    saltadas += 1
+                else:
+                    futs.append(pool.submit(_derivada_ia_una, fid, evid, url_de_ref(ref)))
+            for fut in futs:
+                try:
+                    fid, n, key = fut.result()
+                except Exception as e:
+                    print(f'[derivadas-ia] fallo: {e}')
+                    fallidas += 1; continue
+                nbytes += n
+                if key and Foto.query.filter_by(id=fid, key_ia=None) \
+                                     .update({'key_ia': key}, synchronize_session=False):
+                    hechas += 1
+                else:
+                    fallidas += 1
+            cursor = filas[-1][0]
+            if not avanzar_trabajo(tid, cursor=cursor, hechos=hechas, fallidos=fallidas,
+                                   saltados=saltadas, bytes=nbytes):
+                return
+
+@app.route('/admin/generar-derivadas-ia', methods=['POST'])
+def generar_derivadas_ia():
+    """Genera la copia para la IA de las fotos subidas antes de que existiera.
+    Trabajo en background reanudable; progreso en /admin/trabajos/<id>."""
+    if not session.get('admin'):
+        return jsonify({'error': 'No autorizado'}), 403
+    if not WASABI_ENABLED:
+        return jsonify({'error': 'Wasabi no esta configurado (faltan WASABI_ACCESS_KEY / WASABI_SECRET_KEY)'}), 400
+    t = trabajo_activo('derivadas_ia') or lanzar_trabajo(
+        'derivadas_ia', total=Foto.query.filter(Foto.key_ia.is_(None), Foto.evento_id.isnot(None)).count())
+    return jsonify({'ok': True, 'trabajo': _trabajo_dict(t)}), 202
+
 @app.route('/admin/diag-wasabi', methods=['GET'])
 def diag_wasabi():
     """Diagnostico: intenta bajar el original de la primera foto y devuelve el detalle."""
     if not session.get('admin'):
         return jsonify({'error': 'No autorizado'}), 403
-    import urllib.request
     f = Foto.query.first()
     if not f:
         return jsonify({'error': 'no hay fotos'})
     info = {'foto_id': f.id, 'url_original': f.url_original, 'bucket': WASABI_BUCKET,
             'region': WASABI_REGION, 'endpoint': WASABI_ENDPOINT, 'wasabi_enabled': WASABI_ENABLED}
     try:
-        ruta = urllib.parse.urlparse(f.url_original or '').path.lstrip('/')
-        if WASABI_BUCKET and ruta.startswith(WASABI_BUCKET + '/'):
-            key = ruta[len(WASABI_BUCKET) + 1:]
-        else:
-            key = ruta.split('/', 1)[1] if '/' in ruta else ruta
+        key = key_wasabi_de_url(f.url_original)
         info['key'] = key
         presigned = get_wasabi_presigned_url(key)
         info['presigned_ok']   = bool(presigned)
         info['presigned_host'] = urllib.parse.urlparse(presigned).netloc if presigned else None
         try:
-            req = urllib.request.Request(presigned, headers={'User-Agent': 'Mozilla/5.0'})
-            with urllib.request.urlopen(req, timeout=30) as resp:
-                data = resp.read()
-                info['download_status'] = resp.status
-                info['download_bytes']  = len(data)
-        except urllib.error.HTTPError as e:
-            cuerpo = ''
-            try: cuerpo = e.read().decode('utf-8', 'ignore')[:450]
-            except Exception: pass
+            resp = http_pedir('descarga', 'GET', presigned, headers={'User-Agent': 'Mozilla/5.0'}, timeout=30)
+            info['download_status'] = resp.status
+            info['download_bytes']  = len(resp.data)
+        except ErrorHTTP as e:
             info['download_error'] = f'HTTP {e.code}'
-            info['wasabi_dice']    = cuerpo
+            info['wasabi_dice']    = e.cuerpo[:450]
         except Exception as e:
             info['download_error'] = f'{type(e).__name__}: {str(e)[:250]}'
     except Exception as e:
@@ -2207,5 +5163,64 @@ def diag_wasabi():
     return jsonify(info)
 
 
+@app.route('/admin/indice-fotos', methods=['GET', 'POST'])
+def ver_indice_fotos():
+    """Tamaño y versión del índice de fotos en memoria de este worker. POST lo
+    vuelve a cargar entero (si se tocó la base por fuera de la app)."""
+    if not session.get('admin'):
+        return jsonify({'error': 'No autorizado'}), 403
+    if request.method == 'POST':
+        with INDICE_FOTOS.lock:
+            INDICE_FOTOS.version = None
+    t0 = _time.perf_counter()
+    INDICE_FOTOS.actualizar()
+    return jsonify({**INDICE_FOTOS.stats(), 'ms': round((_time.perf_counter() - t0) * 1000, 1)})
+
+@app.route('/admin/http-stats', methods=['GET'])
+def ver_http_stats():
+    """Latencia y errores de las integraciones salientes (este worker)."""
+    if not session.get('admin'):
+        return jsonify({'error': 'No autorizado'}), 403
+    return jsonify(http_stats())
+
+
+# Backfill único de los rollups de ventas (la primera vez que arranca con ellos)
+with app.app_context():
+    # El archivo de compras copia columna por columna: si las tablas divergen,
+    # mejor no arrancar que perder datos (o fallar) al archivar
+    diferencias = verificar_compra_archivada()
+    if diferencias:
+        raise RuntimeError('compra_archivada no coincide con compra: ' + '; '.join(diferencias))
+    try:
+        if not VentaDia.query.first() and Compra.query.filter_by(estado='approved').first():
+            reconstruir_rollups()
+    except Exception as e:
+        db.session.rollback()
+        print(f'[migracion] rollups de ventas: {e}')
+    # ídem para el índice jugador -> fotos
+    try:
+        if not IndiceJugador.query.first() and FotoEtiqueta.query.first():
+            reconstruir_indice_jugadores()
+    except Exception as e:
+        db.session.rollback()
+        print(f'[migracion] índice de jugadores: {e}')
+
+if BACKGROUND_WORKERS:
+    iniciar_periodico('vigia-trabajos', _vigia_trabajos, 30)
+    iniciar_periodico('gc-storage', gc_storage, 120)
+    iniciar_periodico('entregas', drenar_entregas, 5, _ENTREGAS_DESPERTAR)
+    iniciar_periodico('mp-inbox', procesar_notificaciones_mp, 5, _MP_INBOX_DESPERTAR)
+    iniciar_periodico('archivo-compras', archivar_compras, 3600)
+    iniciar_periodico('podar-bajas', podar_bajas_catalogo, 3600)
+    # La carga inicial del índice de fotos (segundos con ~1M fotos) se hace acá y
+    # no en el primer checkout de cada worker
+    def _precargar_indice():
+        try:
+            with app.app_context():
+                indice_fotos()
+        except Exception as e:
+            print(f'[indice-fotos] precarga: {e}')
+    threading.Thread(target=_precargar_indice, name='indice-fotos', daemon=True).start()
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,323 @@
+"""
+Prueba de carga del circuito de venta completo, sin tocar servicios reales.
+
+    /crear-orden -> preferencia MP -> /mp-webhook -> inbox -> outbox de entregas
+                 -> Resend / Meta WhatsApp / CallMeBot
+
+Levanta stand-ins HTTP locales de Mercado Pago, Resend, Meta Graph y CallMeBot
+(cada uno con su latencia y tasa de error configurables), sirve la app Flask REAL
+con un pool de hilos acotado (como gunicorn --threads) y lanza muchas compras
+concurrentes. El stand-in de MP manda el webhook de pago aprobado a la app, igual
+que MP en producción (y lo puede repetir, como hacen sus reintentos).
+
+Reporta: órdenes/seg, latencia de /crear-orden y del ack del webhook,
+percentiles webhook -> email / WhatsApp entregado, hilos vivos y saturación del
+pool de conexiones de la base.
+
+USAR CONTRA UNA BASE DESCARTABLE: crea un evento, fotos y compras de prueba.
+
+    DATABASE_URL=postgresql://.../nl_carga python carga_checkout.py \\
+        --ordenes 500 --clientes 40 --latencia-mp 300 --error-resend 0.05
+"""
+import os, sys, json, time, random, threading, argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+import urllib3
+
+
+def _pct(valores, p):
+    if not valores:
+        return None
+    v = sorted(valores)
+    return v[min(len(v) - 1, int(round(p / 100 * (len(v) - 1))))]
+
+def _resumen_ms(valores):
+    if not valores:
+        return 'sin datos'
+    return (f'n={len(valores)}  p50={_pct(valores, 50):.0f}ms  p95={_pct(valores, 95):.0f}ms  '
+            f'p99={_pct(valores, 99):.0f}ms  max={max(valores):.0f}ms')
+
+
+# ── STAND-INS DE LOS PROVEEDORES ──────────────────────────────────────────────
+class StandIn:
+    """Servidor HTTP local que imita a un proveedor: cada pedido espera `latencia_ms`
+    (±50%) y falla con probabilidad `error` (500, o 429 si el proveedor limita)."""
+    def __init__(self, nombre, latencia_ms, error, codigo_error=500):
+        self.nombre, self.latencia, self.error, self.codigo_error = nombre, latencia_ms, error, codigo_error
+        self.pedidos = self.errores = 0
+        self.lock    = threading.Lock()
+        stand_in     = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def log_message(self, *a): pass
+            def _responder(self, codigo, cuerpo):
+                data = json.dumps(cuerpo).encode() if not isinstance(cuerpo, bytes) else cuerpo
+                self.send_response(codigo)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            def _atender(self):
+                largo  = int(self.headers.get('Content-Length') or 0)
+                cuerpo = self.rfile.read(largo) if largo else b''
+                with stand_in.lock:
+                    stand_in.pedidos += 1
+                if stand_in.latencia:
+                    time.sleep(stand_in.latencia * random.uniform(0.5, 1.5) / 1000)
+                if random.random() < stand_in.error:
+                    with stand_in.lock:
+                        stand_in.errores += 1
+                    return self._responder(stand_in.codigo_error, {'error': 'stand-in: error inyectado'})
+                datos = json.loads(cuerpo) if cuerpo else None
+                codigo, resp = stand_in.atender(self.command, self.path, datos)
+                self._responder(codigo, resp)
+            do_GET = do_POST = do_PUT = _atender
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, name=f'standin-{nombre}', daemon=True).start()
+
+    def atender(self, metodo, ruta, datos):
+        return 200, {}
+
+
+class MercadoPagoFalso(StandIn):
+    """Preferencias y pagos. Al crear una preferencia simula que el cliente paga:
+    después de `pago_ms` manda el webhook (y `duplicados` copias más)."""
+    def __init__(self, latencia_ms, error, pago_ms, duplicados):
+        self.pago_ms, self.duplicados = pago_ms, duplicados
+        self.pagos, self.webhook_en, self.ack_ms = {}, {}, []
+        self.http  = urllib3.PoolManager(maxsize=64)
+        self.envio = ThreadPoolExecutor(max_workers=32, thread_name_prefix='mp-webhook')
+        self._seq  = 0
+        super().__init__('mercadopago', latencia_ms, error)
+
+    def atender(self, metodo, ruta, datos):
+        if metodo == 'POST' and ruta.startswith('/checkout/preferences'):
+            with self.lock:
+                self._seq += 1
+                pago = 900000 + self._seq
+            ref = datos.get('external_reference')
+            self.pagos[pago] = {'id': pago, 'status': 'approved', 'external_reference': ref,
+                                'preference_id': f'pref-{pago}'}
+            t = threading.Timer(self.pago_ms / 1000, self.envio.submit,
+                                args=(self._notificar, datos['notification_url'], pago, ref))
+            t.daemon = True
+            t.start()
+            return 201, {'id': f'pref-{pago}', 'init_point': f'{self.url}/checkout/{pago}'}
+        if metodo == 'GET' and ruta.startswith('/v1/payments/'):
+            pago = self.pagos.get(int(ruta.rsplit('/', 1)[-1].split('?')[0]))
+            return (200, pago) if pago else (404, {'message': 'payment not found'})
+        return 404, {'message': 'not found'}
+
+    def _notificar(self, url, pago, ref):
+        cuerpo = json.dumps({'type': 'payment', 'action': 'payment.created', 'data': {'id': str(pago)}})
+        self.webhook_en[ref] = time.perf_counter()
+        for _ in range(1 + self.duplicados):
+            t0 = time.perf_counter()
+            try:
+                self.http.request('POST', url, body=cuerpo, headers={'Content-Type': 'application/json'},
+                                  timeout=30, retries=False)
+                with self.lock:
+                    self.ack_ms.append((time.perf_counter() - t0) * 1000)
+            except Exception as e:
+                print(f'[stand-in mp] webhook falló: {e}')
+
+
+class ResendFalso(StandIn):
+    def __init__(self, latencia_ms, error):
+        self.recibido = {}    # email -> perf_counter de la primera entrega
+        super().__init__('resend', latencia_ms, error, codigo_error=429)
+
+    def atender(self, metodo, ruta, datos):
+        mensajes = datos if ruta.startswith('/emails/batch') else [datos]
+        ahora = time.perf_counter()
+        for m in mensajes:
+            for to in m.get('to', []):
+                self.recibido.setdefault(to, ahora)
+        if ruta.startswith('/emails/batch'):
+            return 200, {'data': [{'id': f'em-{i}'} for i in range(len(mensajes))]}
+        return 200, {'id': 'em-1'}
+
+
+class MetaFalso(StandIn):
+    def __init__(self, latencia_ms, error):
+        self.recibido = {}    # número -> perf_counter
+        super().__init__('meta', latencia_ms, error)
+
+    def atender(self, metodo, ruta, datos):
+        self.recibido.setdefault(datos.get('to'), time.perf_counter())
+        return 200, {'messages': [{'id': 'wamid.carga'}]}
+
+
+class CallMeBotFalso(StandIn):
+    def atender(self, metodo, ruta, datos):
+        return 200, b'Message queued'
+
+
+# ── APP REAL CON HILOS ACOTADOS (como gunicorn --threads N) ───────────────────
+class _SinLog(WSGIRequestHandler):
+    def log_message(self, *a): pass
+
+class ServidorAcotado(WSGIServer):
+    def __init__(self, app, hilos):
+        super().__init__(('127.0.0.1', 0), _SinLog)
+        self.set_app(app)
+        self.pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='wsgi')
+        self.url  = f'http://127.0.0.1:{self.server_address[1]}'
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._atender, request, client_address)
+
+    def _atender(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('--ordenes',  type=int, default=200, help='compras a crear')
+    ap.add_argument('--clientes', type=int, default=20,  help='clientes concurrentes')
+    ap.add_argument('--hilos',    type=int, default=8,   help='hilos de la app (gunicorn --threads)')
+    ap.add_argument('--fotos',    type=int, default=50,  help='fotos del evento de prueba')
+    ap.add_argument('--pago-ms',  type=int, default=200, help='demora entre preferencia y webhook')
+    ap.add_argument('--webhooks-duplicados', type=int, default=1, help='copias extra de cada webhook')
+    ap.add_argument('--espera',   type=int, default=120, help='seg. máximos esperando las entregas')
+    for srv, lat in (('mp', 150), ('resend', 120), ('meta', 150), ('callmebot', 300)):
+        ap.add_argument(f'--latencia-{srv}', type=int, default=lat, help=f'ms de latencia de {srv}')
+        ap.add_argument(f'--error-{srv}', type=float, default=0.0, help=f'tasa de error de {srv} (0-1)')
+    ap.add_argument('--json', action='store_true', help='imprimir el resultado como JSON')
+    args = ap.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        sys.exit('Definí DATABASE_URL apuntando a una base DESCARTABLE.')
+
+    mp       = MercadoPagoFalso(args.latencia_mp, args.error_mp, args.pago_ms, args.webhooks_duplicados)
+    resend   = ResendFalso(args.latencia_resend, args.error_resend)
+    meta     = MetaFalso(args.latencia_meta, args.error_meta)
+    cmb      = CallMeBotFalso('callmebot', args.latencia_callmebot, args.error_callmebot)
+
+    # La app se configura por entorno ANTES de importarla
+    os.environ.update({
+        'BACKGROUND_WORKERS': '1',
+        'MP_ACCESS_TOKEN':    'TEST-carga',
+        'RESEND_API_KEY':     'carga',   'RESEND_API_URL': resend.url,
+        'META_WA_TOKEN':      'carga',   'META_WA_PHONE_ID': '100000', 'META_GRAPH_URL': meta.url,
+        'CMB_PHONE':          '5490000', 'CMB_APIKEY': 'carga',      'CMB_API_URL': cmb.url,
+    })
+    os.environ.pop('MP_WEBHOOK_SECRET', None)
+    import mercadopago.config.config as mp_config
+    mp_config.Config.api_base_url = property(lambda self: mp.url)   # el SDK real, contra el stand-in
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as A
+
+    with A.app.app_context():
+        # Con el sello del catálogo, como lo hace la app: el índice en memoria
+        # (ya cargado al importar) solo trae las filas con versión nueva
+        v  = A.sellar_catalogo()
+        ev = A.Evento(titulo=f'Carga {time.strftime("%Y-%m-%d %H:%M:%S")}', deporte='carga', version=v)
+        A.db.session.add(ev); A.db.session.flush()
+        fotos = [A.Foto(evento_id=ev.id, url_preview=f'https://example.com/p/{i}.jpg',
+                        url_original=f'https://example.com/o/{i}.jpg', version=v) for i in range(args.fotos)]
+        A.db.session.add_all(fotos); A.db.session.commit()
+        ids_fotos = [f.id for f in fotos]
+        motor     = A.db.engine
+    capacidad = motor.pool.size() + motor.pool._max_overflow
+
+    servidor = ServidorAcotado(A.app, args.hilos)
+    threading.Thread(target=servidor.serve_forever, name='wsgi-accept', daemon=True).start()
+
+    # Muestreo de hilos y del pool de la base
+    muestras, fin_muestreo = [], threading.Event()
+    def muestrear():
+        while not fin_muestreo.wait(0.05):
+            muestras.append((threading.active_count(), motor.pool.checkedout()))
+    threading.Thread(target=muestrear, name='muestreo', daemon=True).start()
+
+    http = urllib3.PoolManager(maxsize=args.clientes)
+    orden_ms, errores_orden, clientes = [], [], {}
+    lock = threading.Lock()
+    def comprar(n):
+        email = f'carga{n}@example.com'
+        wa    = f'351{n:07d}'
+        cuerpo = {'foto_ids': random.sample(ids_fotos, random.randint(1, min(5, len(ids_fotos)))),
+                  'email': email, 'nombre': f'Carga {n}', 'whatsapp': wa}
+        t0 = time.perf_counter()
+        try:
+            r = http.request('POST', f'{servidor.url}/crear-orden', body=json.dumps(cuerpo),
+                             headers={'Content-Type': 'application/json'}, timeout=60, retries=False)
+            ms = (time.perf_counter() - t0) * 1000
+            d  = json.loads(r.data or b'{}')
+            with lock:
+                if r.status == 200 and d.get('compra_id'):
+                    orden_ms.append(ms)
+                    clientes[str(d['compra_id'])] = (email, A.normalizar_wa_ar(wa))
+                else:
+                    errores_orden.append(f'{r.status}: {d.get("error")}')
+        except Exception as e:
+            with lock:
+                errores_orden.append(f'{type(e).__name__}: {e}')
+
+    print(f'▶ {args.ordenes} órdenes con {args.clientes} clientes contra {args.hilos} hilos de app...')
+    t_inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clientes, thread_name_prefix='cliente') as pool:
+        list(pool.map(comprar, range(args.ordenes)))
+    t_ordenes = time.perf_counter() - t_inicio
+
+    # Esperar a que todas las compras creadas reciban su email
+    limite = time.perf_counter() + args.espera
+    while time.perf_counter() < limite:
+        if all(email in resend.recibido for email, _ in clientes.values()):
+            break
+        time.sleep(0.2)
+    t_total = time.perf_counter() - t_inicio
+    fin_muestreo.set()
+
+    lat_email, lat_wa = [], []
+    for ref, (email, wa) in clientes.items():
+        t_wh = mp.webhook_en.get(ref)
+        if t_wh is None:
+            continue
+        if email in resend.recibido:
+            lat_email.append((resend.recibido[email] - t_wh) * 1000)
+        if wa in meta.recibido:
+            lat_wa.append((meta.recibido[wa] - t_wh) * 1000)
+
+    hilos    = [h for h, _ in muestras] or [threading.active_count()]
+    conexion = [c for _, c in muestras] or [0]
+    saturado = sum(1 for c in conexion if c >= capacidad)
+    resultado = {
+        'ordenes_ok':            len(orden_ms),
+        'ordenes_error':         len(errores_orden),
+        'ordenes_por_seg':       round(len(orden_ms) / t_ordenes, 1) if t_ordenes else 0,
+        'crear_orden':           _resumen_ms(orden_ms),
+        'webhook_ack':           _resumen_ms(mp.ack_ms),
+        'webhook_a_email':       _resumen_ms(lat_email),
+        'webhook_a_whatsapp':    _resumen_ms(lat_wa),
+        'emails_entregados':     f'{len(lat_email)}/{len(clientes)}',
+        'whatsapp_entregados':   f'{len(lat_wa)}/{len(clientes)}',
+        'duracion_seg':          round(t_total, 1),
+        'hilos_max':             max(hilos),
+        'pool_bd_max_en_uso':    f'{max(conexion)}/{capacidad}',
+        'pool_bd_saturado_pct':  round(100 * saturado / len(conexion), 1),
+        'stand_ins':             {s.nombre: {'pedidos': s.pedidos, 'errores_inyectados': s.errores}
+                                  for s in (mp, resend, meta, cmb)},
+        'errores_orden_ejemplos': errores_orden[:5],
+    }
+    if args.json:
+        print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    else:
+        for k, v in resultado.items():
+            print(f'  {k:<24} {v}')
+
+
+if __name__ == '__main__':
+    main()
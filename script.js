@@ -116,6 +116,7 @@ function calcularTotalCarrito() {
 
 // ─── ESTADO ───────────────────────────────────────────────────────────────────
 let eventosData     = [];
+let catalogoVersion = null;     // versión del catálogo que tiene eventosData
 let eventoActual    = null;
 let carrito         = new Map();
 let isAdmin         = false;
@@ -271,15 +272,91 @@ function initBackToTop() {
     btn.addEventListener('click', () => window.scrollTo({ top: 0, behavior: 'smooth' }));
 }
 
+// ─── CATÁLOGO INCREMENTAL ────────────────────────────────────────────────────
+// La primera vez se baja el árbol entero con su versión (X-Catalogo-Version) y se
+// guarda en localStorage; después solo se piden los cambios desde esa versión.
+async function sincronizarEventos() {
+    if (catalogoVersion == null) {
+        try {
+            const g = JSON.parse(localStorage.getItem('nl_catalogo') || 'null');
+            if (g && g.version && Array.isArray(g.eventos)) { eventosData = g.eventos; catalogoVersion = g.version; }
+        } catch {}
+    }
+    if (catalogoVersion != null) {
+        const r = await fetch(`/catalogo/cambios?desde=${catalogoVersion}`);
+        const c = r.ok ? await r.json() : { completo: true };
+        if (!c.completo) {
+            if (c.version !== catalogoVersion) { aplicarCambiosCatalogo(c); guardarCatalogo(); }
+            return;
+        }
+    }
+    const r = await fetch('/obtener-eventos');
+    eventosData     = await r.json();
+    catalogoVersion = Number(r.headers.get('X-Catalogo-Version')) || null;
+    guardarCatalogo();
+}
+
+function guardarCatalogo() {
+    try {
+        localStorage.setItem('nl_catalogo', JSON.stringify({ version: catalogoVersion, eventos: eventosData }));
+    } catch {
+        localStorage.removeItem('nl_catalogo');   // no entra (cuota): la próxima visita baja todo
+    }
+}
+
+function aplicarCambiosCatalogo(c) {
+    const porId = new Map();
+    (function indexar(lista) {
+        lista.forEach(ev => { porId.set(ev.id, ev); indexar(ev.subcarpetas || []); });
+    })(eventosData);
+    c.eventos_borrados.forEach(id => porId.delete(id));
+    c.eventos.forEach(e => {
+        const ev = porId.get(e.id) || { fotos: [] };
+        Object.assign(ev, e);             // los cambios no traen fotos ni subcarpetas
+        porId.set(e.id, ev);
+    });
+    if (c.fotos.length || c.fotos_borradas.length) {
+        const fuera = new Set([...c.fotos_borradas, ...c.fotos.map(f => f.id)]);
+        porId.forEach(ev => { ev.fotos = (ev.fotos || []).filter(f => !fuera.has(f.id)); });
+        c.fotos.forEach(f => {
+            const ev = porId.get(f.evento_id);
+            if (ev) ev.fotos.push({ id: f.id, url_preview: f.url_preview, precio: f.precio });
+        });
+        new Set(c.fotos.map(f => f.evento_id)).forEach(id => porId.get(id)?.fotos.sort((a, b) => a.id - b.id));
+    }
+    // Rearmar el árbol como lo arma /obtener-eventos (raíces nuevas primero)
+    const raices = [];
+    porId.forEach(ev => { ev.subcarpetas = []; });
+    porId.forEach(ev => {
+        const padre = ev.parent_id != null ? porId.get(ev.parent_id) : null;
+        (padre ? padre.subcarpetas : raices).push(ev);
+    });
+    raices.sort((a, b) => b.id - a.id);
+    porId.forEach(ev => ev.subcarpetas.sort((a, b) => a.id - b.id));
+    eventosData     = raices;
+    catalogoVersion = c.version;
+
+    // Reglas de precios de los eventos que cambiaron (y la config general si cambió)
+    if (NL_CONFIG) {
+        NL_CONFIG.reglas_eventos = NL_CONFIG.reglas_eventos || {};
+        NL_CONFIG.parents        = NL_CONFIG.parents || {};
+        c.eventos_borrados.forEach(id => { delete NL_CONFIG.reglas_eventos[id]; delete NL_CONFIG.parents[id]; });
+        c.eventos.forEach(e => {
+            if (e.regla) NL_CONFIG.reglas_eventos[e.id] = e.regla; else delete NL_CONFIG.reglas_eventos[e.id];
+            NL_CONFIG.parents[e.id] = e.parent_id;
+        });
+        if (c.config) Object.assign(NL_CONFIG, c.config);
+    }
+}
+
 async function cargarEventos() {
     const grid = document.getElementById('gallery-grid');
     if (!grid) return;
     try {
-        const [rEv, rCat] = await Promise.all([
-            fetch('/obtener-eventos'),
+        const [, rCat] = await Promise.all([
+            sincronizarEventos(),
             fetch('/categorias')
         ]);
-        eventosData    = await rEv.json();
         const cats     = await rCat.json();
 
         // Construir menú dinámico de categorías
@@ -1278,6 +1355,45 @@ async function prepararParaSubir(file,maxBytes=9.5*1024*1024){
     return new File([blob],file.name.replace(/\.[^.]+$/,'')+'.jpg',{type:'image/jpeg'});
 }
 
+// ── Subida directa del ORIGINAL a Wasabi: multipart firmado, partes en paralelo ──
+// El original no pasa por Cloudinary ni por el servidor; después /registrar-foto
+// genera la preview y la portada leyendo el objeto ya guardado en el bucket.
+async function subirOriginalWasabi(file, eventoId) {
+    const post = (url, body) => fetch(url, {
+        method: 'POST', credentials: 'include',
+        headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(body)
+    });
+    const ini = await post('/wasabi/multipart/iniciar', {
+        evento_id: eventoId, nombre: file.name, tamano: file.size, tipo: file.type || 'image/jpeg'
+    });
+    if (!ini.ok) throw new Error('No se pudo iniciar la subida');
+    const up = await ini.json();
+
+    const partes = new Array(up.urls.length);
+    let siguiente = 0;
+    async function subirPartes() {
+        while (siguiente < up.urls.length) {
+            const i    = siguiente++;
+            const blob = file.slice(i * up.parte_bytes, (i + 1) * up.parte_bytes);
+            let res = null;
+            for (let intento = 0; intento < 3 && !(res && res.ok); intento++) {
+                try { res = await fetch(up.urls[i], { method: 'PUT', body: blob }); } catch(e) { res = null; }
+            }
+            if (!res || !res.ok) throw new Error(`Falló la parte ${i + 1}`);
+            partes[i] = { PartNumber: i + 1, ETag: res.headers.get('ETag') };
+        }
+    }
+    try {
+        await Promise.all(Array.from({ length: Math.min(4, up.urls.length) }, subirPartes));
+    } catch(e) {
+        post('/wasabi/multipart/abortar', { key: up.key, upload_id: up.upload_id });
+        throw e;
+    }
+    const fin = await post('/wasabi/multipart/completar', { key: up.key, upload_id: up.upload_id, partes });
+    if (!fin.ok) throw new Error('No se pudo completar la subida');
+    return up.key;
+}
+
 async function subirFotos(event, eventoId) {
     event.preventDefault();
     const input = event.target.querySelector('input[type="file"]');
@@ -1309,6 +1425,8 @@ async function subirFotos(event, eventoId) {
         return;
     }
 
+    // 1. Subir cada archivo al storage (el navegador no espera al procesamiento)
+    const subidas = [];
     for (let i = 0; i < files.length; i++) {
         const labelStr = `Subiendo ${i+1} de ${files.length} — ${files[i].name.substring(0,30)}`;
         if (label)    label.textContent = labelStr;
@@ -1316,43 +1434,59 @@ async function subirFotos(event, eventoId) {
         if (progBar)  progBar.style.width = `${(i/files.length)*100}%`;
 
         try {
-            // 1. Subir directo a Cloudinary desde el browser (sin pasar por Railway)
-            const fd = new FormData();
-            let archivo = files[i];
-            try { archivo = await prepararParaSubir(files[i]); } catch(e) {}
-            fd.append('file',         archivo);
-            fd.append('api_key',      sigData.api_key);
-            fd.append('timestamp',    sigData.timestamp);
-            fd.append('signature',    sigData.signature);
-            fd.append('folder',       sigData.folder);
-            fd.append('upload_preset','ml_default');
-
-            const cloudRes = await fetch(
-                `https://api.cloudinary.com/v1_1/${sigData.cloud_name}/image/upload`,
-                { method: 'POST', body: fd }
-            );
-            const cloudData = await cloudRes.json();
+            if (sigData.wasabi_directo) {
+                // Original directo a Wasabi (sin comprimir)
+                subidas.push({ key_original: await subirOriginalWasabi(files[i], eventoId) });
+            } else {
+                // Directo a Cloudinary desde el browser (sin pasar por Railway)
+                const fd = new FormData();
+                let archivo = files[i];
+                try { archivo = await prepararParaSubir(files[i]); } catch(e) {}
+                fd.append('file',         archivo);
+                fd.append('api_key',      sigData.api_key);
+                fd.append('timestamp',    sigData.timestamp);
+                fd.append('signature',    sigData.signature);
+                fd.append('folder',       sigData.folder);
+                fd.append('upload_preset','ml_default');
+
+                const cloudRes = await fetch(
+                    `https://api.cloudinary.com/v1_1/${sigData.cloud_name}/image/upload`,
+                    { method: 'POST', body: fd }
+                );
+                const cloudData = await cloudRes.json();
+                if (!cloudData.secure_url) { errores++; continue; }
+                subidas.push({ url_preview: cloudData.secure_url, public_id: cloudData.public_id });
+            }
+        } catch(e) { errores++; }
 
-            if (!cloudData.secure_url) { errores++; continue; }
+        if (progBar) progBar.style.width = `${((i+1)/files.length)*100}%`;
+    }
 
-            // 2. Registrar en BD (solo envía la URL, no la foto)
-            const regRes = await fetch('/registrar-foto', {
+    // 2. Registrar TODAS en un solo pedido y seguir el lote hasta que termine
+    if (subidas.length) {
+        try {
+            const loteRes = await fetch('/registrar-fotos/lote', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    url_preview: cloudData.secure_url,
-                    evento_id:   eventoId,
-                    precio:      PRECIO_BASE,
-                    public_id:   cloudData.public_id
-                }),
+                body: JSON.stringify({ evento_id: eventoId, precio: PRECIO_BASE, fotos: subidas }),
                 credentials: 'include'
             });
-            if (regRes.ok) exitosas++;
-            else errores++;
-
-        } catch(e) { errores++; }
-
-        if (progBar) progBar.style.width = `${((i+1)/files.length)*100}%`;
+            if (!loteRes.ok) throw new Error('lote');
+            const { lote_id } = await loteRes.json();
+            let lote = null;
+            do {
+                await new Promise(r => setTimeout(r, 2000));
+                const estRes = await fetch(`/registrar-fotos/lote/${lote_id}?estado=error`, { credentials: 'include' });
+                if (!estRes.ok) continue;
+                lote = (await estRes.json()).lote;
+                const txt = `Procesando ${lote.procesados} de ${lote.total}...`;
+                if (label)    label.textContent = txt;
+                if (progText) progText.textContent = txt;
+                if (progBar)  progBar.style.width = `${(lote.procesados/lote.total)*100}%`;
+            } while (!lote || ['pendiente', 'corriendo'].includes(lote.estado));
+            exitosas += lote.hechos;
+            errores  += lote.total - lote.hechos;
+        } catch(e) { errores += subidas.length; }
     }
 
     setTimeout(() => {
@@ -1648,11 +1782,17 @@ async function procesarPago() {
     btn.innerHTML  = '<i class="fa-solid fa-spinner fa-spin"></i> Procesando...';
 
     try {
-        const res  = await fetch('/crear-orden', {
-            method:'POST', credentials:'include',
-            headers:{'Content-Type':'application/json'},
-            body: JSON.stringify({ foto_ids, email, nombre, whatsapp, precios_custom, tipo: nlTipoCompra, fotos_impresion_ids: nlFotosImpresion })
-        });
+        // 409: otro pedido con el mismo carrito está creando el link de pago; se reintenta
+        let res;
+        for (let intento = 0; ; intento++) {
+            res = await fetch('/crear-orden', {
+                method:'POST', credentials:'include',
+                headers:{'Content-Type':'application/json'},
+                body: JSON.stringify({ foto_ids, email, nombre, whatsapp, precios_custom, tipo: nlTipoCompra, fotos_impresion_ids: nlFotosImpresion })
+            });
+            if (res.status !== 409 || intento >= 3) break;
+            await new Promise(r => setTimeout(r, 1000));
+        }
         const data = await res.json();
 
         if (res.ok && data.init_point) {
@@ -1805,7 +1945,7 @@ async function cargarAdminStats() {
     } catch {}
 }
 
-let _comprasCache = [];
+let _comprasCache = [], _comprasSiguiente = null, _comprasTimer = null;
 function _itemCompraHTML(p) {
     const cls = p.estado==='approved'?'badge-approved':p.estado==='rejected'?'badge-rejected':'badge-pendiente';
     const emailCls = p.email_enviado ? 'badge-approved' : 'badge-pendiente';
@@ -1864,6 +2004,8 @@ function _asegurarBarraFiltros() {
     cont.innerHTML =
         '<input id="filtro-q" type="text" placeholder="Buscar cliente o email..." oninput="_aplicarFiltros()" style="'+inp+';flex:1 1 180px;min-width:150px">' +
         '<select id="filtro-evento" onchange="_aplicarFiltros()" style="'+inp+';flex:1 1 160px;max-width:230px;text-overflow:ellipsis"><option value="">Todos los eventos</option></select>' +
+        '<select id="filtro-estado" onchange="_aplicarFiltros()" style="'+inp+'"><option value="">Todos los estados</option><option value="approved">Aprobadas</option><option value="pendiente">Pendientes</option><option value="rejected">Rechazadas</option></select>' +
+        '<select id="filtro-envio" onchange="_aplicarFiltros()" style="'+inp+'"><option value="">Cualquier envío</option><option value="sin_email">Sin email</option><option value="sin_wa">WA pendiente</option><option value="completo">Entregadas</option><option value="con_error">Con error de envío</option></select>' +
         '<div style="display:flex;gap:6px;align-items:center;background:#16140e;border:1px solid #38331f;border-radius:8px;padding:3px 9px">' +
             '<input id="filtro-desde" type="date" onchange="_aplicarFiltros()" title="Desde" style="background:transparent;border:0;color:#ece6d6;font-size:12px;outline:none;color-scheme:dark">' +
             '<span style="color:#7c745f;font-size:12px">→</span>' +
@@ -1872,24 +2014,29 @@ function _asegurarBarraFiltros() {
         '<button onclick="_limpiarFiltros()" style="background:transparent;border:1px solid #38331f;color:#b9b09a;padding:8px 14px;border-radius:8px;font-size:13px;cursor:pointer;white-space:nowrap">Limpiar</button>';
     barraTabs.insertAdjacentElement('beforebegin', cont);
 }
+// Los filtros se resuelven en el servidor; al tipear se espera un poco antes de pedir
 function _aplicarFiltros() {
-    const q = (document.getElementById('filtro-q')?.value || '').toLowerCase().trim();
-    const ev = document.getElementById('filtro-evento')?.value || '';
-    const desde = document.getElementById('filtro-desde')?.value || '';
-    const hasta = document.getElementById('filtro-hasta')?.value || '';
-    const lista = _comprasCache.filter(c => {
-        if (q && !(((c.nombre||'')+' '+(c.email||'')).toLowerCase().includes(q))) return false;
-        if (ev && !(c.eventos||[]).some(e => String(e.id) === ev)) return false;
-        if (desde && c.fecha_iso && c.fecha_iso < desde) return false;
-        if (hasta && c.fecha_iso && c.fecha_iso > hasta) return false;
-        return true;
+    clearTimeout(_comprasTimer);
+    _comprasTimer = setTimeout(() => cargarCompras(), 300);
+}
+function _paramsCompras() {
+    const p = new URLSearchParams();
+    [['q','filtro-q'],['evento','filtro-evento'],['desde','filtro-desde'],['hasta','filtro-hasta'],
+     ['estado','filtro-estado'],['envio','filtro-envio']].forEach(([k, id]) => {
+        const v = (document.getElementById(id)?.value || '').trim();
+        if (v) p.set(k, v);
     });
+    return p;
+}
+function _renderCompras() {
     const el = document.getElementById('tab-compras');
-    if (el) el.innerHTML = lista.length ? lista.map(_itemCompraHTML).join('') : '<p class="admin-loading">Sin resultados.</p>';
+    if (!el) return;
+    el.innerHTML = (_comprasCache.length ? _comprasCache.map(_itemCompraHTML).join('') : '<p class="admin-loading">Sin resultados.</p>') +
+        (_comprasSiguiente ? `<div style="text-align:center;padding:14px 0"><button class="admin-action-btn" onclick="cargarCompras(true)"><i class="fa-solid fa-angles-down"></i> Cargar más</button></div>` : '');
 }
 function _limpiarFiltros() {
     ['filtro-q','filtro-desde','filtro-hasta'].forEach(id => { const el=document.getElementById(id); if (el) el.value=''; });
-    const sel=document.getElementById('filtro-evento'); if (sel) sel.value='';
+    ['filtro-evento','filtro-estado','filtro-envio'].forEach(id => { const el=document.getElementById(id); if (el) el.value=''; });
     _aplicarFiltros();
 }
 // ── PESTAÑA PRECIOS: general + por evento/álbum (fijo o escalera) ──
@@ -2087,22 +2234,29 @@ async function _npGuardarRegla(evId, regla) {
     } catch(e) {}
 }
 
-async function cargarCompras() {
+async function cargarCompras(mas) {
     const el = document.getElementById('tab-compras');
     if (!el) return;
-    el.innerHTML = '<p class="admin-loading">Cargando compras...</p>';
+    if (!mas) el.innerHTML = '<p class="admin-loading">Cargando compras...</p>';
+    const sel = document.getElementById('filtro-evento');
+    if (sel && sel.options.length <= 1) {
+        // Eventos y subcarpetas ya cargados en la home (una madre incluye a sus hijas)
+        const ops = [];
+        const recorrer = (evs, pre) => (evs||[]).forEach(e => {
+            ops.push([String(e.id), pre + e.titulo]);
+            recorrer(e.subcarpetas, pre + e.titulo + ' / ');
+        });
+        recorrer(eventosData, '');
+        sel.innerHTML = '<option value="">Todos los eventos</option>' +
+            ops.sort((a,b)=>a[1].localeCompare(b[1])).map(([id,t]) => `<option value="${id}">${t}</option>`).join('');
+    }
+    const p = _paramsCompras();
+    if (mas && _comprasSiguiente) p.set('antes', _comprasSiguiente);
     try {
-        _comprasCache = await (await fetch('/admin/compras', { credentials:'include' })).json();
-        const sel = document.getElementById('filtro-evento');
-        if (sel) {
-            const vistos = new Map();
-            _comprasCache.forEach(c => (c.eventos||[]).forEach(e => vistos.set(String(e.id), e.titulo)));
-            const actual = sel.value;
-            sel.innerHTML = '<option value="">Todos los eventos</option>' +
-                [...vistos.entries()].sort((a,b)=>a[1].localeCompare(b[1])).map(([id,t]) => `<option value="${id}">${t}</option>`).join('');
-            sel.value = actual;
-        }
-        _aplicarFiltros();
+        const d = await (await fetch('/admin/compras?' + p.toString(), { credentials:'include' })).json();
+        _comprasCache     = mas ? _comprasCache.concat(d.compras || []) : (d.compras || []);
+        _comprasSiguiente = d.siguiente || null;
+        _renderCompras();
     } catch { el.innerHTML = '<p class="admin-loading" style="color:var(--red)">Error al cargar.</p>'; }
 }
 
@@ -2323,7 +2477,18 @@ async function abrirRoster(eventoId) {
                            font-family:Inter,sans-serif">
                     🤖 Procesar todas las fotos con IA
                 </button>
-            </div>`,
+                <label style="padding:8px 18px;background:var(--ink-3);color:var(--text);
+                           border:1px solid var(--ink-5);font-size:11px;font-weight:700;
+                           letter-spacing:1px;cursor:pointer;text-transform:uppercase;
+                           font-family:Inter,sans-serif">
+                    📄 Importar CSV / Excel
+                    <input type="file" accept=".csv,.xlsx" style="display:none"
+                        onchange="importarRosterArchivo(${eventoId}, this)">
+                </label>
+            </div>
+            <p style="font-size:10px;color:var(--text-dim);margin-top:8px">
+                Columnas: numero, nombre, equipo y opcional categoria (nombre de la subcarpeta).
+            </p>`,
         showConfirmButton: false,
         showCloseButton:   true,
     });
@@ -2364,6 +2529,21 @@ async function agregarJugadorRosterInline(eventoId) {
     }
 }
 
+async function importarRosterArchivo(eventoId, input) {
+    const archivo = input.files && input.files[0];
+    if (!archivo) return;
+    const fd = new FormData();
+    fd.append('archivo', archivo);
+    toast('Importando roster...', 'info', 1500);
+    const res  = await fetch(`/evento/${eventoId}/roster/importar`, {method:'POST', credentials:'include', body: fd});
+    const data = await res.json();
+    input.value = '';
+    if (!data.ok) { toast(data.error || 'No se pudo importar', 'error'); return; }
+    toast(`✓ ${data.insertados} nuevos, ${data.actualizados} actualizados` +
+          (data.rechazadas ? ` · ${data.rechazadas} filas con error` : ''), data.rechazadas ? 'info' : 'success', 4000);
+    abrirRoster(eventoId);
+}
+
 async function borrarJugadorRoster(eventoId, jugadorId, btn) {
     if (!jugadorId) { btn.closest('div')?.remove(); return; }
     await fetch(`/evento/${eventoId}/roster/${jugadorId}`, {method:'DELETE', credentials:'include'});